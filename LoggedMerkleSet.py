@@ -0,0 +1,159 @@
+from hashlib import blake2b
+import os
+
+from ReferenceMerkleSet import *
+from MerkleSet import MerkleSet, _sync_directory
+
+__all__ = ['LoggedMerkleSet']
+
+"""
+A MerkleSet which survives the process dying, by logging every change before making it and
+every so often flushing the set as a checkpoint.
+
+Both are kept in a directory. The set is a file made with MerkleSet.open, so a checkpoint 
+only writes out what changed since the last one and opening it again goes back to the last 
+checkpoint without rebuilding anything. The log has everything since the checkpoint, appended 
+in chunks which are each synced to disk at once. A chunk which didn't finish being written is 
+ignored, along with everything after it. Recovering is opening the set and replaying the log.
+
+Log format:
+
+log: [chunk]
+chunk: length 4 checksum 16 [op 1 hash 32]
+op: ADD or REMOVE
+ADD: \x01
+REMOVE: \x02
+"""
+
+ADD = bytes([1])
+REMOVE = bytes([2])
+
+class LoggedMerkleSet:
+    # depth, leaf_units and hasher are for the MerkleSet, they have to be the same every time
+    # Changes are written to the log once there are group_size of them or commit is called
+    def __init__(self, path, depth, leaf_units, hasher = default_hasher, group_size = 1024):
+        self.path = path
+        self.group_size = group_size
+        os.makedirs(path, exist_ok = True)
+        self.mset = MerkleSet.open(os.path.join(path, 'set'), depth, leaf_units, hasher)
+        self.hasher = hasher
+        logpath = os.path.join(path, 'log')
+        self.log = open(logpath, 'r+b' if os.path.exists(logpath) else 'w+b')
+        _sync_directory(path)
+        self._replay()
+        # records which haven't been written to the log yet
+        self.pending = []
+
+    # Applies everything in the log, runs of the same op are done as one batch
+    # Anything after the last whole chunk is cut off
+    def _replay(self):
+        data = self.log.read()
+        pos = 0
+        op = None
+        batch = []
+        while pos + 20 <= len(data):
+            length = int.from_bytes(data[pos:pos + 4], 'big')
+            body = data[pos + 20:pos + 20 + length]
+            if length % 33 != 0 or len(body) != length or _checksum(body) != data[pos + 4:pos + 20]:
+                break
+            for i in range(0, length, 33):
+                if body[i:i + 1] != op:
+                    self._apply(op, batch)
+                    op = body[i:i + 1]
+                    batch = []
+                batch.append(body[i + 1:i + 33])
+            pos += 20 + length
+        self._apply(op, batch)
+        if pos != len(data):
+            self.log.truncate(pos)
+            _sync(self.log)
+        self.log.seek(pos)
+
+    def _apply(self, op, batch):
+        if op == ADD:
+            self.mset.add_many_already_hashed(batch)
+        elif op == REMOVE:
+            self.mset.remove_many_already_hashed(batch)
+        elif op is not None:
+            raise SetError()
+
+    def _record(self, op, things):
+        for thing in things:
+            assert len(thing) == 32
+            self.pending.append(op + bytes(thing))
+        if len(self.pending) >= self.group_size:
+            self.commit()
+
+    # Convenience function
+    def add(self, toadd):
+        return self.add_already_hashed(self.hasher.hash_value(toadd))
+
+    def add_already_hashed(self, toadd):
+        self._record(ADD, [toadd])
+        self.mset.add_already_hashed(toadd)
+
+    def add_many_already_hashed(self, toadds):
+        toadds = list(toadds)
+        self._record(ADD, toadds)
+        self.mset.add_many_already_hashed(toadds)
+
+    # Convenience function
+    def remove(self, toremove):
+        return self.remove_already_hashed(self.hasher.hash_value(toremove))
+
+    def remove_already_hashed(self, toremove):
+        self._record(REMOVE, [toremove])
+        self.mset.remove_already_hashed(toremove)
+
+    def remove_many_already_hashed(self, toremoves):
+        toremoves = list(toremoves)
+        self._record(REMOVE, toremoves)
+        self.mset.remove_many_already_hashed(toremoves)
+
+    def get_root(self):
+        return self.mset.get_root()
+
+    # returns (boolean, proof string)
+    def is_included_already_hashed(self, tocheck):
+        return self.mset.is_included_already_hashed(tocheck)
+
+    # Convenience function
+    def contains(self, tocheck):
+        return self.contains_already_hashed(self.hasher.hash_value(tocheck))
+
+    def contains_already_hashed(self, tocheck):
+        return self.mset.contains_already_hashed(tocheck)
+
+    def __contains__(self, tocheck):
+        return self.contains_already_hashed(tocheck)
+
+    # Makes every change so far durable
+    def commit(self):
+        if len(self.pending) == 0:
+            return
+        body = b''.join(self.pending)
+        self.log.write(len(body).to_bytes(4, 'big') + _checksum(body) + body)
+        _sync(self.log)
+        self.pending = []
+
+    # Flushes the set as a new checkpoint and empties the log
+    # If this is cut short the log is replayed on top of whichever checkpoint is there,
+    # which gives the same result
+    def checkpoint(self):
+        self.commit()
+        self.mset.flush()
+        self.log.seek(0)
+        self.log.truncate()
+        _sync(self.log)
+
+    def close(self):
+        self.checkpoint()
+        self.mset.close()
+        self.log.close()
+
+def _checksum(body):
+    return blake2b(body, digest_size = 16).digest()
+
+def _sync(f):
+    f.flush()
+    os.fsync(f.fileno())
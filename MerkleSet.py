@@ -1,10 +1,21 @@
-from hashlib import blake2s, sha256
+from bisect import bisect_left
+from functools import partial
+from hashlib import blake2b
+from multiprocessing import Pool, shared_memory
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+import weakref
 
 from ReferenceMerkleSet import *
 LAZY = TRUNCATED
 
 __all__ = ['confirm_included', 'confirm_included_already_hashed', 'confirm_not_included', 
-        'confirm_not_included_already_hashed', 'MerkleSet']
+        'confirm_not_included_already_hashed', 'confirm_many_already_hashed', 'confirm_prefix_already_hashed', 'verify_proof', 'MerkleSet', 'Arena', 'MmapArena', 'Snapshot', 'hash_batch', 
+        'Hasher', 'default_hasher', 'RemoteSet', 'serve_prefix_nodes']
 
 """
 The behavior of this implementation is semantically identical to the one in ReferenceMerkleSet
@@ -16,16 +27,19 @@ Good memory efficiency
 Reasonable defense against malicious insertion attacks
 
 TODO: Port to C
-TODO: Add combining of proofs and looking up a whole multiproof at once
+TODO: Add combining of proofs
 
 Branch memory allocation data format:
 
+# Branches and leaves are blocks in an Arena, references to them are their 8 byte offsets
 # The active child is the leaf where overflow is currently sent to
 # When the active child is filled, a new empty one is made
 # When a leaf overflows, the data is sent to the active child of the parent branch
 # all unused should be zeroed out
 branch: active_child 8 patricia[size]
-patricia[n]: type 1 hash 32 type 1 hash 32 patricia[n-1] patricia[n-1]
+# count is how many things are below a MIDDLE child, it's brought up to date along with the hash
+# and is meaningless for other types
+patricia[n]: type 1 hash 32 type 1 hash 32 count 4 count 4 patricia[n-1] patricia[n-1]
 type: EMPTY or TERMINAL or MIDDLE or LAZY
 EMPTY: \x00
 TERMINAL: \x01
@@ -40,9 +54,9 @@ Leaf memory allocation data format:
 # num_inputs is the number of references from the parent branch into this leaf
 leaf: first_unused 2 num_inputs 2 [node or emptynode]
 # pos0 and pos1 are one based indexes to make it easy to detect if they are accidently cleared to zero
-node: type 1 hash 32 type 1 hash 32 pos0 2 pos1 2
+node: type 1 hash 32 type 1 hash 32 pos0 2 pos1 2 count0 4 count1 4
 # next is a zero based index
-emptynode: next 2 unused 68
+emptynode: next 2 unused 76
 """
 
 # Returned in branch updates when the terminal was unused
@@ -60,6 +74,11 @@ FRAGILE = 6
 INVALIDATING = 7
 DONE = 8
 FULL = 9
+# Returned in batch removal when there's nothing left
+NONELEFT = 10
+# Returned in single adds and removes when the thing was already there or wasn't there, so 
+# none of the counts on the way back up change
+UNCHANGED = 11
 
 def from_bytes(f):
     return int.from_bytes(f, 'big')
@@ -67,8 +86,16 @@ def from_bytes(f):
 def to_bytes(f, v):
     return int.to_bytes(f, v, 'big')
 
+# Whether the half node at pos in mem is a TERMINAL for tocheck, compared in place
+def _is_terminal(mem, pos, tocheck):
+    return mem[pos] == TERMINAL[0] and mem.find(tocheck, pos + 1, pos + 33) == pos + 1
+
 # Sanity checking on top of the hash function
-def hashaudit(mystr):
+def hashaudit(mystr, hasher = default_hasher):
+    _check_node(mystr)
+    return hasher.hashdown(mystr)
+
+def _check_node(mystr):
     assert len(mystr) == 66
     t0, t1 = mystr[0:1], mystr[33:34]
     assert t0 != LAZY and t1 != LAZY
@@ -77,7 +104,12 @@ def hashaudit(mystr):
         assert mystr[1:33] < mystr[34:]
     assert t0 != EMPTY or mystr[1:33] == BLANK
     assert t1 != EMPTY or mystr[34:] == BLANK
-    return hashdown(mystr)
+
+# Hashes a list of nodes
+def hash_batch(mystrs, hasher = default_hasher):
+    for mystr in mystrs:
+        _check_node(mystr)
+    return hasher.hash_many(mystrs)
 
 # Bounds checking for the win
 class safearray(bytearray):
@@ -100,20 +132,1027 @@ class safearray(bytearray):
             assert index < len(self)
         bytearray.__setitem__(self, index, thing)
 
-class MerkleSet:
+# Hands out blocks carved from one contiguous piece of memory, referred to by their offsets
+# Offset zero is never handed out so it can be used as null
+# memory must stay the same object as it grows because callers hold on to it
+# Subclasses can supply different memory by overriding _grow
+class Arena:
+    def __init__(self, memory = None, start = 8):
+        if memory is None:
+            memory = safearray(start)
+        self.memory = memory
+        # every block is preceded by a header of size 4 tag 4, tag is zero for free blocks
+        self.start = start
+        self.top = start
+        # free blocks are kept in a linked list per size, threaded through their first 8 bytes
+        self.free_lists = {}
+        # (pos, old contents) for everything overwritten since begin, None when not in a transaction
+        self.journal = None
+
+    # In C this should be malloc
+    # tag is any nonzero value the caller wants to keep with the block
+    # returns the offset of a zeroed out block
+    def allocate(self, size, tag = 1):
+        assert tag != 0
+        mem = self.memory
+        pos = self.free_lists.get(size, 0)
+        if pos != 0:
+            self.save(pos - 4, 12)
+            self.free_lists[size] = from_bytes(mem[pos:pos + 8])
+            mem[pos:pos + 8] = bytes(8)
+        else:
+            pos = self.top + 8
+            self._grow(pos + size)
+            mem[pos - 8:pos - 4] = to_bytes(size, 4)
+            self.top = pos + size
+        mem[pos - 4:pos] = to_bytes(tag, 4)
+        return pos
+
+    # In C this should be free
+    def free(self, pos):
+        mem = self.memory
+        size = self.size(pos)
+        assert self.tag(pos) != 0
+        self.save(pos - 4, size + 4)
+        mem[pos - 4:pos] = bytes(4)
+        mem[pos:pos + size] = bytes(size)
+        mem[pos:pos + 8] = to_bytes(self.free_lists.get(size, 0), 8)
+        self.free_lists[size] = pos
+
+    def size(self, pos):
+        return from_bytes(self.memory[pos - 8:pos - 4])
+
+    def tag(self, pos):
+        return from_bytes(self.memory[pos - 4:pos])
+
+    # returns the offsets of all blocks in use
+    def blocks(self):
+        r = []
+        pos = self.start + 8
+        while pos <= self.top:
+            if self.tag(pos) != 0:
+                r.append(pos)
+            pos += self.size(pos) + 8
+        return r
+
+    # Everything from here on can be undone with rollback
+    def begin(self):
+        assert self.journal is None
+        self.journal = []
+        self.before = (self.top, dict(self.free_lists))
+
+    # Has to be called before memory from pos to pos + length is overwritten in a transaction, 
+    # blocks past top don't need it
+    def save(self, pos, length):
+        if self.journal is not None:
+            self.journal.append((pos, bytes(self.memory[pos:pos + length])))
+
+    def commit(self):
+        self.journal = None
+
+    # Puts memory back the way it was at begin, newest first so the oldest contents win
+    def rollback(self):
+        assert self.journal is not None
+        self.modifying()
+        mem = self.memory
+        for pos, old in reversed(self.journal):
+            mem[pos:pos + len(old)] = old
+        top, free_lists = self.before
+        if self.top > top:
+            mem[top:self.top] = bytes(self.top - top)
+        self.top = top
+        self.free_lists = free_lists
+        self.journal = None
+
+    # makes memory at least end long
+    def _grow(self, end):
+        if end > len(self.memory):
+            self.memory.extend(bytes(max(end, 2 * len(self.memory)) - len(self.memory)))
+
+    # Called before anything in memory gets changed
+    def modifying(self):
+        pass
+
+    # Makes everything so far durable along with meta, which describes what's stored
+    # garbage is blocks which aren't in use by what's stored but haven't been freed yet
+    def flush(self, meta, garbage = ()):
+        pass
+
+    def close(self):
+        pass
+
+# An Arena in a memory mapped file, so what's in it can be reopened without rebuilding it
+# Only what's been flushed is kept. Nothing which is part of the last flush gets overwritten 
+# until the next one is done, so if the process dies partway through anything, opening the 
+# file again goes back to the last flush.
+# The free lists are threaded through free blocks, which get overwritten when they're reused, 
+# so every flush also writes a free block listing everything which is free in what it flushed 
+# and opening the file links them up again
+# header: magic 8 dirty 1 slot slot
+# slot: seq 8 top 8 meta 64 free 8 checksum 16
+# Flushes take turns writing the two slots, the valid one with the higher seq is the last flush
+# dirty is set when there might be blocks past the top of the last flush
+# free block: num 8 [pos 8]
+# blocks start after the header
+HEADER_SIZE = 4096
+SLOT_SIZE = 104
+MAGIC = b'MerkSet4'
+
+class MmapArena(Arena):
+    # meta is None if the file was just created
+    def __init__(self, path):
+        exists = os.path.exists(path)
+        self.file = open(path, 'r+b' if exists else 'w+b')
+        if not exists:
+            self.file.truncate(HEADER_SIZE)
+        elif os.path.getsize(path) < HEADER_SIZE:
+            self.file.close()
+            raise SetError()
+        Arena.__init__(self, mmap.mmap(self.file.fileno(), 0), HEADER_SIZE)
+        self.dirty = False
+        self.meta = None
+        # seq of the last flush
+        self.seq = 0
+        # the free block written by the last flush, which has to stay as it is until the next one
+        self.listed = 0
+        if not exists:
+            return
+        mem = self.memory
+        slots = [_read_slot(mem, 9 + SLOT_SIZE * i) for i in range(2)]
+        slots = [slot for slot in slots if slot is not None]
+        if mem[:8] != MAGIC or len(slots) == 0:
+            self.close()
+            raise SetError()
+        self.seq, self.top, self.meta, self.listed = max(slots)
+        if mem[8:9] != bytes(1):
+            mem[self.top:len(mem)] = bytes(len(mem) - self.top)
+        if self.listed != 0:
+            for i in range(from_bytes(mem[self.listed:self.listed + 8])):
+                pos = from_bytes(mem[self.listed + 8 + 8 * i:self.listed + 16 + 8 * i])
+                size = self.size(pos)
+                mem[pos - 4:pos + size] = bytes(size + 4)
+                mem[pos:pos + 8] = to_bytes(self.free_lists.get(size, 0), 8)
+                self.free_lists[size] = pos
+
+    def _grow(self, end):
+        if end > len(self.memory):
+            self.memory.resize(max(end, 2 * len(self.memory)))
+
+    def modifying(self):
+        if not self.dirty:
+            self.memory[8:9] = bytes([1])
+            self.memory.flush(0, HEADER_SIZE)
+            self.dirty = True
+
+    # returns every block on the free lists
+    def _free_blocks(self):
+        r = []
+        for pos in self.free_lists.values():
+            while pos != 0:
+                r.append(pos)
+                pos = from_bytes(self.memory[pos:pos + 8])
+        return r
+
+    # garbage is written out as free, the caller frees it after this returns
+    # The slot is only written after everything else is on disk, and the last free block is 
+    # only freed after that
+    def flush(self, meta, garbage = ()):
+        assert len(meta) <= 64
+        mem = self.memory
+        self.modifying()
+        old = self.listed
+        free = self._free_blocks()
+        # sized in powers of two so the ones from earlier flushes can be reused
+        size = 16
+        while size < 8 + 8 * (len(free) + len(garbage) + 1):
+            size *= 2
+        self.listed = self.allocate(size)
+        if self.listed in free:
+            free.remove(self.listed)
+        free.extend(garbage)
+        if old != 0:
+            free.append(old)
+        mem[self.listed:self.listed + 8 + 8 * len(free)] = to_bytes(len(free), 8) + b''.join(to_bytes(pos, 8) for pos in free)
+        mem.flush()
+        self.seq += 1
+        slot = to_bytes(self.seq, 8) + to_bytes(self.top, 8) + meta + bytes(64 - len(meta)) + to_bytes(self.listed, 8)
+        pos = 9 + SLOT_SIZE * (self.seq % 2)
+        mem[:8] = MAGIC
+        mem[pos:pos + SLOT_SIZE] = slot + blake2b(slot, digest_size = 16).digest()
+        mem.flush(0, HEADER_SIZE)
+        mem[8:9] = bytes(1)
+        mem.flush(0, HEADER_SIZE)
+        self.dirty = False
+        self.meta = slot[16:80]
+        if old != 0:
+            self.free(old)
+
+    # The free block belongs to the arena rather than to whatever is stored
+    def blocks(self):
+        return [pos for pos in Arena.blocks(self) if pos != self.listed]
+
+    # Doesn't flush
+    def close(self):
+        self.memory.close()
+        self.file.close()
+
+def _sync_directory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# returns (seq, top, meta, free) for the slot at pos, None if it's not valid
+def _read_slot(mem, pos):
+    slot = bytes(mem[pos:pos + SLOT_SIZE - 16])
+    if blake2b(slot, digest_size = 16).digest() != mem[pos + SLOT_SIZE - 16:pos + SLOT_SIZE]:
+        return None
+    return from_bytes(slot[:8]), from_bytes(slot[8:16]), slot[16:80], from_bytes(slot[80:88])
+
+# A dump is everything in a set in sorted order, each stored as how many bytes it has in 
+# common with the one before followed by the rest of it, in chunks which can be read whole
+# dump: magic 8 [chunk] end trailer
+# chunk: num_entries 2 length 4 [shared 1 rest]
+# end: \x00 * 6
+# trailer: \x00 or \x01 root 32
+DUMP_MAGIC = b'MerkDmp1'
+
+def _shared_bytes(a, b):
+    i = 0
+    while i < 31 and a[i] == b[i]:
+        i += 1
+    return i
+
+def _write_chunk(fileobj, entries):
+    body = b''.join(entries)
+    fileobj.write(to_bytes(len(entries), 2) + to_bytes(len(body), 4) + body)
+
+# Yields the hashes in a dump in order, raises SetError if they aren't in order or a chunk is cut short
+def _read_chunks(fileobj):
+    last = None
+    while True:
+        head = fileobj.read(6)
+        if len(head) != 6:
+            raise SetError()
+        num = from_bytes(head[:2])
+        length = from_bytes(head[2:])
+        if num == 0:
+            if length != 0:
+                raise SetError()
+            return
+        body = fileobj.read(length)
+        if len(body) != length:
+            raise SetError()
+        pos = 0
+        for i in range(num):
+            if pos >= length:
+                raise SetError()
+            shared = body[pos]
+            if shared > 31 or pos + 33 - shared > length or (last is None and shared != 0):
+                raise SetError()
+            thing = (last or b'')[:shared] + body[pos + 1:pos + 33 - shared]
+            if last is not None and thing <= last:
+                raise SetError()
+            pos += 33 - shared
+            last = thing
+            yield thing
+        if pos != length:
+            raise SetError()
+
+# Lookahead on a sorted stream of hashes which skips over repeats
+class _SortedStream:
+    def __init__(self, hashes):
+        self.hashes = iter(hashes)
+        self.upcoming = []
+        self.last = None
+
+    # returns None if the stream ends first
+    def peek(self, i):
+        while len(self.upcoming) <= i:
+            h = next(self.hashes, None)
+            if h is None:
+                return None
+            h = bytes(h)
+            assert len(h) == 32
+            if self.last is not None:
+                assert h >= self.last
+                if h == self.last:
+                    continue
+            self.last = h
+            self.upcoming.append(h)
+        return self.upcoming[i]
+
+    def next(self):
+        self.peek(0)
+        return self.upcoming.pop(0)
+
+    # returns how many upcoming hashes share their first depth bits with ref, up to limit
+    def count(self, ref, depth, limit):
+        i = 0
+        while i < limit:
+            h = self.peek(i)
+            if h is None or not _same_prefix(ref, h, depth):
+                break
+            i += 1
+        return i
+
+# Everything MerkleSet and Snapshot have in common, which is all that only reads the set
+# Uses arena, root, rootblock, subblock_lengths, leaf_units and hasher
+class _Reader:
+    # Snapshots can't be read from once they've been released
+    def _check_live(self):
+        pass
+
+    # The root has to have been calculated already
+    def get_root(self):
+        self._check_live()
+        assert self.root[:1] != LAZY
+        return self.hasher.compress_root(self.root)
+
+    # Turns a stored reference into an offset, None if it's null
+    def _ref(self, ref):
+        assert len(ref) == 8
+        if ref == bytes(8):
+            return None
+        return from_bytes(ref)
+
+    # Turns an offset into a reference for storing
+    def _deref(self, thing):
+        assert thing is not None
+        return to_bytes(thing, 8)
+
+    # Writes everything in the set to fileobj in the dump format, with the root if with_root is set
+    # chunk_size is how many go in each chunk, which the format only has room for up to 65535 of
+    def dump(self, fileobj, with_root = True, chunk_size = 4096):
+        self._check_live()
+        if not 0 < chunk_size <= 0xFFFF:
+            raise ValueError()
+        fileobj.write(DUMP_MAGIC)
+        last = None
+        entries = []
+        for thing in self.iter_sorted():
+            shared = 0 if last is None else _shared_bytes(last, thing)
+            entries.append(bytes([shared]) + thing[shared:])
+            last = thing
+            if len(entries) == chunk_size:
+                _write_chunk(fileobj, entries)
+                entries = []
+        if len(entries) > 0:
+            _write_chunk(fileobj, entries)
+        fileobj.write(bytes(6))
+        if with_root:
+            fileobj.write(bytes([1]) + self.get_root())
+        else:
+            fileobj.write(bytes([0]))
+
+    # Nodes are referred to as (block, pos, moddepth) where pos is where the node itself is and
+    # moddepth is None for nodes in leaves
+    # returns the node for a position in a branch, following references to other blocks
+    def _resolve(self, block, pos, moddepth):
+        mem = self.arena.memory
+        while moddepth == 0:
+            block = self._ref(mem[pos:pos + 8])
+            leafpos = from_bytes(mem[pos + 8:pos + 10])
+            if leafpos != 0xFFFF:
+                return block, block + 4 + leafpos * 78, None
+            pos = block + 8
+            moddepth = len(self.subblock_lengths) - 1
+        return block, pos, moddepth
+
+    # returns the node below the MIDDLE or LAZY child on side of node
+    def _child_node(self, node, side):
+        mem = self.arena.memory
+        block, pos, moddepth = node
+        if moddepth is None:
+            p = from_bytes(mem[pos + 66 + 2 * side:pos + 68 + 2 * side]) - 1
+            return block, block + 4 + p * 78, None
+        return self._resolve(block, pos + 74 + side * self.subblock_lengths[moddepth - 1], moddepth - 1)
+
+    # where the counts of a node's children are relative to it
+    def _count_offset(self, node):
+        return 70 if node[2] is None else 66
+
+    def _node_count(self, node):
+        return _count(self.arena.memory, node[1], node[1] + self._count_offset(node))
+
+    # returns the number of nodes it takes to store everything below node, which is at least two things
+    def _node_size(self, node):
+        mem = self.arena.memory
+        r = 1
+        for side in range(2):
+            if mem[node[1] + 33 * side:node[1] + 33 * side + 1] in (MIDDLE, LAZY):
+                r += self._node_size(self._child_node(node, side))
+        return r
+
+    # appends everything below node to things in sorted order
+    def _node_things(self, node, things):
+        mem = self.arena.memory
+        for side in range(2):
+            tpos = node[1] + 33 * side
+            t = mem[tpos:tpos + 1]
+            if t == TERMINAL:
+                things.append(bytes(mem[tpos + 1:tpos + 33]))
+            elif t != EMPTY:
+                self._node_things(self._child_node(node, side), things)
+
+    # Yields everything in the set in sorted order, starting from the first thing which isn't 
+    # less than start if it's given
+    # The set mustn't change while this is in progress, iterate over a snapshot for that
+    def iter_sorted(self, start = None):
+        self._check_live()
+        t = self.root[:1]
+        if t == EMPTY:
+            return
+        if t == TERMINAL:
+            if start is None or self.root[1:] >= start:
+                yield bytes(self.root[1:])
+            return
+        yield from self._iter_branch(self.rootblock, self.rootblock + 8, 0, len(self.subblock_lengths) - 1, start)
+
+    def __iter__(self):
+        return self.iter_sorted()
+
+    # start is None once everything here comes after it
+    # Terminals are compared directly because the two in a double can share bits
+    def _iter_branch(self, block, pos, depth, moddepth, start):
+        mem = self.arena.memory
+        if moddepth == 0:
+            child = self._ref(mem[pos:pos + 8])
+            if mem[pos + 8:pos + 10] == bytes([0xFF, 0xFF]):
+                yield from self._iter_branch(child, child + 8, depth, len(self.subblock_lengths) - 1, start)
+            else:
+                yield from self._iter_leaf(child, from_bytes(mem[pos + 8:pos + 10]), depth, start)
+            return
+        bit = 0 if start is None else get_bit(start, depth)
+        t = mem[pos:pos + 1]
+        if t == TERMINAL:
+            if start is None or mem[pos + 1:pos + 33] >= start:
+                yield bytes(mem[pos + 1:pos + 33])
+        elif t != EMPTY and bit == 0:
+            yield from self._iter_branch(block, pos + 74, depth + 1, moddepth - 1, start)
+        t = mem[pos + 33:pos + 34]
+        if t == TERMINAL:
+            if start is None or mem[pos + 34:pos + 66] >= start:
+                yield bytes(mem[pos + 34:pos + 66])
+        elif t != EMPTY:
+            yield from self._iter_branch(block, pos + 74 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1, start if bit == 1 else None)
+
+    def _iter_leaf(self, leaf, pos, depth, start):
+        mem = self.arena.memory
+        assert pos >= 0
+        rpos = leaf + 4 + pos * 78
+        bit = 0 if start is None else get_bit(start, depth)
+        t = mem[rpos:rpos + 1]
+        if t == TERMINAL:
+            if start is None or mem[rpos + 1:rpos + 33] >= start:
+                yield bytes(mem[rpos + 1:rpos + 33])
+        elif t != EMPTY and bit == 0:
+            yield from self._iter_leaf(leaf, from_bytes(mem[rpos + 66:rpos + 68]) - 1, depth + 1, start)
+        t = mem[rpos + 33:rpos + 34]
+        if t == TERMINAL:
+            if start is None or mem[rpos + 34:rpos + 66] >= start:
+                yield bytes(mem[rpos + 34:rpos + 66])
+        elif t != EMPTY:
+            yield from self._iter_leaf(leaf, from_bytes(mem[rpos + 68:rpos + 70]) - 1, depth + 1, start if bit == 1 else None)
+
+    # The number of things in the set
+    def __len__(self):
+        self._check_live()
+        t = self.root[:1]
+        if t == EMPTY:
+            return 0
+        if t == TERMINAL:
+            return 1
+        return _count(self.arena.memory, self.rootblock + 8, self.rootblock + 74)
+
+    # returns the number of things in the set which are less than tocheck
+    def rank(self, tocheck):
+        self._check_live()
+        t = self.root[:1]
+        if t == EMPTY:
+            return 0
+        if t == TERMINAL:
+            if self.root[1:] < tocheck:
+                return 1
+            return 0
+        return self._rank_branch(tocheck, self.rootblock, self.rootblock + 8, 0, len(self.subblock_lengths) - 1)
+
+    # Only follows the children tocheck would be under, counts are added for those before it
+    # Terminals are compared directly because the two in a double can share bits
+    def _rank_branch(self, tocheck, block, pos, depth, moddepth):
+        mem = self.arena.memory
+        if moddepth == 0:
+            child = self._ref(mem[pos:pos + 8])
+            if mem[pos + 8:pos + 10] == bytes([0xFF, 0xFF]):
+                return self._rank_branch(tocheck, child, child + 8, depth, len(self.subblock_lengths) - 1)
+            return self._rank_leaf(tocheck, child, from_bytes(mem[pos + 8:pos + 10]), depth)
+        bit = get_bit(tocheck, depth)
+        r = 0
+        t = mem[pos:pos + 1]
+        if t == TERMINAL:
+            if mem[pos + 1:pos + 33] < tocheck:
+                r += 1
+        elif t != EMPTY:
+            if bit == 0:
+                r += self._rank_branch(tocheck, block, pos + 74, depth + 1, moddepth - 1)
+            else:
+                r += from_bytes(mem[pos + 66:pos + 70])
+        t = mem[pos + 33:pos + 34]
+        if t == TERMINAL:
+            if mem[pos + 34:pos + 66] < tocheck:
+                r += 1
+        elif t != EMPTY and bit == 1:
+            r += self._rank_branch(tocheck, block, pos + 74 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1)
+        return r
+
+    def _rank_leaf(self, tocheck, leaf, pos, depth):
+        mem = self.arena.memory
+        assert pos >= 0
+        rpos = leaf + 4 + pos * 78
+        bit = get_bit(tocheck, depth)
+        r = 0
+        t = mem[rpos:rpos + 1]
+        if t == TERMINAL:
+            if mem[rpos + 1:rpos + 33] < tocheck:
+                r += 1
+        elif t != EMPTY:
+            if bit == 0:
+                r += self._rank_leaf(tocheck, leaf, from_bytes(mem[rpos + 66:rpos + 68]) - 1, depth + 1)
+            else:
+                r += from_bytes(mem[rpos + 70:rpos + 74])
+        t = mem[rpos + 33:rpos + 34]
+        if t == TERMINAL:
+            if mem[rpos + 34:rpos + 66] < tocheck:
+                r += 1
+        elif t != EMPTY and bit == 1:
+            r += self._rank_leaf(tocheck, leaf, from_bytes(mem[rpos + 68:rpos + 70]) - 1, depth + 1)
+        return r
+
+    # returns the thing at index in sorted order
+    def select(self, index):
+        if index < 0 or index >= len(self):
+            raise IndexError()
+        if self.root[:1] == TERMINAL:
+            return bytes(self.root[1:])
+        return self._select_branch(index, self.rootblock, self.rootblock + 8, len(self.subblock_lengths) - 1)
+
+    def _select_branch(self, index, block, pos, moddepth):
+        mem = self.arena.memory
+        if moddepth == 0:
+            child = self._ref(mem[pos:pos + 8])
+            if mem[pos + 8:pos + 10] == bytes([0xFF, 0xFF]):
+                return self._select_branch(index, child, child + 8, len(self.subblock_lengths) - 1)
+            return self._select_leaf(index, child, from_bytes(mem[pos + 8:pos + 10]))
+        t = mem[pos:pos + 1]
+        if t == TERMINAL:
+            if index == 0:
+                return bytes(mem[pos + 1:pos + 33])
+            index -= 1
+        elif t != EMPTY:
+            count = from_bytes(mem[pos + 66:pos + 70])
+            if index < count:
+                return self._select_branch(index, block, pos + 74, moddepth - 1)
+            index -= count
+        if mem[pos + 33:pos + 34] == TERMINAL:
+            assert index == 0
+            return bytes(mem[pos + 34:pos + 66])
+        return self._select_branch(index, block, pos + 74 + self.subblock_lengths[moddepth - 1], moddepth - 1)
+
+    def _select_leaf(self, index, leaf, pos):
+        mem = self.arena.memory
+        assert pos >= 0
+        rpos = leaf + 4 + pos * 78
+        t = mem[rpos:rpos + 1]
+        if t == TERMINAL:
+            if index == 0:
+                return bytes(mem[rpos + 1:rpos + 33])
+            index -= 1
+        elif t != EMPTY:
+            count = from_bytes(mem[rpos + 70:rpos + 74])
+            if index < count:
+                return self._select_leaf(index, leaf, from_bytes(mem[rpos + 66:rpos + 68]) - 1)
+            index -= count
+        if mem[rpos + 33:rpos + 34] == TERMINAL:
+            assert index == 0
+            return bytes(mem[rpos + 34:rpos + 66])
+        return self._select_leaf(index, leaf, from_bytes(mem[rpos + 68:rpos + 70]) - 1)
+
+    # returns a thing from the set picked uniformly at random
+    def sample(self):
+        num = len(self)
+        if num == 0:
+            raise IndexError()
+        return self.select(random.randrange(num))
+
+    # Finds the node for everything whose first depth bits are the same as prefix's
+    # returns (summary, things) where things is a list of what's there if there are fewer 
+    # than three of them, otherwise None
+    def get_prefix_node(self, prefix, depth):
+        self.get_root()
+        t = self.root[:1]
+        if t == EMPTY:
+            return EMPTY + BLANK, []
+        if t == TERMINAL:
+            return _prefix_terminal(bytes(self.root), prefix, depth)
+        return self._prefix_node_branch(prefix, depth, self.rootblock, self.rootblock + 8, 0, 
+                len(self.subblock_lengths) - 1, bytes(self.root))
+
+    # summary is for the node at pos
+    def _prefix_node_branch(self, prefix, depth, block, pos, d, moddepth, summary):
+        mem = self.arena.memory
+        if moddepth == 0:
+            child = self._ref(mem[pos:pos + 8])
+            leafpos = from_bytes(mem[pos + 8:pos + 10])
+            if leafpos == 0xFFFF:
+                return self._prefix_node_branch(prefix, depth, child, child + 8, d, len(self.subblock_lengths) - 1, summary)
+            return self._prefix_node_leaf(prefix, depth, child, leafpos, d, summary)
+        node = bytes(mem[pos:pos + 66])
+        if node[:1] == TERMINAL and node[33:34] == TERMINAL:
+            return _prefix_double(node, prefix, depth, summary)
+        if d == depth:
+            return summary, None
+        if get_bit(prefix, d) == 0:
+            if node[:1] != MIDDLE:
+                return _prefix_terminal(node[:33], prefix, depth)
+            return self._prefix_node_branch(prefix, depth, block, pos + 74, d + 1, moddepth - 1, node[:33])
+        else:
+            if node[33:34] != MIDDLE:
+                return _prefix_terminal(node[33:], prefix, depth)
+            return self._prefix_node_branch(prefix, depth, block, pos + 74 + self.subblock_lengths[moddepth - 1], 
+                    d + 1, moddepth - 1, node[33:])
+
+    def _prefix_node_leaf(self, prefix, depth, leaf, pos, d, summary):
+        mem = self.arena.memory
+        rpos = leaf + 4 + pos * 78
+        node = bytes(mem[rpos:rpos + 66])
+        if node[:1] == TERMINAL and node[33:34] == TERMINAL:
+            return _prefix_double(node, prefix, depth, summary)
+        if d == depth:
+            return summary, None
+        if get_bit(prefix, d) == 0:
+            if node[:1] != MIDDLE:
+                return _prefix_terminal(node[:33], prefix, depth)
+            return self._prefix_node_leaf(prefix, depth, leaf, from_bytes(mem[rpos + 66:rpos + 68]) - 1, d + 1, node[:33])
+        else:
+            if node[33:34] != MIDDLE:
+                return _prefix_terminal(node[33:], prefix, depth)
+            return self._prefix_node_leaf(prefix, depth, leaf, from_bytes(mem[rpos + 68:rpos + 70]) - 1, d + 1, node[33:])
+
+    # returns (sorted list of everything whose first depth bits are the same as prefix's, proof string)
+    # The proof is a multiproof with everything below the prefix and only summaries off the
+    # path to it, confirm_prefix_already_hashed checks that nothing was left out
+    def prefix_query(self, prefix, depth):
+        self.get_root()
+        t = self.root[:1]
+        if t == EMPTY:
+            return [], EMPTY
+        if t == TERMINAL:
+            return _prefix_terminal(bytes(self.root), prefix, depth)[1], bytes(self.root)
+        buf = []
+        found = []
+        self._prefix_query(prefix, depth, self._resolve(self.rootblock, self.rootblock + 8,
+                len(self.subblock_lengths) - 1), 0, buf, found)
+        return found, b''.join([bytes(x) for x in buf])
+
+    # appends to buf, appends what's under the prefix to found
+    def _prefix_query(self, prefix, depth, node, d, buf, found):
+        mem = self.arena.memory
+        pos = node[1]
+        buf.append(MIDDLE)
+        if mem[pos:pos + 1] == TERMINAL and mem[pos + 33:pos + 34] == TERMINAL:
+            _finish_proof(mem[pos:pos + 66], d, buf)
+            found.extend(_prefix_double(bytes(mem[pos:pos + 66]), prefix, depth, None)[1])
+            return
+        for side in range(2):
+            val = mem[pos + 33 * side:pos + 33 * side + 33]
+            if val[:1] == MIDDLE and (d >= depth or get_bit(prefix, d) == side):
+                self._prefix_query(prefix, depth, self._child_node(node, side), d + 1, buf, found)
+            else:
+                buf.append(_quick_summary(val))
+                found.extend(_prefix_terminal(bytes(val), prefix, depth)[1])
+
+    # queries is a list of (prefix, depth), returns what get_prefix_node does for each
+    def get_prefix_nodes(self, queries):
+        return [self.get_prefix_node(prefix, depth) for prefix, depth in queries]
+
+    # Yields (thing, included) for everything which is in only one of this set and other,
+    # included is whether it's the one in this set
+    # other can be anything with get_prefix_nodes, including a Snapshot or a RemoteSet
+    # Both are walked together a level at a time, skipping wherever their summaries match, so
+    # the work done is proportional to how much they differ
+    def diff(self, other):
+        queries = [(bytes(32), 0)]
+        while len(queries) > 0:
+            nextqueries = []
+            for (prefix, depth), (s0, things0), (s1, things1) in zip(queries,
+                    self.get_prefix_nodes(queries), other.get_prefix_nodes(queries)):
+                if s0 == s1:
+                    continue
+                if things0 is not None and things1 is not None:
+                    for thing in sorted(set(things0) ^ set(things1)):
+                        yield thing, thing in things0
+                    continue
+                nextqueries.append((prefix, depth + 1))
+                nextqueries.append((_set_bit(prefix, depth), depth + 1))
+            queries = nextqueries
+
+    # Convenience function
+    def is_included(self, tocheck):
+        return self.is_included_already_hashed(self.hasher.hash_value(tocheck))
+
+    # returns (boolean, proof string)
+    def is_included_already_hashed(self, tocheck):
+        buf = []
+        self.get_root()
+        t = self.root[:1]
+        if t == EMPTY:
+            return False, EMPTY
+        if t == TERMINAL:
+            return tocheck == self.root[1:], self.root
+        assert t == MIDDLE
+        r = self._is_included_branch(tocheck, self.rootblock, self.rootblock + 8, 0, len(self.subblock_lengths) - 1, buf)
+        return r, b''.join([bytes(x) for x in buf])
+
+    # returns boolean, appends to buf
+    def _is_included_branch(self, tocheck, block, pos, depth, moddepth, buf):
+        mem = self.arena.memory
+        if moddepth == 0:
+            if mem[pos + 8:pos + 10] == bytes([0xFF, 0xFF]):
+                child = self._ref(mem[pos:pos + 8])
+                return self._is_included_branch(tocheck, child, child + 8, depth, len(self.subblock_lengths) - 1, buf)
+            else:
+                return self._is_included_leaf(tocheck, self._ref(mem[pos:pos + 8]), from_bytes(mem[pos + 8:pos + 10]), depth, buf)
+        buf.append(MIDDLE)
+        # the types are checked too since EMPTY ones are all zeroes
+        if _is_terminal(mem, pos, tocheck) or _is_terminal(mem, pos + 33, tocheck):
+            _finish_proof(mem[pos:pos + 66], depth, buf)
+            return True
+        if get_bit(tocheck, depth) == 0:
+            t = mem[pos:pos + 1]
+            if t == EMPTY or t == TERMINAL:
+                _finish_proof(mem[pos:pos + 66], depth, buf)
+                return False
+            assert t == MIDDLE
+            r = self._is_included_branch(tocheck, block, pos + 74, depth + 1, moddepth - 1, buf)
+            buf.append(_quick_summary(mem[pos + 33:pos + 66]))
+            return r
+        else:
+            t = mem[pos + 33:pos + 34]
+            if t == EMPTY or t == TERMINAL:
+                _finish_proof(mem[pos:pos + 66], depth, buf)
+                return False
+            assert t == MIDDLE
+            buf.append(_quick_summary(mem[pos:pos + 33]))
+            return self._is_included_branch(tocheck, block, pos + 74 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1, buf)
+
+    # returns boolean, appends to buf
+    def _is_included_leaf(self, tocheck, block, pos, depth, buf):
+        mem = self.arena.memory
+        assert pos >= 0
+        pos = block + 4 + pos * 78
+        buf.append(MIDDLE)
+        if _is_terminal(mem, pos, tocheck) or _is_terminal(mem, pos + 33, tocheck):
+            _finish_proof(mem[pos:pos + 66], depth, buf)
+            return True
+        if get_bit(tocheck, depth) == 0:
+            t = mem[pos:pos + 1]
+            if t == EMPTY or t == TERMINAL:
+                _finish_proof(mem[pos:pos + 66], depth, buf)
+                return False
+            assert t == MIDDLE
+            r = self._is_included_leaf(tocheck, block, from_bytes(mem[pos + 66:pos + 68]) - 1, depth + 1, buf)
+            buf.append(_quick_summary(mem[pos + 33:pos + 66]))
+            return r
+        else:
+            t = mem[pos + 33:pos + 34]
+            if t == EMPTY or t == TERMINAL:
+                _finish_proof(mem[pos:pos + 66], depth, buf)
+                return False
+            assert t == MIDDLE
+            buf.append(_quick_summary(mem[pos:pos + 33]))
+            return self._is_included_leaf(tocheck, block, from_bytes(mem[pos + 68:pos + 70]) - 1, depth + 1, buf)
+
+    # Convenience function
+    def contains(self, tocheck):
+        return self.contains_already_hashed(self.hasher.hash_value(tocheck))
+
+    # Just whether tocheck is in the set, without calculating the root or making a proof, so 
+    # it's cheap to use in between changes
+    # Only looks at types and where children are, LAZY ones are followed like MIDDLE
+    def contains_already_hashed(self, tocheck):
+        self._check_live()
+        assert len(tocheck) == 32
+        t = self.root[0]
+        if t == EMPTY[0]:
+            return False
+        if t == TERMINAL[0]:
+            return _is_terminal(self.root, 0, tocheck)
+        return self._contains_branch(tocheck, self.rootblock + 8, 0, len(self.subblock_lengths) - 1)
+
+    __contains__ = contains_already_hashed
+
+    def _contains_branch(self, tocheck, pos, depth, moddepth):
+        mem = self.arena.memory
+        if moddepth == 0:
+            child, leafpos = struct.unpack_from('>QH', mem, pos)
+            if leafpos == 0xFFFF:
+                return self._contains_branch(tocheck, child + 8, depth, len(self.subblock_lengths) - 1)
+            return self._contains_leaf(tocheck, child, leafpos, depth)
+        if _is_terminal(mem, pos, tocheck) or _is_terminal(mem, pos + 33, tocheck):
+            return True
+        if get_bit(tocheck, depth) == 0:
+            t = mem[pos]
+            if t == EMPTY[0] or t == TERMINAL[0]:
+                return False
+            return self._contains_branch(tocheck, pos + 74, depth + 1, moddepth - 1)
+        t = mem[pos + 33]
+        if t == EMPTY[0] or t == TERMINAL[0]:
+            return False
+        return self._contains_branch(tocheck, pos + 74 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1)
+
+    def _contains_leaf(self, tocheck, leaf, pos, depth):
+        mem = self.arena.memory
+        assert pos >= 0
+        rpos = leaf + 4 + pos * 78
+        if _is_terminal(mem, rpos, tocheck) or _is_terminal(mem, rpos + 33, tocheck):
+            return True
+        if get_bit(tocheck, depth) == 0:
+            t = mem[rpos]
+            if t == EMPTY[0] or t == TERMINAL[0]:
+                return False
+            return self._contains_leaf(tocheck, leaf, struct.unpack_from('>H', mem, rpos + 66)[0] - 1, depth + 1)
+        t = mem[rpos + 33]
+        if t == EMPTY[0] or t == TERMINAL[0]:
+            return False
+        return self._contains_leaf(tocheck, leaf, struct.unpack_from('>H', mem, rpos + 68)[0] - 1, depth + 1)
+
+    # Adds the ones of tochecks which are below pos to found, in one walk for all of them
+    # tochecks must be sorted and all belong under pos, which must be in use
+    def _contains_many_branch(self, tochecks, pos, depth, moddepth, found):
+        mem = self.arena.memory
+        if moddepth == 0:
+            child, leafpos = struct.unpack_from('>QH', mem, pos)
+            if leafpos == 0xFFFF:
+                self._contains_many_branch(tochecks, child + 8, depth, len(self.subblock_lengths) - 1, found)
+            else:
+                self._contains_many_leaf(tochecks, child, leafpos, depth, found)
+            return
+        split = _split(tochecks, depth)
+        for side, part in ((0, tochecks[:split]), (1, tochecks[split:])):
+            tpos = pos + 33 * side
+            t = mem[tpos]
+            if t == TERMINAL[0]:
+                # both of a double are checked against everything since they can share bits
+                thing = bytes(mem[tpos + 1:tpos + 33])
+                if _contains_sorted(tochecks, thing):
+                    found.add(thing)
+            elif t != EMPTY[0] and len(part) > 0:
+                self._contains_many_branch(part, pos + 74 + side * self.subblock_lengths[moddepth - 1], 
+                        depth + 1, moddepth - 1, found)
+
+    def _contains_many_leaf(self, tochecks, leaf, pos, depth, found):
+        mem = self.arena.memory
+        assert pos >= 0
+        rpos = leaf + 4 + pos * 78
+        split = _split(tochecks, depth)
+        for side, part in ((0, tochecks[:split]), (1, tochecks[split:])):
+            tpos = rpos + 33 * side
+            t = mem[tpos]
+            if t == TERMINAL[0]:
+                thing = bytes(mem[tpos + 1:tpos + 33])
+                if _contains_sorted(tochecks, thing):
+                    found.add(thing)
+            elif t != EMPTY[0] and len(part) > 0:
+                self._contains_many_leaf(part, leaf, struct.unpack_from('>H', mem, rpos + 66 + 2 * side)[0] - 1, 
+                        depth + 1, found)
+
+    # Convenience function
+    def is_included_many(self, tochecks):
+        return self.is_included_many_already_hashed([self.hasher.hash_value(x) for x in tochecks])
+
+    # returns (list of booleans, proof string)
+    def is_included_many_already_hashed(self, tochecks):
+        tochecks = [bytes(x) for x in tochecks]
+        self.get_root()
+        t = self.root[:1]
+        if len(tochecks) == 0:
+            return [], bytes(_quick_summary(self.root))
+        if t == EMPTY:
+            return [False] * len(tochecks), EMPTY
+        if t == TERMINAL:
+            return [x == self.root[1:] for x in tochecks], bytes(self.root)
+        assert t == MIDDLE
+        buf = []
+        found = set()
+        self._is_included_many_branch(sorted(set(tochecks)), self.rootblock, self.rootblock + 8, 0, len(self.subblock_lengths) - 1, buf, found)
+        return [x in found for x in tochecks], b''.join([bytes(x) for x in buf])
+
+    # appends to buf, adds the ones which are included to found
+    def _is_included_many_branch(self, tochecks, block, pos, depth, moddepth, buf, found):
+        mem = self.arena.memory
+        if moddepth == 0:
+            if mem[pos + 8:pos + 10] == bytes([0xFF, 0xFF]):
+                child = self._ref(mem[pos:pos + 8])
+                self._is_included_many_branch(tochecks, child, child + 8, depth, len(self.subblock_lengths) - 1, buf, found)
+            else:
+                self._is_included_many_leaf(tochecks, self._ref(mem[pos:pos + 8]), from_bytes(mem[pos + 8:pos + 10]), depth, buf, found)
+            return
+        buf.append(MIDDLE)
+        if mem[pos:pos + 1] == TERMINAL and mem[pos + 33:pos + 34] == TERMINAL:
+            _finish_proof(mem[pos:pos + 66], depth, buf)
+            _found_terminal(tochecks, mem[pos:pos + 33], found)
+            _found_terminal(tochecks, mem[pos + 33:pos + 66], found)
+            return
+        split = _split(tochecks, depth)
+        if split == 0 or mem[pos:pos + 1] != MIDDLE:
+            buf.append(_quick_summary(mem[pos:pos + 33]))
+            _found_terminal(tochecks[:split], mem[pos:pos + 33], found)
+        else:
+            self._is_included_many_branch(tochecks[:split], block, pos + 74, depth + 1, moddepth - 1, buf, found)
+        if split == len(tochecks) or mem[pos + 33:pos + 34] != MIDDLE:
+            buf.append(_quick_summary(mem[pos + 33:pos + 66]))
+            _found_terminal(tochecks[split:], mem[pos + 33:pos + 66], found)
+        else:
+            self._is_included_many_branch(tochecks[split:], block, pos + 74 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1, buf, found)
+
+    # appends to buf, adds the ones which are included to found
+    def _is_included_many_leaf(self, tochecks, block, pos, depth, buf, found):
+        mem = self.arena.memory
+        assert pos >= 0
+        pos = block + 4 + pos * 78
+        buf.append(MIDDLE)
+        if mem[pos:pos + 1] == TERMINAL and mem[pos + 33:pos + 34] == TERMINAL:
+            _finish_proof(mem[pos:pos + 66], depth, buf)
+            _found_terminal(tochecks, mem[pos:pos + 33], found)
+            _found_terminal(tochecks, mem[pos + 33:pos + 66], found)
+            return
+        split = _split(tochecks, depth)
+        if split == 0 or mem[pos:pos + 1] != MIDDLE:
+            buf.append(_quick_summary(mem[pos:pos + 33]))
+            _found_terminal(tochecks[:split], mem[pos:pos + 33], found)
+        else:
+            self._is_included_many_leaf(tochecks[:split], block, from_bytes(mem[pos + 66:pos + 68]) - 1, depth + 1, buf, found)
+        if split == len(tochecks) or mem[pos + 33:pos + 34] != MIDDLE:
+            buf.append(_quick_summary(mem[pos + 33:pos + 66]))
+            _found_terminal(tochecks[split:], mem[pos + 33:pos + 66], found)
+        else:
+            self._is_included_many_leaf(tochecks[split:], block, from_bytes(mem[pos + 68:pos + 70]) - 1, depth + 1, buf, found)
+
+class MerkleSet(_Reader):
     # depth sets the size of branches, it's power of two scale with a smallest value of 0
     # leaf_units is the size of leaves, its smallest possible value is 1
     # Optimal values for both of those are heavily dependent on the memory architecture of 
     # the particular machine
-    def __init__(self, depth, leaf_units):
+    # arena is where branches and leaves are allocated, a fresh Arena by default
+    # hasher is used for all hashing, everything using the set's roots and proofs has to use the same one
+    def __init__(self, depth, leaf_units, arena = None, hasher = default_hasher):
         self.subblock_lengths = [10]
         while len(self.subblock_lengths) <= depth:
-            self.subblock_lengths.append(66 + 2 * self.subblock_lengths[-1])
+            self.subblock_lengths.append(74 + 2 * self.subblock_lengths[-1])
         self.leaf_units = leaf_units
         self.root = safearray(33)
-        # should be dumped completely on a port to C in favor of real dereferencing.
-        self.pointers_to_arrays = {}
+        if arena is None:
+            arena = Arena()
+        self.arena = arena
         self.rootblock = None
+        # where references to other blocks are within a branch, the active child and then every patricia[0]
+        self.references = [0]
+        self._find_references(8, depth)
+        # blocks are tagged with the generation they were made in, which goes up with every 
+        # snapshot and flush
+        self.generation = 1
+        # the generation of the last flush, whose blocks are what the file goes back to if the 
+        # process dies so they're treated like a snapshot's, 0 if there hasn't been one
+        self.flushed = 0
+        # live snapshots, oldest first
+        self.snapshots = []
+        # (block, born, died) for blocks which are only used by snapshots or the last flush
+        self.retired = []
+        self.hasher = hasher
+        # hashes nodes a level at a time when calculating the root, can be swapped for 
+        # anything which gives the same results
+        self.hash_batch = partial(hash_batch, hasher = hasher)
+        # (pool, how many workers it has, shared memory, finalizer) kept between calls to get_root 
+        # with workers, None until then, stop_workers lets go of them
+        self.workers = None
+        # blocks which might have changed since the last drain_changes, True for ones which are 
+        # still in use and False for ones which aren't, None unless track_changes has been called
+        self.changes = None
+        # (root, rootblock, how many blocks were retired, blocks touched since) as of begin, 
+        # None when not in a transaction
+        self.transaction = None
+        # the stack of nodes advance_root is partway through walking, (pos, dest, block, moddepth) 
+        # for ones still to be looked at and (pos, dest) for ones to hash once everything below 
+        # them is, None if nothing has been started since the last change
+        self.hashing = None
+
+    def _find_references(self, pos, moddepth):
+        if moddepth == 0:
+            self.references.append(pos)
+            return
+        self._find_references(pos + 74, moddepth - 1)
+        self._find_references(pos + 74 + self.subblock_lengths[moddepth - 1], moddepth - 1)
 
     # Only used by test code, makes sure internal state is consistent
     def _audit(self, hashes):
@@ -122,25 +1161,27 @@ class MerkleSet:
         if t == EMPTY:
             assert self.root[1:] == BLANK
             assert self.rootblock == None
-            assert len(self.pointers_to_arrays) == 0
+            assert len(self.arena.blocks()) == len(self.retired)
         elif t == TERMINAL:
             assert self.rootblock == None
-            assert len(self.pointers_to_arrays) == 0
+            assert len(self.arena.blocks()) == len(self.retired)
             newhashes.append(self.root[1:])
         else:
             allblocks = set()
             self._audit_branch(self._deref(self.rootblock), 0, allblocks, self.root, newhashes, True)
-            assert allblocks == set(self.pointers_to_arrays.keys())
+            allblocks.update(self._deref(b) for b, born, died in self.retired)
+            assert allblocks == set(self._deref(b) for b in self.arena.blocks())
         assert newhashes == sorted(hashes)
 
     def _audit_branch(self, branch, depth, allblocks, expected, hashes, can_terminate):
+        mem = self.arena.memory
         assert branch not in allblocks
         allblocks.add(branch)
         outputs = {}
         branch = self._ref(branch)
-        assert len(branch) == 8 + self.subblock_lengths[-1]
-        self._audit_branch_inner(branch, 8, depth, len(self.subblock_lengths) - 1, outputs, allblocks, expected, hashes, can_terminate)
-        active = branch[:8]
+        assert self.arena.size(branch) == 8 + self.subblock_lengths[-1]
+        self._audit_branch_inner(branch, branch + 8, depth, len(self.subblock_lengths) - 1, outputs, allblocks, expected, hashes, can_terminate)
+        active = mem[branch:branch + 8]
         if active != bytes(8):
             assert bytes(active) in outputs
         for leaf, positions in outputs.items():
@@ -149,283 +1190,687 @@ class MerkleSet:
             self._audit_whole_leaf(leaf, positions)
 
     def _audit_branch_inner(self, branch, pos, depth, moddepth, outputs, allblocks, expected, hashes, can_terminate):
+        mem = self.arena.memory
         if moddepth == 0:
-            newpos = from_bytes(branch[pos + 8:pos + 10])
-            output = bytes(branch[pos:pos + 8])
-            assert output in self.pointers_to_arrays
+            newpos = from_bytes(mem[pos + 8:pos + 10])
+            output = bytes(mem[pos:pos + 8])
             if newpos == 0xFFFF:
                 self._audit_branch(output, depth, allblocks, expected, hashes, can_terminate)
             else:
                 outputs.setdefault(output, []).append((newpos, expected))
                 self._add_hashes_leaf(self._ref(output), newpos, hashes, can_terminate)
             return
-        assert expected[:1] == LAZY or hashaudit(branch[pos:pos + 66]) == expected[1:]
-        t0 = branch[pos:pos + 1]
-        t1 = branch[pos + 33:pos + 34]
+        assert expected[:1] == LAZY or hashaudit(mem[pos:pos + 66], self.hasher) == expected[1:]
+        t0 = mem[pos:pos + 1]
+        t1 = mem[pos + 33:pos + 34]
         if t0 == EMPTY:
             assert t1 != EMPTY and t1 != TERMINAL
-            assert branch[pos + 1:pos + 33] == BLANK
+            assert mem[pos + 1:pos + 33] == BLANK
         elif t0 == TERMINAL:
             assert can_terminate or t1 != TERMINAL
             assert t1 != EMPTY
         if t1 == EMPTY:
-            assert branch[pos + 34:pos + 66] == BLANK
+            assert mem[pos + 34:pos + 66] == BLANK
         if t0 == EMPTY or t0 == TERMINAL:
-            self._audit_branch_inner_empty(branch, pos + 66, moddepth - 1)
+            self._audit_branch_inner_empty(branch, pos + 74, moddepth - 1)
             if t0 == TERMINAL:
-                hashes.append(branch[pos + 1:pos + 33])
+                hashes.append(mem[pos + 1:pos + 33])
         else:
-            self._audit_branch_inner(branch, pos + 66, depth + 1, moddepth - 1, outputs, allblocks, 
-                branch[pos:pos + 33], hashes, t1 != EMPTY)
+            n = len(hashes)
+            self._audit_branch_inner(branch, pos + 74, depth + 1, moddepth - 1, outputs, allblocks, 
+                mem[pos:pos + 33], hashes, t1 != EMPTY)
+            assert from_bytes(mem[pos + 66:pos + 70]) == len(hashes) - n
         if t1 == EMPTY or t1 == TERMINAL:
-            self._audit_branch_inner_empty(branch, pos + 66 + self.subblock_lengths[moddepth - 1], moddepth - 1)
+            self._audit_branch_inner_empty(branch, pos + 74 + self.subblock_lengths[moddepth - 1], moddepth - 1)
             if t1 == TERMINAL:
-                hashes.append(branch[pos + 34:pos + 66])
+                hashes.append(mem[pos + 34:pos + 66])
         else:
-            self._audit_branch_inner(branch, pos + 66 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1, outputs, allblocks, 
-                branch[pos + 33:pos + 66], hashes, t0 != EMPTY)
+            n = len(hashes)
+            self._audit_branch_inner(branch, pos + 74 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1, outputs, allblocks, 
+                mem[pos + 33:pos + 66], hashes, t0 != EMPTY)
+            assert from_bytes(mem[pos + 70:pos + 74]) == len(hashes) - n
 
     def _add_hashes_leaf(self, leaf, pos, hashes, can_terminate):
+        mem = self.arena.memory
         assert pos >= 0
-        rpos = 4 + pos * 70
-        t0 = leaf[rpos:rpos + 1]
-        t1 = leaf[rpos + 33:rpos + 34]
+        rpos = leaf + 4 + pos * 78
+        t0 = mem[rpos:rpos + 1]
+        t1 = mem[rpos + 33:rpos + 34]
         if t0 == TERMINAL:
-            hashes.append(leaf[rpos + 1:rpos + 33])
+            hashes.append(mem[rpos + 1:rpos + 33])
             assert can_terminate or t1 != TERMINAL
         elif t0 != EMPTY:
-            self._add_hashes_leaf(leaf, from_bytes(leaf[rpos + 66:rpos + 68]) - 1, hashes, t1 != EMPTY)
+            n = len(hashes)
+            self._add_hashes_leaf(leaf, from_bytes(mem[rpos + 66:rpos + 68]) - 1, hashes, t1 != EMPTY)
+            assert from_bytes(mem[rpos + 70:rpos + 74]) == len(hashes) - n
         if t1 == TERMINAL:
-            hashes.append(leaf[rpos + 34:rpos + 66])
+            hashes.append(mem[rpos + 34:rpos + 66])
         elif t1 != EMPTY:
-            self._add_hashes_leaf(leaf, from_bytes(leaf[rpos + 68:rpos + 70]) - 1, hashes, t0 != EMPTY)
+            n = len(hashes)
+            self._add_hashes_leaf(leaf, from_bytes(mem[rpos + 68:rpos + 70]) - 1, hashes, t0 != EMPTY)
+            assert from_bytes(mem[rpos + 74:rpos + 78]) == len(hashes) - n
 
     def _audit_branch_inner_empty(self, branch, pos, moddepth):
+        mem = self.arena.memory
         if moddepth == 0:
-            assert branch[pos:pos + 10] == bytes(10)
+            assert mem[pos:pos + 10] == bytes(10)
             return
-        assert branch[pos:pos + 66] == bytes(66)
-        self._audit_branch_inner_empty(branch, pos + 66, moddepth - 1)
-        self._audit_branch_inner_empty(branch, pos + 66 + self.subblock_lengths[moddepth - 1], moddepth - 1)
+        assert mem[pos:pos + 74] == bytes(74)
+        self._audit_branch_inner_empty(branch, pos + 74, moddepth - 1)
+        self._audit_branch_inner_empty(branch, pos + 74 + self.subblock_lengths[moddepth - 1], moddepth - 1)
 
     def _audit_whole_leaf(self, leaf, inputs):
+        mem = self.arena.memory
         leaf = self._ref(leaf)
-        assert len(leaf) == 4 + self.leaf_units * 70
-        assert len(inputs) == from_bytes(leaf[2:4])
-        mycopy = safearray([ord('X')] * (4 + self.leaf_units * 70))
+        assert self.arena.size(leaf) == 4 + self.leaf_units * 78
+        assert len(inputs) == from_bytes(mem[leaf + 2:leaf + 4])
+        mycopy = safearray([ord('X')] * (4 + self.leaf_units * 78))
         for pos, expected in inputs:
             self._audit_whole_leaf_inner(leaf, mycopy, pos, expected)
-        i = from_bytes(leaf[:2])
+        i = from_bytes(mem[leaf:leaf + 2])
         while i != 0xFFFF:
-            nexti = from_bytes(leaf[4 + i * 70:4 + i * 70 + 2])
-            assert mycopy[4 + i * 70:4 + i * 70 + 70] == b'X' * 70
-            mycopy[4 + i * 70:4 + i * 70 + 70] = bytes(70)
-            mycopy[4 + i * 70:4 + i * 70 + 2] = to_bytes(nexti, 2)
+            nexti = from_bytes(mem[leaf + 4 + i * 78:leaf + 4 + i * 78 + 2])
+            assert mycopy[4 + i * 78:4 + i * 78 + 78] == b'X' * 78
+            mycopy[4 + i * 78:4 + i * 78 + 78] = bytes(78)
+            mycopy[4 + i * 78:4 + i * 78 + 2] = to_bytes(nexti, 2)
             i = nexti
-        assert mycopy[4:] == leaf[4:]
+        assert mycopy[4:] == mem[leaf + 4:leaf + 4 + self.leaf_units * 78]
 
     def _audit_whole_leaf_inner(self, leaf, mycopy, pos, expected):
+        mem = self.arena.memory
         assert pos >= 0
-        rpos = 4 + pos * 70
-        assert mycopy[rpos:rpos + 70] == b'X' * 70
-        mycopy[rpos:rpos + 70] = leaf[rpos:rpos + 70]
-        t0 = leaf[rpos:rpos + 1]
-        t1 = leaf[rpos + 33:rpos + 34]
-        assert expected[:1] == LAZY or hashaudit(leaf[rpos:rpos + 66]) == expected[1:]
+        rpos = leaf + 4 + pos * 78
+        assert mycopy[rpos - leaf:rpos - leaf + 78] == b'X' * 78
+        mycopy[rpos - leaf:rpos - leaf + 78] = mem[rpos:rpos + 78]
+        t0 = mem[rpos:rpos + 1]
+        t1 = mem[rpos + 33:rpos + 34]
+        assert expected[:1] == LAZY or hashaudit(mem[rpos:rpos + 66], self.hasher) == expected[1:]
         if t0 == EMPTY:
             assert t1 != EMPTY
             assert t1 != TERMINAL
-            assert leaf[rpos + 1:rpos + 33] == BLANK
-            assert leaf[rpos + 66:rpos + 68] == bytes(2)
+            assert mem[rpos + 1:rpos + 33] == BLANK
+            assert mem[rpos + 66:rpos + 68] == bytes(2)
         elif t0 == TERMINAL:
             assert t1 != EMPTY
-            assert leaf[rpos + 66:rpos + 68] == bytes(2)
+            assert mem[rpos + 66:rpos + 68] == bytes(2)
         else:
             assert t0 == MIDDLE or t0 == LAZY
-            self._audit_whole_leaf_inner(leaf, mycopy, from_bytes(leaf[rpos + 66:rpos + 68]) - 1, 
-                leaf[rpos:rpos + 33])
+            self._audit_whole_leaf_inner(leaf, mycopy, from_bytes(mem[rpos + 66:rpos + 68]) - 1, 
+                mem[rpos:rpos + 33])
         if t1 == EMPTY:
-            assert leaf[rpos + 34:rpos + 66] == BLANK
-            assert leaf[rpos + 68:rpos + 70] == bytes(2)
+            assert mem[rpos + 34:rpos + 66] == BLANK
+            assert mem[rpos + 68:rpos + 70] == bytes(2)
         elif t1 == TERMINAL:
-            assert leaf[rpos + 68:rpos + 70] == bytes(2)
+            assert mem[rpos + 68:rpos + 70] == bytes(2)
         else:
             assert t1 == MIDDLE or t1 == LAZY
-            self._audit_whole_leaf_inner(leaf, mycopy, from_bytes(leaf[rpos + 68:rpos + 70]) - 1, 
-                leaf[rpos + 33:rpos + 66])
+            self._audit_whole_leaf_inner(leaf, mycopy, from_bytes(mem[rpos + 68:rpos + 70]) - 1, 
+                mem[rpos + 33:rpos + 66])
 
-    # In C this should be malloc/new
     def _allocate_branch(self):
-        b = safearray(8 + self.subblock_lengths[-1])
-        self.pointers_to_arrays[self._deref(b)] = b
-        return b
+        block = self.arena.allocate(8 + self.subblock_lengths[-1], self.generation)
+        self._changed(block)
+        return block
 
-    # In C this should be malloc/new
     def _allocate_leaf(self):
-        leaf = safearray(4 + self.leaf_units * 70)
+        mem = self.arena.memory
+        leaf = self.arena.allocate(4 + self.leaf_units * 78, self.generation)
+        self._changed(leaf)
         for i in range(self.leaf_units):
-            p = 4 + i * 70
-            leaf[p:p + 2] = to_bytes((i + 1) if i != self.leaf_units - 1 else 0xFFFF, 2)
-        self.pointers_to_arrays[self._deref(leaf)] = leaf
+            p = leaf + 4 + i * 78
+            mem[p:p + 2] = to_bytes((i + 1) if i != self.leaf_units - 1 else 0xFFFF, 2)
         return leaf
 
-    # In C this should be calloc/free
     def _deallocate(self, thing):
-        del self.pointers_to_arrays[self._deref(thing)]
+        if self._shared(thing):
+            self._retire(thing)
+        else:
+            self._gone(thing)
+            self.arena.free(thing)
 
-    # In C this should be *
-    def _ref(self, ref):
-        assert len(ref) == 8
-        if ref == bytes(8):
-            return None
-        return self.pointers_to_arrays[bytes(ref)]
+    # Whether a snapshot or the last flush might be using a block, in which case it can't be changed
+    def _shared(self, block):
+        tag = self.arena.tag(block)
+        return tag <= self.flushed or (len(self.snapshots) > 0 and tag <= self.snapshots[-1].generation)
 
-    # In C this should be &
-    def _deref(self, thing):
-        assert thing is not None
-        return to_bytes(id(thing), 8)
+    # Frees block once no snapshot or flush is using it
+    def _retire(self, block):
+        self._gone(block)
+        self.retired.append((block, self.arena.tag(block), self.generation))
 
-    def get_root(self):
+    def _copy_block(self, block):
+        mem = self.arena.memory
+        size = self.arena.size(block)
+        newblock = self.arena.allocate(size, self.generation)
+        self._changed(newblock)
+        mem[newblock:newblock + size] = mem[block:block + size]
+        return newblock
+
+    # Everything which changes a block goes through _writable first or allocated it, so 
+    # that's where changes are noted
+    # In a transaction the first change to each block saves what was in it
+    def _changed(self, block):
+        if self.changes is not None:
+            self.changes[block] = True
+        if self.transaction is not None and block not in self.transaction[3]:
+            self.transaction[3].add(block)
+            self.arena.save(block, self.arena.size(block))
+
+    # The arena saves blocks it frees itself
+    def _gone(self, block):
+        if self.changes is not None:
+            self.changes[block] = False
+        if self.transaction is not None:
+            self.transaction[3].add(block)
+
+    # Starts a transaction, everything done until commit can be undone with rollback in time 
+    # proportional to how much was changed
+    # Snapshots can't be taken or released until it's over
+    def begin(self):
+        assert self.transaction is None
+        self.transaction = (bytes(self.root), self.rootblock, len(self.retired), set())
+        self.arena.begin()
+
+    def commit(self):
+        assert self.transaction is not None
+        self.transaction = None
+        self.arena.commit()
+
+    # Puts everything back the way it was at begin
+    def rollback(self):
+        assert self.transaction is not None
+        root, rootblock, numretired, touched = self.transaction
+        self.transaction = None
+        self.arena.rollback()
+        self.hashing = None
+        self.root[:] = root
+        self.rootblock = rootblock
+        del self.retired[numretired:]
+        if self.changes is not None:
+            retired = set(block for block, born, died in self.retired)
+            for block in touched:
+                self.changes[block] = self.arena.tag(block) != 0 and block not in retired
+
+    # Starts keeping track of which blocks change, for drain_changes
+    # Everything in use counts as changed to start with
+    def track_changes(self):
+        if self.changes is None:
+            retired = set(block for block, born, died in self.retired)
+            self.changes = {block: True for block in self.arena.blocks() if block not in retired}
+
+    # returns an iterator of (block, contents) for every block which might have changed since
+    # the last call, in order of block, after calculating the root
+    # contents is None for blocks which aren't used any more
+    # Applying these in order to a copy of every block there was keeps it the same as the 
+    # blocks which are in use now, rootblock says which of them is the root
+    def drain_changes(self):
+        self.track_changes()
+        self.get_root()
+        mem = self.arena.memory
+        changes = self.changes
+        self.changes = {}
+        return iter([(block, bytes(mem[block:block + self.arena.size(block)]) if inuse else None) 
+                for block, inuse in sorted(changes.items())])
+
+    # Has to be called on the root block before anything else is changed
+    def _writable_root(self):
+        self.hashing = None
+        if self.rootblock is None:
+            return
+        if self._shared(self.rootblock):
+            newblock = self._copy_block(self.rootblock)
+            self._retire(self.rootblock)
+            self.rootblock = newblock
+        else:
+            self._changed(self.rootblock)
+
+    # Whether making block writable does anything more than hand it back, in which case adds and 
+    # removes check that something below it is going to change first, so no-ops don't copy 
+    # shared blocks or show up in changes and transactions
+    def _costly(self, block):
+        if self.changes is not None or self.transaction is not None:
+            return True
+        # nothing can be shared if there's no snapshot or flush, which is worth not looking up
+        return (self.flushed != 0 or len(self.snapshots) > 0) and self._shared(block)
+
+    # Has to be called on a child before it gets changed, block must already be writable
+    # returns child, or a copy of it which block refers to instead if it's shared
+    def _writable(self, block, child):
+        if child is None:
+            return child
+        if not self._shared(child):
+            self._changed(child)
+            return child
+        mem = self.arena.memory
+        newchild = self._copy_block(child)
+        old = self._deref(child)
+        new = self._deref(newchild)
+        # a leaf can be referred to from several places in block
+        for p in self.references:
+            if mem[block + p:block + p + 8] == old:
+                mem[block + p:block + p + 8] = new
+        self._retire(child)
+        return newchild
+
+    # Returns a read only view of the set as it is now, which doesn't change along with the set
+    # Call release on it when done so any blocks only it uses can be freed
+    def snapshot(self):
+        assert self.transaction is None
+        self.get_root()
+        s = Snapshot(self)
+        self.snapshots.append(s)
+        self.generation += 1
+        return s
+
+    def _release(self, snapshot):
+        assert self.transaction is None
+        self.snapshots.remove(snapshot)
+        self.arena.modifying()
+        self._free_retired()
+
+    # Frees the retired blocks which neither a snapshot nor the last flush is using any more
+    def _free_retired(self):
+        retired = []
+        for block, born, died in self.retired:
+            if born <= self.flushed < died or any(born <= s.generation < died for s in self.snapshots):
+                retired.append((block, born, died))
+            else:
+                self.arena.free(block)
+        self.retired = retired
+
+    # Opens the set stored in the file at path, making an empty one if there isn't one yet
+    # depth and leaf_units have to be the same as when it was made
+    @classmethod
+    def open(cls, path, depth, leaf_units, hasher = default_hasher):
+        if not os.path.exists(path):
+            # made under another name and only moved to path once it's been flushed, so if the 
+            # process dies partway through there's either nothing at path or a file which opens
+            new = path + '.new'
+            if os.path.exists(new):
+                os.remove(new)
+            mset = cls(depth, leaf_units, MmapArena(new), hasher)
+            mset.flush()
+            os.replace(new, path)
+            _sync_directory(os.path.dirname(os.path.abspath(path)))
+            return mset
+        arena = MmapArena(path)
+        mset = cls(depth, leaf_units, arena, hasher)
+        if arena.meta[:5] != to_bytes(depth, 1) + to_bytes(leaf_units, 4):
+            arena.close()
+            raise SetError()
+        mset.root[:] = arena.meta[5:38]
+        mset.rootblock = mset._ref(arena.meta[38:46])
+        mset.flushed = from_bytes(arena.meta[46:50])
+        mset.generation = mset.flushed + 1
+        return mset
+
+    # Makes the current state durable for sets made with open
+    # The root is calculated first so nothing which was flushed gets hashed in place afterwards
+    # meta: depth 1 leaf_units 4 root 33 rootblock 8 generation 4
+    def flush(self):
+        assert self.transaction is None
+        self.get_root()
+        rootblock = bytes(8) if self.rootblock is None else self._deref(self.rootblock)
+        # retired blocks are only kept for snapshots, which don't outlast the process
+        self.arena.flush(to_bytes(len(self.subblock_lengths) - 1, 1) + to_bytes(self.leaf_units, 4) + 
+                bytes(self.root) + rootblock + to_bytes(self.generation, 4), 
+                [block for block, born, died in self.retired])
+        # everything there is now is what the file goes back to until the next flush
+        self.flushed = self.generation
+        self.generation += 1
+        self._free_retired()
+
+    # Releases any snapshots, flushes and lets go of the file for sets made with open
+    def close(self):
+        while len(self.snapshots) > 0:
+            self.snapshots[0].release()
+        self.flush()
+        self.stop_workers()
+        self.arena.close()
+
+    # workers is how many processes to split the hashing between, hash_batch has to be 
+    # picklable to use more than one
+    def get_root(self, workers = None):
         if self.root[:1] == LAZY:
-            self.root[:] = self._force_calculation_branch(self.rootblock, 8, len(self.subblock_lengths) - 1)
-        return compress_root(self.root)
+            if workers is not None and workers > 1:
+                self.arena.modifying()
+                self.hashing = None
+                self._hash_levels(self._hash_subtrees_in_workers(workers))
+            else:
+                self.advance_root()
+        return self.hasher.compress_root(self.root)
 
-    def _force_calculation_branch(self, block, pos, moddepth):
-        if moddepth == 0:
-            block2 = self._ref(block[pos:pos + 8])
-            pos = from_bytes(block[pos + 8:pos + 10])
-            if pos == 0xFFFF:
-                return self._force_calculation_branch(block2, 8, len(self.subblock_lengths) - 1)
+    # Does some of the hashing get_root would do, so it can be spread out
+    # Stops after budget_nodes nodes or once budget_seconds have gone by, None for no limit, 
+    # and carries on from there next time
+    # Finding what needs hashing is done along the way, only looking below a node once it's 
+    # been reached, and everything hashed is kept if the set changes before the next call, so 
+    # each call does a bounded amount of work even with changes in between
+    # returns whether the root is ready, in which case get_root won't do any hashing
+    def advance_root(self, budget_nodes = None, budget_seconds = None):
+        if self.root[:1] != LAZY:
+            return True
+        self.arena.modifying()
+        if budget_nodes is None and budget_seconds is None:
+            # with no limit it's quicker to find everything first and hash it a level at a time
+            self.hashing = None
+            self._hash_levels(self._collect_levels())
+            return True
+        if self.hashing is None:
+            self.hashing = [self._root_node()]
+        stack = self.hashing
+        mem = self.arena.memory
+        if budget_seconds is not None:
+            deadline = time.monotonic() + budget_seconds
+        # the nodes reached are hashed at the end, grouped by how far they are above ones whose 
+        # children were already hashed so each group can be hashed together
+        levels = []
+        # the height of each of those by where its summary goes
+        heights = {}
+        steps = 0
+        while len(stack) > 0 and budget_nodes != 0:
+            node = stack.pop()
+            if len(node) == 4:
+                pos, dest, block, moddepth = node
+                stack.append((pos, dest))
+                stack.extend(self._lazy_children(pos, block, moddepth))
+            else:
+                pos, dest = node
+                height = 0
+                if mem[pos] == LAZY[0]:
+                    height = heights.pop(pos) + 1
+                if mem[pos + 33] == LAZY[0]:
+                    height = max(height, heights.pop(pos + 33) + 1)
+                heights[dest] = height
+                if height == len(levels):
+                    levels.append([])
+                levels[height].append(node)
+                if budget_nodes is not None:
+                    budget_nodes -= 1
+            steps += 1
+            if budget_seconds is not None and steps % 256 == 0 and time.monotonic() >= deadline:
+                break
+        for level in levels:
+            self._hash_nodes(level)
+        if len(stack) == 0:
+            self.hashing = None
+            return True
+        return False
+
+    # Calls advance_root in a thread, budget_nodes at a time while holding lock, until the root 
+    # is ready
+    # Anything else using the set has to hold lock too until the thread is done
+    # returns the thread
+    def advance_root_in_background(self, lock, budget_nodes = 256):
+        def run():
+            while True:
+                with lock:
+                    if self.advance_root(budget_nodes):
+                        return
+                # gives whatever is waiting on lock a chance to get it
+                time.sleep(0)
+        thread = threading.Thread(target = run, daemon = True)
+        thread.start()
+        return thread
+
+    def _collect_levels(self):
+        return _collect_levels(self.arena.memory, self.subblock_lengths, [self._root_node()], [])
+
+    # The root as (pos, dest, block, moddepth), the form nodes are passed around in while hashing
+    def _root_node(self):
+        return (self.rootblock + 8, None, self.rootblock, len(self.subblock_lengths) - 1)
+
+    # returns the LAZY children of the node at pos, as (pos, dest, block, moddepth) with a 
+    # moddepth of -1 for nodes in leaves
+    def _lazy_children(self, pos, block, moddepth):
+        mem = self.arena.memory
+        r = []
+        if moddepth < 0:
+            if mem[pos] == LAZY[0]:
+                r.append((block + 4 + (from_bytes(mem[pos + 66:pos + 68]) - 1) * 78, pos, block, -1))
+            if mem[pos + 33] == LAZY[0]:
+                r.append((block + 4 + (from_bytes(mem[pos + 68:pos + 70]) - 1) * 78, pos + 33, block, -1))
+            return r
+        if mem[pos] == LAZY[0]:
+            r.append(self._node_at(block, pos + 74, moddepth - 1, pos))
+        if mem[pos + 33] == LAZY[0]:
+            r.append(self._node_at(block, pos + 74 + self.subblock_lengths[moddepth - 1], moddepth - 1, pos + 33))
+        return r
+
+    # Follows a reference to the top node of the block it's to
+    def _node_at(self, block, pos, moddepth, dest):
+        if moddepth > 0:
+            return (pos, dest, block, moddepth)
+        mem = self.arena.memory
+        child = self._ref(mem[pos:pos + 8])
+        leafpos = from_bytes(mem[pos + 8:pos + 10])
+        if leafpos == 0xFFFF:
+            return (child + 8, dest, child, len(self.subblock_lengths) - 1)
+        return (child + 4 + leafpos * 78, dest, child, -1)
+
+    def _hash_levels(self, levels):
+        # deepest first so everything below a node is done before it's hashed
+        for level in reversed(levels):
+            self._hash_nodes(level)
+
+    # everything nodes are above has to be hashed already
+    def _hash_nodes(self, nodes):
+        mem = self.arena.memory
+        digests = self.hash_batch([mem[pos:pos + 66] for pos, dest in nodes])
+        for (pos, dest), digest in zip(nodes, digests):
+            if dest is None:
+                self.root[:] = MIDDLE + digest
             else:
-                return self._force_calculation_leaf(block2, pos)
-        if block[pos:pos + 1] == LAZY:
-            block[pos:pos + 33] = self._force_calculation_branch(block, pos + 66, moddepth - 1)
-        if block[pos + 33:pos + 34] == LAZY:
-            block[pos + 33:pos + 66] = self._force_calculation_branch(block, pos + 66 + self.subblock_lengths[moddepth - 1], moddepth - 1)
-        return MIDDLE + hashaudit(block[pos:pos + 66])
-
-    def _force_calculation_leaf(self, block, pos):
-        pos = 4 + pos * 70
-        if block[pos:pos + 1] == LAZY:
-            block[pos:pos + 33] = self._force_calculation_leaf(block, from_bytes(block[pos + 66:pos + 68]) - 1)
-        if block[pos + 33:pos + 34] == LAZY:
-            block[pos + 33:pos + 66] = self._force_calculation_leaf(block, from_bytes(block[pos + 68:pos + 70]) - 1)
-        return MIDDLE + hashaudit(block[pos:pos + 66])
+                mem[dest:dest + 33] = MIDDLE + digest
+
+    # Hashes the subtrees below the first depth with enough LAZY nodes to keep the workers busy, 
+    # each worker finding and hashing whole subtrees in a shared memory copy of the arena, so 
+    # only the depths above that are walked here
+    # returns the levels above that depth, which are left to do
+    def _hash_subtrees_in_workers(self, workers):
+        levels = [[self._root_node()]]
+        while len(levels[-1]) < 4 * workers:
+            below = []
+            for pos, dest, block, moddepth in levels[-1]:
+                below.extend(self._lazy_children(pos, block, moddepth))
+            if len(below) == 0:
+                break
+            levels.append(below)
+        if len(levels[-1]) >= 4 * workers:
+            cut = levels.pop()
+            pool, shm = self._start_workers(workers)
+            top = self.arena.top
+            with memoryview(self.arena.memory) as view:
+                shm.buf[:top] = view[:top]
+            tasks = [(shm.name, self.hash_batch, self.subblock_lengths, cut[i::4 * workers]) for i in range(4 * workers)]
+            results = pool.starmap(_hash_subtrees_in_worker, tasks)
+            # whole blocks are copied back, they can't have changed here in the meantime
+            mem = self.arena.memory
+            copied = set()
+            for blocks, summaries in results:
+                for block in blocks:
+                    if block not in copied:
+                        copied.add(block)
+                        size = self.arena.size(block)
+                        mem[block:block + size] = shm.buf[block:block + size]
+            for blocks, summaries in results:
+                for dest, summary in summaries:
+                    mem[dest:dest + 33] = summary
+        return [[(pos, dest) for pos, dest, block, moddepth in level] for level in levels]
+
+    # returns the pool and shared memory for hashing in workers, starting them if there aren't 
+    # any yet, replacing the pool if it has a different number of workers and the shared 
+    # memory if the arena has outgrown it
+    def _start_workers(self, workers):
+        pool = shm = None
+        if self.workers is not None:
+            pool, num, shm, finalizer = self.workers
+            finalizer.detach()
+            if num != workers:
+                _stop_workers(pool, None)
+                pool = None
+            if shm.size < self.arena.top:
+                _stop_workers(None, shm)
+                shm = None
+        # the shared memory has to come first, so the workers share the resource tracker it 
+        # starts instead of starting their own which remove it when they exit
+        if shm is None:
+            # with room to grow so it isn't replaced every time something is added
+            shm = shared_memory.SharedMemory(create = True, size = 2 * self.arena.top)
+        if pool is None:
+            pool = Pool(workers)
+        # lets go of them if the set is garbage collected or the interpreter exits first
+        self.workers = (pool, workers, shm, weakref.finalize(self, _stop_workers, pool, shm))
+        return pool, shm
+
+    # Lets go of the worker processes and shared memory kept for get_root with workers
+    # This also happens when the set is garbage collected, but calling it or close says when
+    def stop_workers(self):
+        if self.workers is None:
+            return
+        finalizer = self.workers[3]
+        self.workers = None
+        finalizer()
 
     # Convenience function
     def add(self, toadd):
-        return self.add_already_hashed(sha256(toadd).digest())
+        return self.add_already_hashed(self.hasher.hash_value(toadd))
 
     def add_already_hashed(self, toadd):
         t = self.root[:1]
+        if t == TERMINAL and toadd == self.root[1:]:
+            return
+        # checked is whether toadd is known not to be there yet, see _costly
+        checked = False
+        if (t == MIDDLE or t == LAZY) and (self.hashing is not None or self._costly(self.rootblock)):
+            if self._contains_branch(toadd, self.rootblock + 8, 0, len(self.subblock_lengths) - 1):
+                return
+            checked = True
+        self.arena.modifying()
+        self._writable_root()
         if t == EMPTY:
             self.root[:] = TERMINAL + toadd
         elif t == TERMINAL:
-            if toadd == self.root[1:]:
-                return
             self.rootblock = self._allocate_branch()
-            self._insert_branch([self.root[1:], toadd], self.rootblock, 8, 0, len(self.subblock_lengths) - 1)
+            self._insert_branch([self.root[1:], toadd], self.rootblock, self.rootblock + 8, 0, len(self.subblock_lengths) - 1)
             self.root[:1] = LAZY
         else:
-            if self._add_to_branch(toadd, self.rootblock, 0) == INVALIDATING:
+            if self._add_to_branch(toadd, self.rootblock, 0, checked) == INVALIDATING:
                 self.root[:1] = LAZY
 
-    # returns INVALIDATING, DONE
-    def _add_to_branch(self, toadd, block, depth):
-        return self._add_to_branch_inner(toadd, block, 8, depth, len(self.subblock_lengths) - 1)
+    # returns INVALIDATING, DONE, UNCHANGED
+    def _add_to_branch(self, toadd, block, depth, checked = False):
+        return self._add_to_branch_inner(toadd, block, block + 8, depth, len(self.subblock_lengths) - 1, checked)
 
-    # returns NOTSTARTED, INVALIDATING, DONE
-    def _add_to_branch_inner(self, toadd, block, pos, depth, moddepth):
+    # returns NOTSTARTED, INVALIDATING, DONE, UNCHANGED
+    def _add_to_branch_inner(self, toadd, block, pos, depth, moddepth, checked = False):
+        mem = self.arena.memory
         if moddepth == 0:
-            nextblock = self._ref(block[pos:pos + 8])
-            if nextblock is None:
+            child = self._ref(mem[pos:pos + 8])
+            if child is None:
                 return NOTSTARTED
-            nextpos = from_bytes(block[pos + 8:pos + 10])
+            if not checked and self._costly(child):
+                if self._contains_branch(toadd, pos, depth, 0):
+                    return UNCHANGED
+                checked = True
+            nextblock = self._writable(block, child)
+            nextpos = from_bytes(mem[pos + 8:pos + 10])
             if nextpos == 0xFFFF:
-                return self._add_to_branch(toadd, nextblock, depth)
+                return self._add_to_branch(toadd, nextblock, depth, checked)
             else:
                 return self._add_to_leaf(toadd, block, pos, nextblock, nextpos, depth)
         if get_bit(toadd, depth) == 0:
-            r = self._add_to_branch_inner(toadd, block, pos + 66, depth + 1, moddepth - 1)
+            r = self._add_to_branch_inner(toadd, block, pos + 74, depth + 1, moddepth - 1, checked)
+            if r == UNCHANGED:
+                return UNCHANGED
+            if r != NOTSTARTED:
+                _add_count(mem, pos + 66, 1)
             if r == INVALIDATING:
-                if block[pos:pos + 1] != LAZY:
-                    block[pos:pos + 1] = LAZY
-                    if block[pos + 33:pos + 34] != LAZY:
+                if mem[pos:pos + 1] != LAZY:
+                    mem[pos:pos + 1] = LAZY
+                    if mem[pos + 33:pos + 34] != LAZY:
                         return INVALIDATING
                 return DONE
             if r == DONE:
                 return DONE
-            t0 = block[pos:pos + 1]
-            t1 = block[pos + 33:pos + 34]
+            t0 = mem[pos:pos + 1]
+            t1 = mem[pos + 33:pos + 34]
             if t0 == EMPTY:
                 if t1 == EMPTY:
                     return NOTSTARTED
-                block[pos:pos + 1] = TERMINAL
-                block[pos + 1:pos + 33] = toadd
+                mem[pos:pos + 1] = TERMINAL
+                mem[pos + 1:pos + 33] = toadd
                 if t1 != LAZY:
                     return INVALIDATING
                 else:
                     return DONE
             assert t0 == TERMINAL
-            v0 = block[pos + 1:pos + 33]
+            v0 = mem[pos + 1:pos + 33]
             if v0 == toadd:
-                return DONE
+                return UNCHANGED
             if t1 == TERMINAL:
-                v1 = block[pos + 34:pos + 66]
+                v1 = mem[pos + 34:pos + 66]
                 if v1 == toadd:
-                    return DONE
-                block[pos + 33:pos + 66] = bytes(33)
+                    return UNCHANGED
+                mem[pos + 33:pos + 66] = bytes(33)
                 self._insert_branch([toadd, v0, v1], block, pos, depth, moddepth)
             else:
-                self._insert_branch([toadd, v0], block, pos + 66, depth + 1, moddepth - 1)
-                block[pos:pos + 1] = LAZY
+                self._insert_branch([toadd, v0], block, pos + 74, depth + 1, moddepth - 1)
+                mem[pos:pos + 1] = LAZY
+                self._recount((block, pos, moddepth), 0)
             if t1 != LAZY:
                 return INVALIDATING
             else:
                 return DONE
         else:
-            r = self._add_to_branch_inner(toadd, block, pos + 66 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1)
+            r = self._add_to_branch_inner(toadd, block, pos + 74 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1, checked)
+            if r == UNCHANGED:
+                return UNCHANGED
+            if r != NOTSTARTED:
+                _add_count(mem, pos + 70, 1)
             if r == INVALIDATING:
-                if block[pos + 33:pos + 34] != LAZY:
-                    block[pos + 33:pos + 34] = LAZY
-                    if block[pos:pos + 1] != LAZY:
+                if mem[pos + 33:pos + 34] != LAZY:
+                    mem[pos + 33:pos + 34] = LAZY
+                    if mem[pos:pos + 1] != LAZY:
                         return INVALIDATING
                 return DONE
             if r == DONE:
                 return DONE
-            t0 = block[pos:pos + 1]
-            t1 = block[pos + 33:pos + 34]
+            t0 = mem[pos:pos + 1]
+            t1 = mem[pos + 33:pos + 34]
             if t1 == EMPTY:
                 if t0 == EMPTY:
                     return NOTSTARTED
-                block[pos + 33:pos + 34] = TERMINAL
-                block[pos + 34:pos + 66] = toadd
+                mem[pos + 33:pos + 34] = TERMINAL
+                mem[pos + 34:pos + 66] = toadd
                 if t0 != LAZY:
                     return INVALIDATING
                 else:
                     return DONE
             assert t1 == TERMINAL
-            v1 = block[pos + 34:pos + 66]
+            v1 = mem[pos + 34:pos + 66]
             if v1 == toadd:
-                return DONE
+                return UNCHANGED
             if t0 == TERMINAL:
-                v0 = block[pos + 1:pos + 33]
+                v0 = mem[pos + 1:pos + 33]
                 if v0 == toadd:
-                    return DONE
-                block[pos:pos + 33] = bytes(33)
+                    return UNCHANGED
+                mem[pos:pos + 33] = bytes(33)
                 self._insert_branch([toadd, v0, v1], block, pos, depth, moddepth)
             else:
-                self._insert_branch([toadd, v1], block, pos + 66 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1)
-                block[pos + 33:pos + 34] = LAZY
+                self._insert_branch([toadd, v1], block, pos + 74 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1)
+                mem[pos + 33:pos + 34] = LAZY
+                self._recount((block, pos, moddepth), 1)
             if t0 != LAZY:
                 return INVALIDATING
             else:
                 return DONE
 
     def _insert_branch(self, things, block, pos, depth, moddepth):
+        mem = self.arena.memory
         assert 2 <= len(things) <= 3
         if moddepth == 0:
-            child = self._ref(block[:8])
+            child = self._writable(block, self._ref(mem[block:block + 8]))
             r = FULL
             if child is not None:
                 r, leafpos = self._insert_leaf(things, child, depth)
@@ -435,166 +1880,175 @@ class MerkleSet:
                 if r == FULL:
                     self._deallocate(child)
                     newb = self._allocate_branch()
-                    block[pos:pos + 8] = self._deref(newb)
-                    block[pos + 8:pos + 10] = to_bytes(0xFFFF, 2)
-                    self._insert_branch(things, newb, 8, depth, len(self.subblock_lengths) - 1)
+                    mem[pos:pos + 8] = self._deref(newb)
+                    mem[pos + 8:pos + 10] = to_bytes(0xFFFF, 2)
+                    self._insert_branch(things, newb, newb + 8, depth, len(self.subblock_lengths) - 1)
                     return
-                block[:8] = self._deref(child)
+                mem[block:block + 8] = self._deref(child)
             # increment the number of inputs in the active child
-            child[2:4] = to_bytes(from_bytes(child[2:4]) + 1, 2)
-            block[pos:pos + 8] = self._deref(child)
-            block[pos + 8:pos + 10] = to_bytes(leafpos, 2)
+            mem[child + 2:child + 4] = to_bytes(from_bytes(mem[child + 2:child + 4]) + 1, 2)
+            mem[pos:pos + 8] = self._deref(child)
+            mem[pos + 8:pos + 10] = to_bytes(leafpos, 2)
             return
         things.sort()
         if len(things) == 2:
-            block[pos:pos + 1] = TERMINAL
-            block[pos + 1:pos + 33] = things[0]
-            block[pos + 33:pos + 34] = TERMINAL
-            block[pos + 34:pos + 66] = things[1]
+            mem[pos:pos + 1] = TERMINAL
+            mem[pos + 1:pos + 33] = things[0]
+            mem[pos + 33:pos + 34] = TERMINAL
+            mem[pos + 34:pos + 66] = things[1]
             return
         bits = [get_bit(thing, depth) for thing in things]
         if bits[0] == bits[1] == bits[2]:
             if bits[0] == 0:
-                self._insert_branch(things, block, pos + 66, depth + 1, moddepth - 1)
-                block[pos:pos + 1] = LAZY
+                self._insert_branch(things, block, pos + 74, depth + 1, moddepth - 1)
+                mem[pos:pos + 1] = LAZY
             else:
-                self._insert_branch(things, block, pos + 66 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1)
-                block[pos + 33:pos + 34] = LAZY
+                self._insert_branch(things, block, pos + 74 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1)
+                mem[pos + 33:pos + 34] = LAZY
         else:
             if bits[0] == bits[1]:
-                block[pos + 33:pos + 34] = TERMINAL
-                block[pos + 34:pos + 66] = things[2]
-                self._insert_branch(things[:2], block, pos + 66, depth + 1, moddepth - 1)
-                block[pos:pos + 1] = LAZY
+                mem[pos + 33:pos + 34] = TERMINAL
+                mem[pos + 34:pos + 66] = things[2]
+                self._insert_branch(things[:2], block, pos + 74, depth + 1, moddepth - 1)
+                mem[pos:pos + 1] = LAZY
             else:
-                block[pos:pos + 1] = TERMINAL
-                block[pos + 1:pos + 33] = things[0]
-                self._insert_branch(things[1:], block, pos + 66 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1)
-                block[pos + 33:pos + 34] = LAZY
+                mem[pos:pos + 1] = TERMINAL
+                mem[pos + 1:pos + 33] = things[0]
+                self._insert_branch(things[1:], block, pos + 74 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1)
+                mem[pos + 33:pos + 34] = LAZY
+        self._recount_node((block, pos, moddepth))
 
     # returns INVALIDATING, DONE
     def _add_to_leaf(self, toadd, branch, branchpos, leaf, leafpos, depth):
+        mem = self.arena.memory
         r = self._add_to_leaf_inner(toadd, leaf, leafpos, depth)
         if r != FULL:
             return r
-        if from_bytes(leaf[2:4]) == 1:
+        if from_bytes(mem[leaf + 2:leaf + 4]) == 1:
             # leaf is full and only has one input
             # it cannot be split so it must be replaced with a branch
             newb = self._allocate_branch()
-            self._copy_leaf_to_branch(newb, 8, len(self.subblock_lengths) - 1, leaf, leafpos)
+            self._copy_leaf_to_branch(newb, newb + 8, len(self.subblock_lengths) - 1, leaf, leafpos)
             self._add_to_branch(toadd, newb, depth)
-            branch[branchpos:branchpos + 8] = self._deref(newb)
-            branch[branchpos + 8:branchpos + 10] = to_bytes(0xFFFF, 2)
-            if branch[:8] == self._deref(leaf):
-                branch[:8] = bytes(8)
+            mem[branchpos:branchpos + 8] = self._deref(newb)
+            mem[branchpos + 8:branchpos + 10] = to_bytes(0xFFFF, 2)
+            if mem[branch:branch + 8] == self._deref(leaf):
+                mem[branch:branch + 8] = bytes(8)
             self._deallocate(leaf)
             return INVALIDATING
-        active = self._ref(branch[:8])
-        if active is None or active is leaf:
+        active = self._writable(branch, self._ref(mem[branch:branch + 8]))
+        if active is None or active == leaf:
             active = self._allocate_leaf()
         r, newpos = self._copy_between_leafs(leaf, active, leafpos)
         if r != DONE:
             active = self._allocate_leaf()
             r, newpos = self._copy_between_leafs(leaf, active, leafpos)
             assert r == DONE
-        branch[branchpos:branchpos + 8] = self._deref(active)
-        if branch[:8] != self._deref(active):
-            branch[:8] = self._deref(active)
-        branch[branchpos + 8:branchpos + 10] = to_bytes(newpos, 2)
+        mem[branchpos:branchpos + 8] = self._deref(active)
+        if mem[branch:branch + 8] != self._deref(active):
+            mem[branch:branch + 8] = self._deref(active)
+        mem[branchpos + 8:branchpos + 10] = to_bytes(newpos, 2)
         self._delete_from_leaf(leaf, leafpos)
         return self._add_to_leaf(toadd, branch, branchpos, active, newpos, depth)
 
-    # returns INVALIDATING, DONE, FULL
+    # returns INVALIDATING, DONE, FULL, UNCHANGED
     def _add_to_leaf_inner(self, toadd, leaf, pos, depth):
+        mem = self.arena.memory
         assert pos >= 0
-        rpos = pos * 70 + 4
+        rpos = leaf + pos * 78 + 4
         if get_bit(toadd, depth) == 0:
-            t = leaf[rpos:rpos + 1]
+            t = mem[rpos:rpos + 1]
             if t == EMPTY:
-                leaf[rpos:rpos + 1] = TERMINAL
-                leaf[rpos + 1:rpos + 33] = toadd
+                mem[rpos:rpos + 1] = TERMINAL
+                mem[rpos + 1:rpos + 33] = toadd
                 return INVALIDATING
             elif t == TERMINAL:
-                oldval0 = leaf[rpos + 1:rpos + 33]
+                oldval0 = mem[rpos + 1:rpos + 33]
                 if oldval0 == toadd:
-                    return DONE
-                t1 = leaf[rpos + 33:rpos + 34]
+                    return UNCHANGED
+                t1 = mem[rpos + 33:rpos + 34]
                 if t1 == TERMINAL:
-                    oldval1 = leaf[rpos + 34:rpos + 66]
+                    oldval1 = mem[rpos + 34:rpos + 66]
                     if toadd == oldval1:
-                        return DONE
-                    nextpos = from_bytes(leaf[:2])
-                    leaf[:2] = to_bytes(pos, 2)
-                    leaf[rpos + 2:rpos + 66] = bytes(64)
-                    leaf[rpos:rpos + 2] = to_bytes(nextpos, 2)
+                        return UNCHANGED
+                    nextpos = from_bytes(mem[leaf:leaf + 2])
+                    mem[leaf:leaf + 2] = to_bytes(pos, 2)
+                    mem[rpos + 2:rpos + 66] = bytes(64)
+                    mem[rpos:rpos + 2] = to_bytes(nextpos, 2)
                     r, nextnextpos = self._insert_leaf([toadd, oldval0, oldval1], leaf, depth)
                     if r == FULL:
-                        leaf[:2] = to_bytes(nextpos, 2)
-                        leaf[rpos:rpos + 1] = TERMINAL
-                        leaf[rpos + 1:rpos + 33] = oldval0
-                        leaf[rpos + 33:rpos + 34] = TERMINAL
-                        leaf[rpos + 34:rpos + 66] = oldval1
+                        mem[leaf:leaf + 2] = to_bytes(nextpos, 2)
+                        mem[rpos:rpos + 1] = TERMINAL
+                        mem[rpos + 1:rpos + 33] = oldval0
+                        mem[rpos + 33:rpos + 34] = TERMINAL
+                        mem[rpos + 34:rpos + 66] = oldval1
                         return FULL
                     assert nextnextpos == pos
                     return INVALIDATING
                 r, newpos = self._insert_leaf([toadd, oldval0], leaf, depth + 1)
                 if r == FULL:
                     return FULL
-                leaf[rpos + 66:rpos + 68] = to_bytes(newpos + 1, 2)
-                leaf[rpos:rpos + 1] = LAZY
+                mem[rpos + 66:rpos + 68] = to_bytes(newpos + 1, 2)
+                mem[rpos:rpos + 1] = LAZY
+                self._recount((leaf, rpos, None), 0)
                 if t1 == LAZY:
                     return DONE
                 return INVALIDATING
             else:
-                r = self._add_to_leaf_inner(toadd, leaf, from_bytes(leaf[rpos + 66:rpos + 68]) - 1, depth + 1)
+                r = self._add_to_leaf_inner(toadd, leaf, from_bytes(mem[rpos + 66:rpos + 68]) - 1, depth + 1)
+                if r == INVALIDATING or r == DONE:
+                    _add_count(mem, rpos + 70, 1)
                 if r == INVALIDATING:
                     if t == MIDDLE:
-                        leaf[rpos:rpos + 1] = LAZY
+                        mem[rpos:rpos + 1] = LAZY
                         return INVALIDATING
                     return DONE
                 return r
         else:
-            t = leaf[rpos + 33:rpos + 34]
+            t = mem[rpos + 33:rpos + 34]
             if t == EMPTY:
-                leaf[rpos + 33:rpos + 34] = TERMINAL
-                leaf[rpos + 34:rpos + 66] = toadd
+                mem[rpos + 33:rpos + 34] = TERMINAL
+                mem[rpos + 34:rpos + 66] = toadd
                 return INVALIDATING
             elif t == TERMINAL:
-                oldval1 = leaf[rpos + 34:rpos + 66]
+                oldval1 = mem[rpos + 34:rpos + 66]
                 if oldval1 == toadd:
-                    return DONE
-                t0 = leaf[rpos:rpos + 1]
+                    return UNCHANGED
+                t0 = mem[rpos:rpos + 1]
                 if t0 == TERMINAL:
-                    oldval0 = leaf[rpos + 1:rpos + 33]
+                    oldval0 = mem[rpos + 1:rpos + 33]
                     if toadd == oldval0:
-                        return DONE
-                    nextpos = from_bytes(leaf[:2])
-                    leaf[:2] = to_bytes(pos, 2)
-                    leaf[rpos + 2:rpos + 66] = bytes(64)
-                    leaf[rpos:rpos + 2] = to_bytes(nextpos, 2)
+                        return UNCHANGED
+                    nextpos = from_bytes(mem[leaf:leaf + 2])
+                    mem[leaf:leaf + 2] = to_bytes(pos, 2)
+                    mem[rpos + 2:rpos + 66] = bytes(64)
+                    mem[rpos:rpos + 2] = to_bytes(nextpos, 2)
                     r, nextnextpos = self._insert_leaf([toadd, oldval0, oldval1], leaf, depth)
                     if r == FULL:
-                        leaf[:2] = to_bytes(nextpos, 2)
-                        leaf[rpos:rpos + 1] = TERMINAL
-                        leaf[rpos + 1:rpos + 33] = oldval0
-                        leaf[rpos + 33:rpos + 34] = TERMINAL
-                        leaf[rpos + 34:rpos + 66] = oldval1
+                        mem[leaf:leaf + 2] = to_bytes(nextpos, 2)
+                        mem[rpos:rpos + 1] = TERMINAL
+                        mem[rpos + 1:rpos + 33] = oldval0
+                        mem[rpos + 33:rpos + 34] = TERMINAL
+                        mem[rpos + 34:rpos + 66] = oldval1
                         return FULL
                     assert nextnextpos == pos
                     return INVALIDATING
                 r, newpos = self._insert_leaf([toadd, oldval1], leaf, depth + 1)
                 if r == FULL:
                     return FULL
-                leaf[rpos + 68:rpos + 70] = to_bytes(newpos + 1, 2)
-                leaf[rpos + 33:rpos + 34] = LAZY
+                mem[rpos + 68:rpos + 70] = to_bytes(newpos + 1, 2)
+                mem[rpos + 33:rpos + 34] = LAZY
+                self._recount((leaf, rpos, None), 1)
                 if t0 == LAZY:
                     return DONE
                 return INVALIDATING
             else:
-                r = self._add_to_leaf_inner(toadd, leaf, from_bytes(leaf[rpos + 68:rpos + 70]) - 1, depth + 1)
+                r = self._add_to_leaf_inner(toadd, leaf, from_bytes(mem[rpos + 68:rpos + 70]) - 1, depth + 1)
+                if r == INVALIDATING or r == DONE:
+                    _add_count(mem, rpos + 74, 1)
                 if r == INVALIDATING:
                     if t == MIDDLE:
-                        leaf[rpos + 33:rpos + 34] = LAZY
+                        mem[rpos + 33:rpos + 34] = LAZY
                         return INVALIDATING
                     return DONE
                 return r
@@ -602,145 +2056,707 @@ class MerkleSet:
     # returns state, newpos
     # state can be FULL, DONE
     def _copy_between_leafs(self, fromleaf, toleaf, frompos):
+        mem = self.arena.memory
         r, pos = self._copy_between_leafs_inner(fromleaf, toleaf, frompos)
         if r == DONE:
-            toleaf[2:4] = to_bytes(from_bytes(toleaf[2:4]) + 1, 2)
-            fromleaf[2:4] = to_bytes(from_bytes(fromleaf[2:4]) - 1, 2)
+            mem[toleaf + 2:toleaf + 4] = to_bytes(from_bytes(mem[toleaf + 2:toleaf + 4]) + 1, 2)
+            mem[fromleaf + 2:fromleaf + 4] = to_bytes(from_bytes(mem[fromleaf + 2:fromleaf + 4]) - 1, 2)
         return r, pos
 
     # returns state, newpos
     # state can be FULL, DONE
     def _copy_between_leafs_inner(self, fromleaf, toleaf, frompos):
-        topos = from_bytes(toleaf[:2])
+        mem = self.arena.memory
+        topos = from_bytes(mem[toleaf:toleaf + 2])
         if topos == 0xFFFF:
             return FULL, None
-        rfrompos = 4 + frompos * 70
-        rtopos = 4 + topos * 70
-        toleaf[0:2] = toleaf[rtopos:rtopos + 2]
-        t0 = fromleaf[rfrompos:rfrompos + 1]
+        rfrompos = fromleaf + 4 + frompos * 78
+        rtopos = toleaf + 4 + topos * 78
+        mem[toleaf:toleaf + 2] = mem[rtopos:rtopos + 2]
+        t0 = mem[rfrompos:rfrompos + 1]
         lowpos = None
         highpos = None
         if t0 == MIDDLE or t0 == LAZY:
-            r, lowpos = self._copy_between_leafs_inner(fromleaf, toleaf, from_bytes(fromleaf[rfrompos + 66:rfrompos + 68]) - 1)
+            r, lowpos = self._copy_between_leafs_inner(fromleaf, toleaf, from_bytes(mem[rfrompos + 66:rfrompos + 68]) - 1)
             if r == FULL:
-                assert toleaf[:2] == toleaf[rtopos:rtopos + 2]
-                toleaf[:2] = to_bytes(topos, 2)
+                assert mem[toleaf:toleaf + 2] == mem[rtopos:rtopos + 2]
+                mem[toleaf:toleaf + 2] = to_bytes(topos, 2)
                 return FULL, None
-        t1 = fromleaf[rfrompos + 33:rfrompos + 34]
+        t1 = mem[rfrompos + 33:rfrompos + 34]
         if t1 == MIDDLE or t1 == LAZY:
-            r, highpos = self._copy_between_leafs_inner(fromleaf, toleaf, from_bytes(fromleaf[rfrompos + 68:rfrompos + 70]) - 1)
+            r, highpos = self._copy_between_leafs_inner(fromleaf, toleaf, from_bytes(mem[rfrompos + 68:rfrompos + 70]) - 1)
             if r == FULL:
                 if t0 == MIDDLE or t0 == LAZY:
                     self._delete_from_leaf(toleaf, lowpos)
-                assert toleaf[:2] == toleaf[rtopos:rtopos + 2]
-                toleaf[:2] = to_bytes(topos, 2)
+                assert mem[toleaf:toleaf + 2] == mem[rtopos:rtopos + 2]
+                mem[toleaf:toleaf + 2] = to_bytes(topos, 2)
                 return FULL, None
-        toleaf[rtopos:rtopos + 66] = fromleaf[rfrompos:rfrompos + 66]
+        mem[rtopos:rtopos + 66] = mem[rfrompos:rfrompos + 66]
+        mem[rtopos + 70:rtopos + 78] = mem[rfrompos + 70:rfrompos + 78]
         if lowpos is not None:
-            toleaf[rtopos + 66:rtopos + 68] = to_bytes(lowpos + 1, 2)
+            mem[rtopos + 66:rtopos + 68] = to_bytes(lowpos + 1, 2)
         if highpos is not None:
-            toleaf[rtopos + 68:rtopos + 70] = to_bytes(highpos + 1, 2)
+            mem[rtopos + 68:rtopos + 70] = to_bytes(highpos + 1, 2)
         return DONE, topos
 
     def _delete_from_leaf(self, leaf, pos):
+        mem = self.arena.memory
         assert pos >= 0
-        rpos = 4 + pos * 70
-        t = leaf[rpos:rpos + 1]
+        rpos = leaf + 4 + pos * 78
+        t = mem[rpos:rpos + 1]
         if t == MIDDLE or t == LAZY:
-            self._delete_from_leaf(leaf, from_bytes(leaf[rpos + 66:rpos + 68]) - 1)
-        t = leaf[rpos + 33:rpos + 34]
+            self._delete_from_leaf(leaf, from_bytes(mem[rpos + 66:rpos + 68]) - 1)
+        t = mem[rpos + 33:rpos + 34]
         if t == MIDDLE or t == LAZY:
-            self._delete_from_leaf(leaf, from_bytes(leaf[rpos + 68:rpos + 70]) - 1)
-        leaf[rpos + 2:rpos + 70] = bytes(68)
-        leaf[rpos:rpos + 2] = leaf[:2]
-        leaf[:2] = to_bytes(pos, 2)
+            self._delete_from_leaf(leaf, from_bytes(mem[rpos + 68:rpos + 70]) - 1)
+        mem[rpos + 2:rpos + 78] = bytes(76)
+        mem[rpos:rpos + 2] = mem[leaf:leaf + 2]
+        mem[leaf:leaf + 2] = to_bytes(pos, 2)
+
+    def _copy_leaf_to_branch(self, branch, branchpos, moddepth, leaf, leafpos):
+        mem = self.arena.memory
+        assert leafpos >= 0
+        rleafpos = leaf + 4 + leafpos * 78
+        if moddepth == 0:
+            active = self._ref(mem[branch:branch + 8])
+            if active is None:
+                active = self._allocate_leaf()
+                mem[branch:branch + 8] = self._deref(active)
+            r, newpos = self._copy_between_leafs_inner(leaf, active, leafpos)
+            assert r == DONE
+            mem[active + 2:active + 4] = to_bytes(from_bytes(mem[active + 2:active + 4]) + 1, 2)
+            mem[branchpos:branchpos + 8] = self._deref(active)
+            mem[branchpos + 8:branchpos + 10] = to_bytes(newpos, 2)
+            return
+        mem[branchpos:branchpos + 66] = mem[rleafpos:rleafpos + 66]
+        mem[branchpos + 66:branchpos + 74] = mem[rleafpos + 70:rleafpos + 78]
+        t = mem[rleafpos:rleafpos + 1]
+        if t == MIDDLE or t == LAZY:
+            self._copy_leaf_to_branch(branch, branchpos + 74, moddepth - 1, leaf, from_bytes(mem[rleafpos + 66:rleafpos + 68]) - 1)
+        t = mem[rleafpos + 33:rleafpos + 34]
+        if t == MIDDLE or t == LAZY:
+            self._copy_leaf_to_branch(branch, branchpos + 74 + self.subblock_lengths[moddepth - 1], moddepth - 1, leaf, from_bytes(mem[rleafpos + 68:rleafpos + 70]) - 1)
+
+    # returns (status, pos)
+    # status can be INVALIDATING, FULL
+    def _insert_leaf(self, things, leaf, depth):
+        mem = self.arena.memory
+        assert 2 <= len(things) <= 3
+        pos = from_bytes(mem[leaf:leaf + 2])
+        if pos == 0xFFFF:
+            return FULL, None
+        lpos = leaf + pos * 78 + 4
+        mem[leaf:leaf + 2] = mem[lpos:lpos + 2]
+        things.sort()
+        if len(things) == 2:
+            mem[lpos:lpos + 1] = TERMINAL
+            mem[lpos + 1:lpos + 33] = things[0]
+            mem[lpos + 33:lpos + 34] = TERMINAL
+            mem[lpos + 34:lpos + 66] = things[1]
+            return INVALIDATING, pos
+        bits = [get_bit(thing, depth) for thing in things]
+        if bits[0] == bits[1] == bits[2]:
+            r, laterpos = self._insert_leaf(things, leaf, depth + 1)
+            if r == FULL:
+                mem[leaf:leaf + 2] = to_bytes(pos, 2)
+                return FULL, None
+            if bits[0] == 0:
+                mem[lpos + 66:lpos + 68] = to_bytes(laterpos + 1, 2)
+                mem[lpos:lpos + 1] = LAZY
+            else:
+                mem[lpos + 68:lpos + 70] = to_bytes(laterpos + 1, 2)
+                mem[lpos + 33:lpos + 34] = LAZY
+                mem[lpos:lpos + 2] = bytes(2)
+            self._recount_node((leaf, lpos, None))
+            return INVALIDATING, pos
+        elif bits[0] == bits[1]:
+            r, laterpos = self._insert_leaf([things[0], things[1]], leaf, depth + 1)
+            if r == FULL:
+                mem[leaf:leaf + 2] = to_bytes(pos, 2)
+                return FULL, None
+            mem[lpos + 34:lpos + 66] = things[2]
+            mem[lpos + 33:lpos + 34] = TERMINAL
+            mem[lpos + 66:lpos + 68] = to_bytes(laterpos + 1, 2)
+            mem[lpos:lpos + 1] = LAZY
+        else:
+            r, laterpos = self._insert_leaf([things[1], things[2]], leaf, depth + 1)
+            if r == FULL:
+                mem[leaf:leaf + 2] = to_bytes(pos, 2)
+                return FULL, None
+            mem[lpos + 1:lpos + 33] = things[0]
+            mem[lpos:lpos + 1] = TERMINAL
+            mem[lpos + 68:lpos + 70] = to_bytes(laterpos + 1, 2)
+            mem[lpos + 33:lpos + 34] = LAZY
+        self._recount_node((leaf, lpos, None))
+        return INVALIDATING, pos
+
+    def add_many_already_hashed(self, toadds):
+        toadds = sorted(set(bytes(x) for x in toadds))
+        t = self.root[:1]
+        if t == TERMINAL and toadds == [self.root[1:]]:
+            return
+        # checked is whether none of toadds are there yet, see _costly
+        checked = False
+        if (t == MIDDLE or t == LAZY) and len(toadds) > 0 and (self.hashing is not None or self._costly(self.rootblock)):
+            toadds = self._absent(toadds, self.rootblock + 8, 0, len(self.subblock_lengths) - 1)
+            checked = True
+        if len(toadds) == 0:
+            return
+        self.arena.modifying()
+        self._writable_root()
+        if t == EMPTY or t == TERMINAL:
+            if t == TERMINAL:
+                toadds = sorted(set(toadds + [bytes(self.root[1:])]))
+            if len(toadds) == 1:
+                self.root[:] = TERMINAL + toadds[0]
+                return
+            self.rootblock = self._allocate_branch()
+            self._insert_branch_many(toadds, self.rootblock, self.rootblock + 8, 0, len(self.subblock_lengths) - 1)
+            self.root[:1] = LAZY
+        elif self._add_many_to_branch(toadds, self.rootblock, 0, checked) == INVALIDATING:
+            self.root[:1] = LAZY
+
+    # returns the ones of things which aren't below pos, see _contains_many_branch
+    def _absent(self, things, pos, depth, moddepth):
+        found = set()
+        self._contains_many_branch(things, pos, depth, moddepth, found)
+        return [x for x in things if x not in found]
+
+    # returns INVALIDATING, DONE
+    def _add_many_to_branch(self, toadds, block, depth, checked = False):
+        return self._add_many_to_branch_inner(toadds, block, block + 8, depth, len(self.subblock_lengths) - 1, checked)
+
+    # toadds must be sorted and all belong under this position, which must be in use
+    # returns INVALIDATING, DONE
+    def _add_many_to_branch_inner(self, toadds, block, pos, depth, moddepth, checked = False):
+        mem = self.arena.memory
+        if moddepth == 0:
+            child = self._ref(mem[pos:pos + 8])
+            if not checked and self._costly(child):
+                toadds = self._absent(toadds, pos, depth, 0)
+                if len(toadds) == 0:
+                    return DONE
+                checked = True
+            nextblock = self._writable(block, child)
+            nextpos = from_bytes(mem[pos + 8:pos + 10])
+            if nextpos == 0xFFFF:
+                return self._add_many_to_branch(toadds, nextblock, depth, checked)
+            return self._add_many_to_leaf(toadds, block, pos, nextblock, nextpos, depth)
+        t0 = mem[pos:pos + 1]
+        t1 = mem[pos + 33:pos + 34]
+        if t0 == TERMINAL and t1 == TERMINAL:
+            things = sorted(set(toadds + [bytes(mem[pos + 1:pos + 33]), bytes(mem[pos + 34:pos + 66])]))
+            if len(things) == 2:
+                return DONE
+            mem[pos:pos + 74] = bytes(74)
+            self._insert_branch_many(things, block, pos, depth, moddepth)
+            return INVALIDATING
+        split = _split(toadds, depth)
+        changed0 = self._add_many_to_branch_side(toadds[:split], block, pos, pos + 74, depth + 1, moddepth - 1, checked)
+        changed1 = self._add_many_to_branch_side(toadds[split:], block, pos + 33, 
+                pos + 74 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1, checked)
+        self._recount_node((block, pos, moddepth))
+        if (changed0 or changed1) and t0 != LAZY and t1 != LAZY:
+            return INVALIDATING
+        return DONE
+
+    # tpos is the position of the type of the child, childpos is where its contents go
+    # returns whether the child changed
+    def _add_many_to_branch_side(self, toadds, block, tpos, childpos, depth, moddepth, checked = False):
+        mem = self.arena.memory
+        if len(toadds) == 0:
+            return False
+        t = mem[tpos:tpos + 1]
+        if t == MIDDLE or t == LAZY:
+            if self._add_many_to_branch_inner(toadds, block, childpos, depth, moddepth, checked) == INVALIDATING:
+                mem[tpos:tpos + 1] = LAZY
+                return True
+            return False
+        things = toadds
+        if t == TERMINAL:
+            things = sorted(set(toadds + [bytes(mem[tpos + 1:tpos + 33])]))
+            if len(things) == 1:
+                return False
+        if len(things) == 1:
+            mem[tpos:tpos + 1] = TERMINAL
+            mem[tpos + 1:tpos + 33] = things[0]
+            return True
+        self._insert_branch_many(things, block, childpos, depth, moddepth)
+        mem[tpos:tpos + 1] = LAZY
+        return True
+
+    # Like _insert_branch but for any number of sorted distinct things
+    def _insert_branch_many(self, things, block, pos, depth, moddepth):
+        mem = self.arena.memory
+        assert len(things) >= 2
+        if moddepth == 0:
+            needed = _nodes_needed(things, depth)
+            child = self._writable(block, self._ref(mem[block:block + 8]))
+            if child is None or self._leaf_free_count(child) < needed:
+                if needed > self.leaf_units:
+                    newb = self._allocate_branch()
+                    mem[pos:pos + 8] = self._deref(newb)
+                    mem[pos + 8:pos + 10] = to_bytes(0xFFFF, 2)
+                    self._insert_branch_many(things, newb, newb + 8, depth, len(self.subblock_lengths) - 1)
+                    return
+                child = self._allocate_leaf()
+                mem[block:block + 8] = self._deref(child)
+            leafpos = self._insert_leaf_many(things, child, depth)
+            # increment the number of inputs in the active child
+            mem[child + 2:child + 4] = to_bytes(from_bytes(mem[child + 2:child + 4]) + 1, 2)
+            mem[pos:pos + 8] = self._deref(child)
+            mem[pos + 8:pos + 10] = to_bytes(leafpos, 2)
+            return
+        if len(things) == 2:
+            mem[pos:pos + 1] = TERMINAL
+            mem[pos + 1:pos + 33] = things[0]
+            mem[pos + 33:pos + 34] = TERMINAL
+            mem[pos + 34:pos + 66] = things[1]
+            return
+        split = _split(things, depth)
+        if split == 1:
+            mem[pos:pos + 1] = TERMINAL
+            mem[pos + 1:pos + 33] = things[0]
+        elif split > 1:
+            self._insert_branch_many(things[:split], block, pos + 74, depth + 1, moddepth - 1)
+            mem[pos:pos + 1] = LAZY
+        if len(things) - split == 1:
+            mem[pos + 33:pos + 34] = TERMINAL
+            mem[pos + 34:pos + 66] = things[-1]
+        elif len(things) - split > 1:
+            self._insert_branch_many(things[split:], block, pos + 74 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1)
+            mem[pos + 33:pos + 34] = LAZY
+        self._recount_node((block, pos, moddepth))
+
+    # returns INVALIDATING, DONE
+    def _add_many_to_leaf(self, toadds, branch, branchpos, leaf, leafpos, depth):
+        mem = self.arena.memory
+        hashes = []
+        numnodes = self._leaf_contents(leaf, leafpos, hashes)
+        needed = _nodes_needed(sorted(set(toadds + hashes)), depth) - numnodes
+        if needed <= self._leaf_free_count(leaf):
+            return self._add_many_to_leaf_inner(toadds, leaf, leafpos, depth)
+        if from_bytes(mem[leaf + 2:leaf + 4]) == 1:
+            # leaf doesn't have room and only has one input
+            # it cannot be split so it must be replaced with a branch
+            newb = self._allocate_branch()
+            self._copy_leaf_to_branch(newb, newb + 8, len(self.subblock_lengths) - 1, leaf, leafpos)
+            self._add_many_to_branch(toadds, newb, depth)
+            mem[branchpos:branchpos + 8] = self._deref(newb)
+            mem[branchpos + 8:branchpos + 10] = to_bytes(0xFFFF, 2)
+            if mem[branch:branch + 8] == self._deref(leaf):
+                mem[branch:branch + 8] = bytes(8)
+            self._deallocate(leaf)
+            return INVALIDATING
+        active = self._writable(branch, self._ref(mem[branch:branch + 8]))
+        if active is None or active == leaf:
+            active = self._allocate_leaf()
+        r, newpos = self._copy_between_leafs(leaf, active, leafpos)
+        if r != DONE:
+            active = self._allocate_leaf()
+            r, newpos = self._copy_between_leafs(leaf, active, leafpos)
+            assert r == DONE
+        mem[branchpos:branchpos + 8] = self._deref(active)
+        if mem[branch:branch + 8] != self._deref(active):
+            mem[branch:branch + 8] = self._deref(active)
+        mem[branchpos + 8:branchpos + 10] = to_bytes(newpos, 2)
+        self._delete_from_leaf(leaf, leafpos)
+        return self._add_many_to_leaf(toadds, branch, branchpos, active, newpos, depth)
+
+    # the caller must make sure the leaf has enough room
+    # returns INVALIDATING, DONE
+    def _add_many_to_leaf_inner(self, toadds, leaf, pos, depth):
+        mem = self.arena.memory
+        assert pos >= 0
+        rpos = leaf + 4 + pos * 78
+        t0 = mem[rpos:rpos + 1]
+        t1 = mem[rpos + 33:rpos + 34]
+        if t0 == TERMINAL and t1 == TERMINAL:
+            things = sorted(set(toadds + [bytes(mem[rpos + 1:rpos + 33]), bytes(mem[rpos + 34:rpos + 66])]))
+            if len(things) == 2:
+                return DONE
+            self._deallocate_leaf_node(leaf, pos)
+            newpos = self._insert_leaf_many(things, leaf, depth)
+            assert newpos == pos
+            return INVALIDATING
+        split = _split(toadds, depth)
+        changed0 = self._add_many_to_leaf_side(toadds[:split], leaf, rpos, rpos + 66, depth + 1)
+        changed1 = self._add_many_to_leaf_side(toadds[split:], leaf, rpos + 33, rpos + 68, depth + 1)
+        self._recount_node((leaf, rpos, None))
+        if (changed0 or changed1) and t0 != LAZY and t1 != LAZY:
+            return INVALIDATING
+        return DONE
+
+    # tpos is the position of the type of the child, ppos is the position of its pointer
+    # returns whether the child changed
+    def _add_many_to_leaf_side(self, toadds, leaf, tpos, ppos, depth):
+        mem = self.arena.memory
+        if len(toadds) == 0:
+            return False
+        t = mem[tpos:tpos + 1]
+        if t == MIDDLE or t == LAZY:
+            if self._add_many_to_leaf_inner(toadds, leaf, from_bytes(mem[ppos:ppos + 2]) - 1, depth) == INVALIDATING:
+                mem[tpos:tpos + 1] = LAZY
+                return True
+            return False
+        things = toadds
+        if t == TERMINAL:
+            things = sorted(set(toadds + [bytes(mem[tpos + 1:tpos + 33])]))
+            if len(things) == 1:
+                return False
+        if len(things) == 1:
+            mem[tpos:tpos + 1] = TERMINAL
+            mem[tpos + 1:tpos + 33] = things[0]
+            return True
+        newpos = self._insert_leaf_many(things, leaf, depth)
+        mem[ppos:ppos + 2] = to_bytes(newpos + 1, 2)
+        mem[tpos:tpos + 1] = LAZY
+        return True
+
+    # Like _insert_leaf but for any number of sorted distinct things
+    # the caller must make sure the leaf has enough room
+    # returns pos
+    def _insert_leaf_many(self, things, leaf, depth):
+        mem = self.arena.memory
+        assert len(things) >= 2
+        pos = from_bytes(mem[leaf:leaf + 2])
+        assert pos != 0xFFFF
+        lpos = leaf + pos * 78 + 4
+        mem[leaf:leaf + 2] = mem[lpos:lpos + 2]
+        mem[lpos:lpos + 2] = bytes(2)
+        if len(things) == 2:
+            mem[lpos:lpos + 1] = TERMINAL
+            mem[lpos + 1:lpos + 33] = things[0]
+            mem[lpos + 33:lpos + 34] = TERMINAL
+            mem[lpos + 34:lpos + 66] = things[1]
+            return pos
+        split = _split(things, depth)
+        if split == 1:
+            mem[lpos:lpos + 1] = TERMINAL
+            mem[lpos + 1:lpos + 33] = things[0]
+        elif split > 1:
+            laterpos = self._insert_leaf_many(things[:split], leaf, depth + 1)
+            mem[lpos + 66:lpos + 68] = to_bytes(laterpos + 1, 2)
+            mem[lpos:lpos + 1] = LAZY
+        if len(things) - split == 1:
+            mem[lpos + 33:lpos + 34] = TERMINAL
+            mem[lpos + 34:lpos + 66] = things[-1]
+        elif len(things) - split > 1:
+            laterpos = self._insert_leaf_many(things[split:], leaf, depth + 1)
+            mem[lpos + 68:lpos + 70] = to_bytes(laterpos + 1, 2)
+            mem[lpos + 33:lpos + 34] = LAZY
+        self._recount_node((leaf, lpos, None))
+        return pos
+
+    def _leaf_free_count(self, leaf):
+        mem = self.arena.memory
+        count = 0
+        i = from_bytes(mem[leaf:leaf + 2])
+        while i != 0xFFFF:
+            count += 1
+            i = from_bytes(mem[leaf + 4 + i * 78:leaf + 4 + i * 78 + 2])
+        return count
+
+    # appends the hashes below pos to hashes, returns the number of nodes they use
+    def _leaf_contents(self, leaf, pos, hashes):
+        mem = self.arena.memory
+        assert pos >= 0
+        rpos = leaf + 4 + pos * 78
+        count = 1
+        t0 = mem[rpos:rpos + 1]
+        t1 = mem[rpos + 33:rpos + 34]
+        if t0 == TERMINAL:
+            hashes.append(bytes(mem[rpos + 1:rpos + 33]))
+        elif t0 != EMPTY:
+            count += self._leaf_contents(leaf, from_bytes(mem[rpos + 66:rpos + 68]) - 1, hashes)
+        if t1 == TERMINAL:
+            hashes.append(bytes(mem[rpos + 34:rpos + 66]))
+        elif t1 != EMPTY:
+            count += self._leaf_contents(leaf, from_bytes(mem[rpos + 68:rpos + 70]) - 1, hashes)
+        return count
+
+    # hashes must be in sorted order, it can be a generator
+    @classmethod
+    def from_sorted_hashes(cls, hashes, depth, leaf_units, hasher = default_hasher):
+        mset = cls(depth, leaf_units, hasher = hasher)
+        stream = _SortedStream(hashes)
+        first = stream.peek(0)
+        if first is None:
+            return mset
+        if stream.peek(1) is None:
+            mset.root[:] = TERMINAL + first
+            return mset
+        mset.rootblock = mset._allocate_branch()
+        mset._build_branch(stream, mset.rootblock, mset.rootblock + 8, 0, len(mset.subblock_lengths) - 1)
+        mset.root[:1] = LAZY
+        return mset
+
+    # Makes a set out of what dump wrote, building it in one pass as it's read
+    # Raises SetError if the file is damaged or doesn't match its root
+    @classmethod
+    def load(cls, fileobj, depth, leaf_units, hasher = default_hasher):
+        if fileobj.read(8) != DUMP_MAGIC:
+            raise SetError()
+        hashes = _read_chunks(fileobj)
+        mset = cls.from_sorted_hashes(hashes, depth, leaf_units, hasher)
+        if next(hashes, None) is not None:
+            raise SetError()
+        trailer = fileobj.read(1)
+        if trailer == bytes([1]):
+            if fileobj.read(32) != mset.get_root():
+                raise SetError()
+        elif trailer != bytes([0]):
+            raise SetError()
+        return mset
+
+    # Takes everything off the front of the stream which shares its first depth bits with 
+    # the first one, there must be at least two of them
+    def _build_branch(self, stream, block, pos, depth, moddepth):
+        mem = self.arena.memory
+        ref = stream.peek(0)
+        if moddepth == 0:
+            # every node in a leaf has at most two things so this is enough to tell if they fit
+            num = stream.count(ref, depth, self.leaf_units + 2)
+            if num <= self.leaf_units + 1:
+                self._insert_branch_many([stream.next() for i in range(num)], block, pos, depth, 0)
+                return
+            newb = self._allocate_branch()
+            mem[pos:pos + 8] = self._deref(newb)
+            mem[pos + 8:pos + 10] = to_bytes(0xFFFF, 2)
+            self._build_branch(stream, newb, newb + 8, depth, len(self.subblock_lengths) - 1)
+            return
+        if stream.count(ref, depth, 3) == 2:
+            mem[pos:pos + 1] = TERMINAL
+            mem[pos + 1:pos + 33] = stream.next()
+            mem[pos + 33:pos + 34] = TERMINAL
+            mem[pos + 34:pos + 66] = stream.next()
+            return
+        num0 = 0
+        if get_bit(ref, depth) == 0:
+            num0 = stream.count(ref, depth + 1, 2)
+        if num0 == 1:
+            mem[pos:pos + 1] = TERMINAL
+            mem[pos + 1:pos + 33] = stream.next()
+        elif num0 == 2:
+            self._build_branch(stream, block, pos + 74, depth + 1, moddepth - 1)
+            mem[pos:pos + 1] = LAZY
+        num1 = 0
+        ref1 = stream.peek(0)
+        if ref1 is not None and _same_prefix(ref, ref1, depth):
+            num1 = stream.count(ref1, depth + 1, 2)
+        if num1 == 1:
+            mem[pos + 33:pos + 34] = TERMINAL
+            mem[pos + 34:pos + 66] = stream.next()
+        elif num1 == 2:
+            self._build_branch(stream, block, pos + 74 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1)
+            mem[pos + 33:pos + 34] = LAZY
+        self._recount_node((block, pos, moddepth))
+
+    # Adds everything in other, which can be another set or a Snapshot made with the same hasher
+    # Wherever only other has something its nodes are copied over with their hashes and counts,
+    # and subtrees which are the same in both are skipped, so it only descends where both have
+    # things which differ
+    # Raises SetError if other uses a different hasher, since its hashes couldn't be reused
+    def update(self, other):
+        if other.hasher != self.hasher:
+            raise SetError()
+        other.get_root()
+        ot = other.root[:1]
+        if ot == EMPTY:
+            return
+        if ot == TERMINAL:
+            self.add_already_hashed(bytes(other.root[1:]))
+            return
+        self.arena.modifying()
+        self._writable_root()
+        src = other._resolve(other.rootblock, other.rootblock + 8, len(other.subblock_lengths) - 1)
+        t = self.root[:1]
+        if t == EMPTY or t == TERMINAL:
+            old = bytes(self.root[1:])
+            self.rootblock = self._allocate_branch()
+            self._graft_branch(other, src, self.rootblock, self.rootblock + 8, 0, len(self.subblock_lengths) - 1)
+            self.root[:] = other.root
+            if t == TERMINAL and self._add_many_to_branch([old], self.rootblock, 0) == INVALIDATING:
+                self.root[:1] = LAZY
+            return
+        if self.root == other.root:
+            return
+        if self._update_branch_inner(other, src, self.rootblock, self.rootblock + 8, 0, len(self.subblock_lengths) - 1) == INVALIDATING:
+            self.root[:1] = LAZY
+
+    # src is the node in other in the same place as pos, both have at least two things below them
+    # returns INVALIDATING, DONE
+    def _update_branch_inner(self, other, src, block, pos, depth, moddepth):
+        mem = self.arena.memory
+        omem = other.arena.memory
+        if moddepth == 0:
+            nextblock = self._writable(block, self._ref(mem[pos:pos + 8]))
+            nextpos = from_bytes(mem[pos + 8:pos + 10])
+            if nextpos == 0xFFFF:
+                return self._update_branch_inner(other, src, nextblock, nextblock + 8, depth, len(self.subblock_lengths) - 1)
+            return self._update_leaf(other, src, block, pos, nextblock, nextpos, depth)
+        spos = src[1]
+        if omem[spos:spos + 1] == TERMINAL and omem[spos + 33:spos + 34] == TERMINAL:
+            return self._add_many_to_branch_inner([bytes(omem[spos + 1:spos + 33]), bytes(omem[spos + 34:spos + 66])],
+                    block, pos, depth, moddepth)
+        t0 = mem[pos:pos + 1]
+        t1 = mem[pos + 33:pos + 34]
+        if t0 == TERMINAL and t1 == TERMINAL:
+            things = [bytes(mem[pos + 1:pos + 33]), bytes(mem[pos + 34:pos + 66])]
+            mem[pos:pos + 74] = bytes(74)
+            self._graft_branch(other, src, block, pos, depth, moddepth)
+            self._add_many_to_branch_inner(things, block, pos, depth, moddepth)
+            return INVALIDATING
+        changed0 = self._update_branch_side(other, src, 0, block, pos, pos + 74, depth + 1, moddepth - 1)
+        changed1 = self._update_branch_side(other, src, 1, block, pos,
+                pos + 74 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1)
+        self._recount_node((block, pos, moddepth))
+        if (changed0 or changed1) and t0 != LAZY and t1 != LAZY:
+            return INVALIDATING
+        return DONE
+
+    # side is which child of the node at pos, childpos is where its contents go
+    # returns whether the child changed
+    def _update_branch_side(self, other, src, side, block, pos, childpos, depth, moddepth):
+        mem = self.arena.memory
+        omem = other.arena.memory
+        tpos = pos + 33 * side
+        stpos = src[1] + 33 * side
+        st = omem[stpos:stpos + 1]
+        if st == EMPTY:
+            return False
+        if st == TERMINAL:
+            return self._add_many_to_branch_side([bytes(omem[stpos + 1:stpos + 33])], block, tpos, childpos, depth, moddepth)
+        t = mem[tpos:tpos + 1]
+        if t == EMPTY or t == TERMINAL:
+            old = bytes(mem[tpos + 1:tpos + 33])
+            self._graft_branch(other, other._child_node(src, side), block, childpos, depth, moddepth)
+            mem[tpos:tpos + 33] = omem[stpos:stpos + 33]
+            mem[pos + 66 + 4 * side:pos + 70 + 4 * side] = omem[src[1] + other._count_offset(src) + 4 * side:src[1] + other._count_offset(src) + 4 * side + 4]
+            if t == TERMINAL:
+                self._add_many_to_branch_side([old], block, tpos, childpos, depth, moddepth)
+            return True
+        if mem[tpos:tpos + 33] == omem[stpos:stpos + 33]:
+            return False
+        if self._update_branch_inner(other, other._child_node(src, side), block, childpos, depth, moddepth) == INVALIDATING:
+            mem[tpos:tpos + 1] = LAZY
+            return True
+        return False
+
+    # Leaves are small so the things in whichever side has fewer are added to the other
+    # returns INVALIDATING, DONE
+    def _update_leaf(self, other, src, branch, branchpos, leaf, leafpos, depth):
+        mem = self.arena.memory
+        if other._node_count(src) <= self.leaf_units + 1:
+            things = []
+            other._node_things(src, things)
+            return self._add_many_to_leaf(things, branch, branchpos, leaf, leafpos, depth)
+        things = []
+        self._leaf_contents(leaf, leafpos, things)
+        self._delete_from_leaf(leaf, leafpos)
+        numin = from_bytes(mem[leaf + 2:leaf + 4])
+        if numin == 1:
+            self._deallocate(leaf)
+            if mem[branch:branch + 8] == self._deref(leaf):
+                mem[branch:branch + 8] = bytes(8)
+        else:
+            mem[leaf + 2:leaf + 4] = to_bytes(numin - 1, 2)
+        mem[branchpos:branchpos + 10] = bytes(10)
+        self._graft_branch(other, src, branch, branchpos, depth, 0)
+        self._add_many_to_branch_inner(things, branch, branchpos, depth, 0)
+        return INVALIDATING
 
-    def _copy_leaf_to_branch(self, branch, branchpos, moddepth, leaf, leafpos):
-        assert leafpos >= 0
-        rleafpos = 4 + leafpos * 70
+    # Copies the node src in other and everything below it to pos, which must be unused
+    # Hashes and counts are copied along with everything else, so src mustn't be LAZY
+    def _graft_branch(self, other, src, block, pos, depth, moddepth):
+        mem = self.arena.memory
+        omem = other.arena.memory
         if moddepth == 0:
-            active = self._ref(branch[:8])
-            if active is None:
-                active = self._allocate_leaf()
-                branch[0:8] = self._deref(active)
-            r, newpos = self._copy_between_leafs_inner(leaf, active, leafpos)
-            assert r == DONE
-            active[2:4] = to_bytes(from_bytes(active[2:4]) + 1, 2)
-            branch[branchpos:branchpos + 8] = self._deref(active)
-            branch[branchpos + 8:branchpos + 10] = to_bytes(newpos, 2)
+            # long chains can need more nodes than there are things
+            needed = None
+            if other._node_count(src) <= self.leaf_units + 1:
+                needed = other._node_size(src)
+            if needed is not None and needed <= self.leaf_units:
+                child = self._writable(block, self._ref(mem[block:block + 8]))
+                if child is None or self._leaf_free_count(child) < needed:
+                    child = self._allocate_leaf()
+                    mem[block:block + 8] = self._deref(child)
+                leafpos = self._graft_leaf(other, src, child)
+                # increment the number of inputs in the active child
+                mem[child + 2:child + 4] = to_bytes(from_bytes(mem[child + 2:child + 4]) + 1, 2)
+                mem[pos:pos + 8] = self._deref(child)
+                mem[pos + 8:pos + 10] = to_bytes(leafpos, 2)
+                return
+            newb = self._allocate_branch()
+            mem[pos:pos + 8] = self._deref(newb)
+            mem[pos + 8:pos + 10] = to_bytes(0xFFFF, 2)
+            self._graft_branch(other, src, newb, newb + 8, depth, len(self.subblock_lengths) - 1)
             return
-        branch[branchpos:branchpos + 66] = leaf[rleafpos:rleafpos + 66]
-        t = leaf[rleafpos:rleafpos + 1]
-        if t == MIDDLE or t == LAZY:
-            self._copy_leaf_to_branch(branch, branchpos + 66, moddepth - 1, leaf, from_bytes(leaf[rleafpos + 66:rleafpos + 68]) - 1)
-        t = leaf[rleafpos + 33:rleafpos + 34]
-        if t == MIDDLE or t == LAZY:
-            self._copy_leaf_to_branch(branch, branchpos + 66 + self.subblock_lengths[moddepth - 1], moddepth - 1, leaf, from_bytes(leaf[rleafpos + 68:rleafpos + 70]) - 1)
+        spos = src[1]
+        countpos = spos + other._count_offset(src)
+        mem[pos:pos + 66] = omem[spos:spos + 66]
+        mem[pos + 66:pos + 74] = omem[countpos:countpos + 8]
+        if omem[spos:spos + 1] == MIDDLE:
+            self._graft_branch(other, other._child_node(src, 0), block, pos + 74, depth + 1, moddepth - 1)
+        if omem[spos + 33:spos + 34] == MIDDLE:
+            self._graft_branch(other, other._child_node(src, 1), block, pos + 74 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1)
 
-    # returns (status, pos)
-    # status can be INVALIDATING, FULL
-    def _insert_leaf(self, things, leaf, depth):
-        assert 2 <= len(things) <= 3
-        pos = from_bytes(leaf[:2])
-        if pos == 0xFFFF:
-            return FULL, None
-        lpos = pos * 70 + 4
-        leaf[:2] = leaf[lpos:lpos + 2]
-        things.sort()
-        if len(things) == 2:
-            leaf[lpos:lpos + 1] = TERMINAL
-            leaf[lpos + 1:lpos + 33] = things[0]
-            leaf[lpos + 33:lpos + 34] = TERMINAL
-            leaf[lpos + 34:lpos + 66] = things[1]
-            return INVALIDATING, pos
-        bits = [get_bit(thing, depth) for thing in things]
-        if bits[0] == bits[1] == bits[2]:
-            r, laterpos = self._insert_leaf(things, leaf, depth + 1)
-            if r == FULL:
-                leaf[:2] = to_bytes(pos, 2)
-                return FULL, None
-            if bits[0] == 0:
-                leaf[lpos + 66:lpos + 68] = to_bytes(laterpos + 1, 2)
-                leaf[lpos:lpos + 1] = LAZY
-            else:
-                leaf[lpos + 68:lpos + 70] = to_bytes(laterpos + 1, 2)
-                leaf[lpos + 33:lpos + 34] = LAZY
-                leaf[lpos:lpos + 2] = bytes(2)
-            return INVALIDATING, pos
-        elif bits[0] == bits[1]:
-            r, laterpos = self._insert_leaf([things[0], things[1]], leaf, depth + 1)
-            if r == FULL:
-                leaf[:2] = to_bytes(pos, 2)
-                return FULL, None
-            leaf[lpos + 34:lpos + 66] = things[2]
-            leaf[lpos + 33:lpos + 34] = TERMINAL
-            leaf[lpos + 66:lpos + 68] = to_bytes(laterpos + 1, 2)
-            leaf[lpos:lpos + 1] = LAZY
-        else:
-            r, laterpos = self._insert_leaf([things[1], things[2]], leaf, depth + 1)
-            if r == FULL:
-                leaf[:2] = to_bytes(pos, 2)
-                return FULL, None
-            leaf[lpos + 1:lpos + 33] = things[0]
-            leaf[lpos:lpos + 1] = TERMINAL
-            leaf[lpos + 68:lpos + 70] = to_bytes(laterpos + 1, 2)
-            leaf[lpos + 33:lpos + 34] = LAZY
-        return INVALIDATING, pos
+    # the caller must make sure the leaf has enough room
+    # returns pos
+    def _graft_leaf(self, other, src, leaf):
+        mem = self.arena.memory
+        omem = other.arena.memory
+        pos = from_bytes(mem[leaf:leaf + 2])
+        assert pos != 0xFFFF
+        lpos = leaf + pos * 78 + 4
+        mem[leaf:leaf + 2] = mem[lpos:lpos + 2]
+        spos = src[1]
+        countpos = spos + other._count_offset(src)
+        mem[lpos:lpos + 66] = omem[spos:spos + 66]
+        mem[lpos + 70:lpos + 78] = omem[countpos:countpos + 8]
+        if omem[spos:spos + 1] == MIDDLE:
+            mem[lpos + 66:lpos + 68] = to_bytes(self._graft_leaf(other, other._child_node(src, 0), leaf) + 1, 2)
+        if omem[spos + 33:spos + 34] == MIDDLE:
+            mem[lpos + 68:lpos + 70] = to_bytes(self._graft_leaf(other, other._child_node(src, 1), leaf) + 1, 2)
+        return pos
+
+    # Sets the count of side of node from the counts of the node below it, which have to be 
+    # right already, everything which rebuilds what's below a node calls this on the way back up
+    # Single adds and removes only ever change counts by one so they use _add_count instead
+    def _recount(self, node, side):
+        mem = self.arena.memory
+        countpos = node[1] + self._count_offset(node) + 4 * side
+        mem[countpos:countpos + 4] = to_bytes(self._node_count(self._child_node(node, side)), 4)
+
+    # Same as _recount on both sides of node where there's anything to count
+    def _recount_node(self, node):
+        mem = self.arena.memory
+        for side in range(2):
+            t = mem[node[1] + 33 * side:node[1] + 33 * side + 1]
+            if t == MIDDLE or t == LAZY:
+                self._recount(node, side)
 
     # Convenience function
     def remove(self, toremove):
-        return self.remove_already_hashed(sha256(toremove).digest())
+        return self.remove_already_hashed(self.hasher.hash_value(toremove))
 
     def remove_already_hashed(self, toremove):
         t = self.root[:1]
-        if t == EMPTY:
+        if t == EMPTY or (t == TERMINAL and toremove != self.root[1:]):
             return
-        elif t == TERMINAL:
-            if toremove == self.root[1:]:
-                self.root[:] = bytes(33)
+        # checked is whether toremove is known to be there, see _costly
+        checked = False
+        if (t == MIDDLE or t == LAZY) and (self.hashing is not None or self._costly(self.rootblock)):
+            if not self._contains_branch(toremove, self.rootblock + 8, 0, len(self.subblock_lengths) - 1):
+                return
+            checked = True
+        self.arena.modifying()
+        self._writable_root()
+        if t == TERMINAL:
+            self.root[:] = bytes(33)
             return
         else:
-            status, oneval = self._remove_branch(toremove, self.rootblock, 0)
+            status, oneval = self._remove_branch(toremove, self.rootblock, 0, checked)
         if status == INVALIDATING:
             self.root[:1] = LAZY
         elif status == ONELEFT:
@@ -748,459 +2764,1128 @@ class MerkleSet:
             self.root[:1] = TERMINAL
             self.rootblock = None
         elif status == FRAGILE:
-            self._catch_branch(self.rootblock, 8, len(self.subblock_lengths) - 1)
+            self._catch_branch(self.rootblock, self.rootblock + 8, len(self.subblock_lengths) - 1)
             self.root[:1] = LAZY
 
     # returns (status, oneval)
-    # status can be ONELEFT, FRAGILE, INVALIDATING, DONE
-    def _remove_branch(self, toremove, block, depth):
-        result, val = self._remove_branch_inner(toremove, block, 8, depth, len(self.subblock_lengths) - 1)
+    # status can be ONELEFT, FRAGILE, INVALIDATING, DONE, UNCHANGED
+    def _remove_branch(self, toremove, block, depth, checked = False):
+        result, val = self._remove_branch_inner(toremove, block, block + 8, depth, len(self.subblock_lengths) - 1, checked)
         assert result != NOTSTARTED
         if result == ONELEFT:
             self._deallocate(block)
         return result, val
 
     # returns (status, oneval)
-    # status can be NOTSTARTED, ONELEFT, FRAGILE, INVALIDATING, DONE
-    def _remove_branch_inner(self, toremove, block, pos, depth, moddepth):
+    # status can be NOTSTARTED, ONELEFT, FRAGILE, INVALIDATING, DONE, UNCHANGED
+    def _remove_branch_inner(self, toremove, block, pos, depth, moddepth, checked = False):
+        mem = self.arena.memory
         if moddepth == 0:
-            if block[pos:pos + 8] == bytes(8):
+            child = self._ref(mem[pos:pos + 8])
+            if child is None:
                 return NOTSTARTED, None
-            p = from_bytes(block[pos + 8:pos + 10])
+            if not checked and self._costly(child):
+                if not self._contains_branch(toremove, pos, depth, 0):
+                    return UNCHANGED, None
+                checked = True
+            p = from_bytes(mem[pos + 8:pos + 10])
             if p == 0xFFFF:
-                r, val = self._remove_branch(toremove, self._ref(block[pos:pos + 8]), depth)
+                r, val = self._remove_branch(toremove, self._writable(block, child), depth, checked)
             else:
-                r, val = self._remove_leaf(toremove, self._ref(block[pos:pos + 8]), p, depth, block)
+                r, val = self._remove_leaf(toremove, self._writable(block, child), p, depth, block)
             if r == ONELEFT:
-                block[pos:pos + 10] = bytes(10)
+                mem[pos:pos + 10] = bytes(10)
             return r, val
         if get_bit(toremove, depth) == 0:
-            r, val = self._remove_branch_inner(toremove, block, pos + 66, depth + 1, moddepth - 1)
+            r, val = self._remove_branch_inner(toremove, block, pos + 74, depth + 1, moddepth - 1, checked)
+            if r == UNCHANGED:
+                return r, val
+            if r != NOTSTARTED and r != ONELEFT:
+                _add_count(mem, pos + 66, -1)
             if r == NOTSTARTED:
-                t = block[pos:pos + 1]
+                t = mem[pos:pos + 1]
                 if t == EMPTY:
-                    if block[pos + 33:pos + 34] == EMPTY:
+                    if mem[pos + 33:pos + 34] == EMPTY:
                         return NOTSTARTED, None
-                    return DONE, None
+                    return UNCHANGED, None
                 assert t == TERMINAL
-                if block[pos + 1:pos + 33] == toremove:
-                    t1 = block[pos + 33:pos + 34]
+                if mem[pos + 1:pos + 33] == toremove:
+                    t1 = mem[pos + 33:pos + 34]
                     if t1 == TERMINAL:
-                        left = block[pos + 34:pos + 66]
-                        block[pos:pos + 66] = bytes(66)
+                        left = mem[pos + 34:pos + 66]
+                        mem[pos:pos + 74] = bytes(74)
                         return ONELEFT, left
                     else:
                         assert t1 != EMPTY
-                        block[pos:pos + 33] = bytes(33)
+                        mem[pos:pos + 33] = bytes(33)
                         return FRAGILE, None
-                elif block[pos + 34:pos + 66] == toremove:
-                    left = block[pos + 1:pos + 33]
-                    block[pos:pos + 66] = bytes(66)
+                elif mem[pos + 34:pos + 66] == toremove:
+                    left = mem[pos + 1:pos + 33]
+                    mem[pos:pos + 74] = bytes(74)
                     return ONELEFT, left
-                return DONE, None
+                return UNCHANGED, None
             elif r == ONELEFT:
-                was_invalid = block[pos:pos + 1] == LAZY
-                block[pos + 1:pos + 33] = val
-                block[pos:pos + 1] = TERMINAL
-                if block[pos + 33:pos + 34] == TERMINAL:
+                was_invalid = mem[pos:pos + 1] == LAZY
+                mem[pos + 1:pos + 33] = val
+                mem[pos:pos + 1] = TERMINAL
+                if mem[pos + 33:pos + 34] == TERMINAL:
                     return FRAGILE, None
                 if not was_invalid:
                     return INVALIDATING, None
                 else:
                     return DONE, None
             elif r == FRAGILE:
-                t1 = block[pos + 33:pos + 34]
+                t1 = mem[pos + 33:pos + 34]
                 # scan up the tree until the other child is non-empty
                 if t1 == EMPTY:
-                    block[pos:pos + 1] = LAZY
+                    mem[pos:pos + 1] = LAZY
                     return FRAGILE, None
                 # the other child is non-empty, if the tree can be collapsed
                 # it will be up to the level below this one, so try that
-                self._catch_branch(block, pos + 66, moddepth - 1)
+                self._catch_branch(block, pos + 74, moddepth - 1)
                 # done collasping, continue invalidating if neccessary
-                if block[pos:pos + 1] == LAZY:
+                if mem[pos:pos + 1] == LAZY:
                     return DONE, None
-                block[pos:pos + 1] = LAZY
+                mem[pos:pos + 1] = LAZY
                 if t1 == LAZY:
                     return DONE, None
                 return INVALIDATING, None
             elif r == INVALIDATING:
-                t = block[pos:pos + 1]
+                t = mem[pos:pos + 1]
                 if t == LAZY:
                     return DONE, None
                 else:
                     assert t == MIDDLE
-                    block[pos:pos + 1] = LAZY
-                    if block[pos + 33:pos + 34] == LAZY:
+                    mem[pos:pos + 1] = LAZY
+                    if mem[pos + 33:pos + 34] == LAZY:
                         return DONE, None
                     return INVALIDATING, None
             assert r == DONE
             return r, val
         else:
-            r, val = self._remove_branch_inner(toremove, block, pos + 66 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1)
+            r, val = self._remove_branch_inner(toremove, block, pos + 74 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1, checked)
+            if r == UNCHANGED:
+                return r, val
+            if r != NOTSTARTED and r != ONELEFT:
+                _add_count(mem, pos + 70, -1)
             if r == NOTSTARTED:
-                t = block[pos + 33:pos + 34]
+                t = mem[pos + 33:pos + 34]
                 if t == EMPTY:
-                    if block[pos:pos + 1] == EMPTY:
+                    if mem[pos:pos + 1] == EMPTY:
                         return NOTSTARTED, None
-                    return DONE, None
+                    return UNCHANGED, None
                 assert t == TERMINAL
-                if block[pos + 34:pos + 66] == toremove:
-                    if block[pos:pos + 1] == TERMINAL:
-                        left = block[pos + 1:pos + 33]
-                        block[pos:pos + 66] = bytes(66)
+                if mem[pos + 34:pos + 66] == toremove:
+                    if mem[pos:pos + 1] == TERMINAL:
+                        left = mem[pos + 1:pos + 33]
+                        mem[pos:pos + 74] = bytes(74)
                         return ONELEFT, left
                     else:
-                        block[pos + 33:pos + 66] = bytes(33)
+                        mem[pos + 33:pos + 66] = bytes(33)
                         return FRAGILE, None
-                elif block[pos + 1:pos + 33] == toremove:
-                    left = block[pos + 34:pos + 66]
-                    block[pos:pos + 66] = bytes(66)
+                elif mem[pos + 1:pos + 33] == toremove:
+                    left = mem[pos + 34:pos + 66]
+                    mem[pos:pos + 74] = bytes(74)
                     return ONELEFT, left
-                return DONE, None
+                return UNCHANGED, None
             elif r == ONELEFT:
-                was_invalid = block[pos + 33:pos + 34] == LAZY
-                block[pos + 34:pos + 66] = val
-                block[pos + 33:pos + 34] = TERMINAL
-                if block[pos:pos + 1] == TERMINAL:
+                was_invalid = mem[pos + 33:pos + 34] == LAZY
+                mem[pos + 34:pos + 66] = val
+                mem[pos + 33:pos + 34] = TERMINAL
+                if mem[pos:pos + 1] == TERMINAL:
                     return FRAGILE, None
                 if not was_invalid:
                     return INVALIDATING, None
                 return DONE, None
             elif r == FRAGILE:
-                t0 = block[pos:pos + 1]
+                t0 = mem[pos:pos + 1]
                 if t0 == EMPTY:
-                    block[pos + 33:pos + 34] = LAZY
+                    mem[pos + 33:pos + 34] = LAZY
                     return FRAGILE, None
-                self._catch_branch(block, pos + 66 + self.subblock_lengths[moddepth - 1], moddepth - 1)
-                if block[pos + 33:pos + 34] == LAZY:
+                self._catch_branch(block, pos + 74 + self.subblock_lengths[moddepth - 1], moddepth - 1)
+                if mem[pos + 33:pos + 34] == LAZY:
                     return DONE, None
-                block[pos + 33:pos + 34] = LAZY
+                mem[pos + 33:pos + 34] = LAZY
                 if t0 == LAZY:
                     return DONE, None
                 return INVALIDATING, None
             elif r == INVALIDATING:
-                t = block[pos + 33:pos + 34]
+                t = mem[pos + 33:pos + 34]
                 if t == LAZY:
                     return DONE, None
                 else:
                     assert t == MIDDLE
-                    block[pos + 33:pos + 34] = LAZY
-                    if block[pos:pos + 1] == LAZY:
+                    mem[pos + 33:pos + 34] = LAZY
+                    if mem[pos:pos + 1] == LAZY:
                         return DONE, None
                     return INVALIDATING, None
             assert r == DONE
             return r, val
 
     # returns (status, oneval)
-    # status can be ONELEFT, FRAGILE, INVALIDATING, DONE
+    # status can be ONELEFT, FRAGILE, INVALIDATING, DONE, UNCHANGED
     def _remove_leaf(self, toremove, block, pos, depth, branch):
+        mem = self.arena.memory
         result, val = self._remove_leaf_inner(toremove, block, pos, depth)
         if result == ONELEFT:
-            numin = from_bytes(block[2:4])
+            numin = from_bytes(mem[block + 2:block + 4])
             if numin == 1:
                 self._deallocate(block)
-                if branch[:8] == self._deref(block):
-                    branch[:8] = bytes(8)
+                if mem[branch:branch + 8] == self._deref(block):
+                    mem[branch:branch + 8] = bytes(8)
             else:
-                block[2:4] = to_bytes(numin - 1, 2)
+                mem[block + 2:block + 4] = to_bytes(numin - 1, 2)
         return result, val
 
     def _deallocate_leaf_node(self, leaf, pos):
+        mem = self.arena.memory
         assert pos >= 0
-        rpos = 4 + pos * 70
-        next = leaf[:2]
-        leaf[rpos:rpos + 2] = leaf[:2]
-        leaf[rpos + 2:rpos + 70] = bytes(68)
-        leaf[:2] = to_bytes(pos, 2)
+        rpos = leaf + 4 + pos * 78
+        next = mem[leaf:leaf + 2]
+        mem[rpos:rpos + 2] = mem[leaf:leaf + 2]
+        mem[rpos + 2:rpos + 78] = bytes(76)
+        mem[leaf:leaf + 2] = to_bytes(pos, 2)
 
     # returns (status, oneval)
-    # status can be ONELEFT, FRAGILE, INVALIDATING, DONE
+    # status can be ONELEFT, FRAGILE, INVALIDATING, DONE, UNCHANGED
     def _remove_leaf_inner(self, toremove, block, pos, depth):
+        mem = self.arena.memory
         assert pos >= 0
-        rpos = 4 + pos * 70
+        rpos = block + 4 + pos * 78
         if get_bit(toremove, depth) == 0:
-            t = block[rpos:rpos + 1]
+            t = mem[rpos:rpos + 1]
             if t == EMPTY:
-                return DONE, None
+                return UNCHANGED, None
             if t == TERMINAL:
-                t1 = block[rpos + 33:rpos + 34]
-                if block[rpos + 1:rpos + 33] == toremove:
+                t1 = mem[rpos + 33:rpos + 34]
+                if mem[rpos + 1:rpos + 33] == toremove:
                     if t1 == TERMINAL:
-                        left = block[rpos + 34:rpos + 66]
+                        left = mem[rpos + 34:rpos + 66]
                         self._deallocate_leaf_node(block, pos)
                         return ONELEFT, left
-                    block[rpos:rpos + 33] = bytes(33)
+                    mem[rpos:rpos + 33] = bytes(33)
                     return FRAGILE, None
-                if block[rpos + 34:rpos + 66] == toremove:
-                    left = block[rpos + 1:rpos + 33]
+                if mem[rpos + 34:rpos + 66] == toremove:
+                    left = mem[rpos + 1:rpos + 33]
                     self._deallocate_leaf_node(block, pos)
                     return ONELEFT, left
-                return DONE, None
+                return UNCHANGED, None
             else:
-                r, val = self._remove_leaf_inner(toremove, block, from_bytes(block[rpos + 66:rpos + 68]) - 1, depth + 1)
+                r, val = self._remove_leaf_inner(toremove, block, from_bytes(mem[rpos + 66:rpos + 68]) - 1, depth + 1)
+                if r == UNCHANGED:
+                    return r, val
+                if r != ONELEFT:
+                    _add_count(mem, rpos + 70, -1)
                 if r == DONE:
                     return DONE, None
                 if r == INVALIDATING:
                     if t == MIDDLE:
-                        block[rpos:rpos + 1] = LAZY
-                        if block[rpos + 33:rpos + 34] != LAZY:
+                        mem[rpos:rpos + 1] = LAZY
+                        if mem[rpos + 33:rpos + 34] != LAZY:
                             return INVALIDATING, None
                     return DONE, None
                 if r == ONELEFT:
-                    t1 = block[rpos + 33:rpos + 34]
+                    t1 = mem[rpos + 33:rpos + 34]
                     assert t1 != EMPTY
-                    block[rpos + 1:rpos + 33] = val
-                    block[rpos:rpos + 1] = TERMINAL
-                    block[rpos + 66:rpos + 68] = bytes(2)
+                    mem[rpos + 1:rpos + 33] = val
+                    mem[rpos:rpos + 1] = TERMINAL
+                    mem[rpos + 66:rpos + 68] = bytes(2)
                     if t1 == TERMINAL:
                         return FRAGILE, None
                     if t != LAZY and t1 != LAZY:
                         return INVALIDATING, None
                     return DONE, None
                 assert r == FRAGILE
-                t1 = block[rpos + 33:rpos + 34]
+                t1 = mem[rpos + 33:rpos + 34]
                 if t1 == EMPTY:
                     if t != LAZY:
-                        block[rpos:rpos + 1] = LAZY
+                        mem[rpos:rpos + 1] = LAZY
                     return FRAGILE, None
-                self._catch_leaf(block, from_bytes(block[rpos + 66:rpos + 68]) - 1)
+                self._catch_leaf(block, from_bytes(mem[rpos + 66:rpos + 68]) - 1)
                 if t == LAZY:
                     return DONE, None
-                block[rpos:rpos + 1] = LAZY
+                mem[rpos:rpos + 1] = LAZY
                 if t1 == LAZY:
                     return DONE, None
                 return INVALIDATING, None
         else:
-            t = block[rpos + 33:rpos + 34]
+            t = mem[rpos + 33:rpos + 34]
             if t == EMPTY:
-                return DONE, None
+                return UNCHANGED, None
             elif t == TERMINAL:
-                t0 = block[rpos:rpos + 1]
-                if block[rpos + 34:rpos + 66] == toremove:
+                t0 = mem[rpos:rpos + 1]
+                if mem[rpos + 34:rpos + 66] == toremove:
                     if t0 == TERMINAL:
-                        left = block[rpos + 1:rpos + 33]
+                        left = mem[rpos + 1:rpos + 33]
                         self._deallocate_leaf_node(block, pos)
                         return ONELEFT, left
-                    block[rpos + 33:rpos + 66] = bytes(33)
+                    mem[rpos + 33:rpos + 66] = bytes(33)
                     return FRAGILE, None
-                if block[rpos + 1:rpos + 33] == toremove:
-                    left = block[rpos + 34:rpos + 66]
+                if mem[rpos + 1:rpos + 33] == toremove:
+                    left = mem[rpos + 34:rpos + 66]
                     self._deallocate_leaf_node(block, pos)
                     return ONELEFT, left
-                return DONE, None
+                return UNCHANGED, None
             else:
-                r, val = self._remove_leaf_inner(toremove, block, from_bytes(block[rpos + 68:rpos + 70]) - 1, depth + 1)
+                r, val = self._remove_leaf_inner(toremove, block, from_bytes(mem[rpos + 68:rpos + 70]) - 1, depth + 1)
+                if r == UNCHANGED:
+                    return r, val
+                if r != ONELEFT:
+                    _add_count(mem, rpos + 74, -1)
                 if r == DONE:
                     return DONE, None
                 if r == INVALIDATING:
                     if t == MIDDLE:
-                        block[rpos + 33:rpos + 34] = LAZY
-                        if block[rpos:rpos + 1] != LAZY:
+                        mem[rpos + 33:rpos + 34] = LAZY
+                        if mem[rpos:rpos + 1] != LAZY:
                             return INVALIDATING, None
                     return DONE, None
                 if r == ONELEFT:
-                    t0 = block[rpos:rpos + 1]
+                    t0 = mem[rpos:rpos + 1]
                     assert t0 != EMPTY
-                    block[rpos + 34:rpos + 66] = val
-                    block[rpos + 33:rpos + 34] = TERMINAL
-                    block[rpos + 68:rpos + 70] = bytes(2)
+                    mem[rpos + 34:rpos + 66] = val
+                    mem[rpos + 33:rpos + 34] = TERMINAL
+                    mem[rpos + 68:rpos + 70] = bytes(2)
                     if t0 == TERMINAL:
                         return FRAGILE, None
                     if t != LAZY and t0 != LAZY:
                         return INVALIDATING, None
                     return DONE, None
                 assert r == FRAGILE
-                t0 = block[rpos:rpos + 1]
+                t0 = mem[rpos:rpos + 1]
                 if t0 == EMPTY:
                     if t != LAZY:
-                        block[rpos + 33:rpos + 34] = LAZY
+                        mem[rpos + 33:rpos + 34] = LAZY
                     return FRAGILE, None
-                self._catch_leaf(block, from_bytes(block[rpos + 68:rpos + 70]) - 1)
+                self._catch_leaf(block, from_bytes(mem[rpos + 68:rpos + 70]) - 1)
                 if t == LAZY:
                     return DONE, None
-                block[rpos + 33:rpos + 34] = LAZY
+                mem[rpos + 33:rpos + 34] = LAZY
                 if t0 == LAZY:
                     return DONE, None
                 return INVALIDATING, None
 
+    def remove_many_already_hashed(self, toremoves):
+        toremoves = sorted(set(bytes(x) for x in toremoves))
+        t = self.root[:1]
+        if len(toremoves) == 0 or t == EMPTY or (t == TERMINAL and not _contains_sorted(toremoves, self.root[1:])):
+            return
+        # checked is whether all of toremoves are there, see _costly
+        checked = False
+        if t != TERMINAL and (self.hashing is not None or self._costly(self.rootblock)):
+            toremoves = self._present(toremoves, self.rootblock + 8, 0, len(self.subblock_lengths) - 1)
+            if len(toremoves) == 0:
+                return
+            checked = True
+        self.arena.modifying()
+        self._writable_root()
+        if t == TERMINAL:
+            self.root[:] = bytes(33)
+            return
+        self._finish_removal(*self._remove_many_branch(toremoves, self.rootblock, 0, checked))
+
+    # returns the ones of things which are below pos, see _contains_many_branch
+    def _present(self, things, pos, depth, moddepth):
+        found = set()
+        self._contains_many_branch(things, pos, depth, moddepth, found)
+        return [x for x in things if x in found]
+
+    # Updates the root for what removing from the root block returned
+    def _finish_removal(self, status, oneval):
+        if status == INVALIDATING:
+            self.root[:1] = LAZY
+        elif status == ONELEFT:
+            self.root[1:] = oneval
+            self.root[:1] = TERMINAL
+            self.rootblock = None
+        elif status == NONELEFT:
+            self.root[:] = bytes(33)
+            self.rootblock = None
+        elif status == FRAGILE:
+            self._catch_branch(self.rootblock, self.rootblock + 8, len(self.subblock_lengths) - 1)
+            self.root[:1] = LAZY
+
+    # returns (status, oneval)
+    # status can be NONELEFT, ONELEFT, FRAGILE, INVALIDATING, DONE
+    def _remove_many_branch(self, toremoves, block, depth, checked = False):
+        result, val = self._remove_many_branch_inner(toremoves, block, block + 8, depth, len(self.subblock_lengths) - 1, checked)
+        if result == ONELEFT or result == NONELEFT:
+            self._deallocate(block)
+        return result, val
+
+    # toremoves must be sorted and all belong under this position, which must be in use
+    # returns (status, oneval)
+    # status can be NONELEFT, ONELEFT, FRAGILE, INVALIDATING, DONE
+    def _remove_many_branch_inner(self, toremoves, block, pos, depth, moddepth, checked = False):
+        mem = self.arena.memory
+        if moddepth == 0:
+            child = self._ref(mem[pos:pos + 8])
+            if not checked and self._costly(child):
+                toremoves = self._present(toremoves, pos, depth, 0)
+                if len(toremoves) == 0:
+                    return DONE, None
+                checked = True
+            p = from_bytes(mem[pos + 8:pos + 10])
+            if p == 0xFFFF:
+                r, val = self._remove_many_branch(toremoves, self._writable(block, child), depth, checked)
+            else:
+                r, val = self._remove_many_leaf(toremoves, self._writable(block, child), p, depth, block)
+            if r == ONELEFT or r == NONELEFT:
+                mem[pos:pos + 10] = bytes(10)
+            return r, val
+        t0 = mem[pos:pos + 1]
+        t1 = mem[pos + 33:pos + 34]
+        if t0 == TERMINAL and t1 == TERMINAL:
+            gone0 = _contains_sorted(toremoves, mem[pos + 1:pos + 33])
+            gone1 = _contains_sorted(toremoves, mem[pos + 34:pos + 66])
+            if not gone0 and not gone1:
+                return DONE, None
+            if gone0 and gone1:
+                mem[pos:pos + 74] = bytes(74)
+                return NONELEFT, None
+            if gone0:
+                left = mem[pos + 34:pos + 66]
+            else:
+                left = mem[pos + 1:pos + 33]
+            mem[pos:pos + 74] = bytes(74)
+            return ONELEFT, left
+        oldt0 = t0
+        oldt1 = t1
+        split = _split(toremoves, depth)
+        r0 = self._remove_many_branch_side(toremoves[:split], block, pos, pos + 74, depth + 1, moddepth - 1, checked)
+        r1 = self._remove_many_branch_side(toremoves[split:], block, pos + 33, 
+                pos + 74 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1, checked)
+        return self._settle_branch(block, pos, moddepth, r0, r1, oldt0, oldt1)
+
+    # Called after removing from the children of the node at pos, r0 and r1 are what the two 
+    # sides returned and oldt0 and oldt1 are their types from before
+    # returns (status, oneval)
+    # status can be NONELEFT, ONELEFT, FRAGILE, INVALIDATING, DONE
+    def _settle_branch(self, block, pos, moddepth, r0, r1, oldt0, oldt1):
+        mem = self.arena.memory
+        self._recount_node((block, pos, moddepth))
+        if r0 == DONE and r1 == DONE:
+            return DONE, None
+        t0 = mem[pos:pos + 1]
+        t1 = mem[pos + 33:pos + 34]
+        if t0 == EMPTY:
+            if t1 == EMPTY:
+                mem[pos:pos + 74] = bytes(74)
+                return NONELEFT, None
+            if t1 == TERMINAL:
+                left = mem[pos + 34:pos + 66]
+                mem[pos:pos + 74] = bytes(74)
+                return ONELEFT, left
+            return FRAGILE, None
+        if t1 == EMPTY:
+            if t0 == TERMINAL:
+                left = mem[pos + 1:pos + 33]
+                mem[pos:pos + 74] = bytes(74)
+                return ONELEFT, left
+            return FRAGILE, None
+        if t0 == TERMINAL and t1 == TERMINAL:
+            return FRAGILE, None
+        # both children are non-empty, so any which might have collapsed to two things get caught here
+        if r0 == FRAGILE:
+            self._catch_branch(block, pos + 74, moddepth - 1)
+        if r1 == FRAGILE:
+            self._catch_branch(block, pos + 74 + self.subblock_lengths[moddepth - 1], moddepth - 1)
+        if oldt0 == LAZY or oldt1 == LAZY:
+            return DONE, None
+        return INVALIDATING, None
+
+    # tpos is the position of the type of the child, childpos is where its contents go
+    # returns DONE, INVALIDATING, FRAGILE
+    def _remove_many_branch_side(self, toremoves, block, tpos, childpos, depth, moddepth, checked = False):
+        mem = self.arena.memory
+        if len(toremoves) == 0:
+            return DONE
+        t = mem[tpos:tpos + 1]
+        if t == EMPTY:
+            return DONE
+        if t == TERMINAL:
+            if _contains_sorted(toremoves, mem[tpos + 1:tpos + 33]):
+                mem[tpos:tpos + 33] = bytes(33)
+                return INVALIDATING
+            return DONE
+        r, val = self._remove_many_branch_inner(toremoves, block, childpos, depth, moddepth, checked)
+        if r == DONE:
+            return DONE
+        if r == NONELEFT:
+            mem[tpos:tpos + 33] = bytes(33)
+            return INVALIDATING
+        if r == ONELEFT:
+            mem[tpos + 1:tpos + 33] = val
+            mem[tpos:tpos + 1] = TERMINAL
+            return INVALIDATING
+        mem[tpos:tpos + 1] = LAZY
+        return r
+
+    # returns (status, oneval)
+    # status can be NONELEFT, ONELEFT, FRAGILE, INVALIDATING, DONE
+    def _remove_many_leaf(self, toremoves, leaf, pos, depth, branch):
+        mem = self.arena.memory
+        result, val = self._remove_many_leaf_inner(toremoves, leaf, pos, depth)
+        if result == ONELEFT or result == NONELEFT:
+            numin = from_bytes(mem[leaf + 2:leaf + 4])
+            if numin == 1:
+                self._deallocate(leaf)
+                if mem[branch:branch + 8] == self._deref(leaf):
+                    mem[branch:branch + 8] = bytes(8)
+            else:
+                mem[leaf + 2:leaf + 4] = to_bytes(numin - 1, 2)
+        return result, val
+
+    # returns (status, oneval)
+    # status can be NONELEFT, ONELEFT, FRAGILE, INVALIDATING, DONE
+    def _remove_many_leaf_inner(self, toremoves, leaf, pos, depth):
+        mem = self.arena.memory
+        assert pos >= 0
+        rpos = leaf + 4 + pos * 78
+        t0 = mem[rpos:rpos + 1]
+        t1 = mem[rpos + 33:rpos + 34]
+        if t0 == TERMINAL and t1 == TERMINAL:
+            gone0 = _contains_sorted(toremoves, mem[rpos + 1:rpos + 33])
+            gone1 = _contains_sorted(toremoves, mem[rpos + 34:rpos + 66])
+            if not gone0 and not gone1:
+                return DONE, None
+            if gone0 and gone1:
+                self._deallocate_leaf_node(leaf, pos)
+                return NONELEFT, None
+            if gone0:
+                left = mem[rpos + 34:rpos + 66]
+            else:
+                left = mem[rpos + 1:rpos + 33]
+            self._deallocate_leaf_node(leaf, pos)
+            return ONELEFT, left
+        oldt0 = t0
+        oldt1 = t1
+        split = _split(toremoves, depth)
+        r0 = self._remove_many_leaf_side(toremoves[:split], leaf, rpos, rpos + 66, depth + 1)
+        r1 = self._remove_many_leaf_side(toremoves[split:], leaf, rpos + 33, rpos + 68, depth + 1)
+        return self._settle_leaf(leaf, pos, r0, r1, oldt0, oldt1)
+
+    # Like _settle_branch for the node at pos in leaf
+    def _settle_leaf(self, leaf, pos, r0, r1, oldt0, oldt1):
+        mem = self.arena.memory
+        rpos = leaf + 4 + pos * 78
+        self._recount_node((leaf, rpos, None))
+        if r0 == DONE and r1 == DONE:
+            return DONE, None
+        t0 = mem[rpos:rpos + 1]
+        t1 = mem[rpos + 33:rpos + 34]
+        if t0 == EMPTY:
+            if t1 == EMPTY:
+                self._deallocate_leaf_node(leaf, pos)
+                return NONELEFT, None
+            if t1 == TERMINAL:
+                left = mem[rpos + 34:rpos + 66]
+                self._deallocate_leaf_node(leaf, pos)
+                return ONELEFT, left
+            return FRAGILE, None
+        if t1 == EMPTY:
+            if t0 == TERMINAL:
+                left = mem[rpos + 1:rpos + 33]
+                self._deallocate_leaf_node(leaf, pos)
+                return ONELEFT, left
+            return FRAGILE, None
+        if t0 == TERMINAL and t1 == TERMINAL:
+            return FRAGILE, None
+        if r0 == FRAGILE:
+            self._catch_leaf(leaf, from_bytes(mem[rpos + 66:rpos + 68]) - 1)
+        if r1 == FRAGILE:
+            self._catch_leaf(leaf, from_bytes(mem[rpos + 68:rpos + 70]) - 1)
+        if oldt0 == LAZY or oldt1 == LAZY:
+            return DONE, None
+        return INVALIDATING, None
+
+    # tpos is the position of the type of the child, ppos is the position of its pointer
+    # returns DONE, INVALIDATING, FRAGILE
+    def _remove_many_leaf_side(self, toremoves, leaf, tpos, ppos, depth):
+        mem = self.arena.memory
+        if len(toremoves) == 0:
+            return DONE
+        t = mem[tpos:tpos + 1]
+        if t == EMPTY:
+            return DONE
+        if t == TERMINAL:
+            if _contains_sorted(toremoves, mem[tpos + 1:tpos + 33]):
+                mem[tpos:tpos + 33] = bytes(33)
+                return INVALIDATING
+            return DONE
+        r, val = self._remove_many_leaf_inner(toremoves, leaf, from_bytes(mem[ppos:ppos + 2]) - 1, depth)
+        if r == DONE:
+            return DONE
+        if r == NONELEFT:
+            mem[tpos:tpos + 33] = bytes(33)
+            mem[ppos:ppos + 2] = bytes(2)
+            return INVALIDATING
+        if r == ONELEFT:
+            mem[tpos + 1:tpos + 33] = val
+            mem[tpos:tpos + 1] = TERMINAL
+            mem[ppos:ppos + 2] = bytes(2)
+            return INVALIDATING
+        mem[tpos:tpos + 1] = LAZY
+        return r
+
+    # Removes everything whose first depth bits are the same as prefix's
+    # Whole blocks below the prefix are freed without looking inside them and the tree is only
+    # collapsed on the way back up from it
+    def remove_prefix(self, prefix, depth):
+        t = self.root[:1]
+        if t == EMPTY or (t == TERMINAL and not _same_prefix(self.root[1:], prefix, depth)):
+            return
+        # nothing gets made writable if there's nothing to remove
+        if t != TERMINAL and not self._holds_prefix_branch(prefix, depth, self.rootblock + 8, 0, len(self.subblock_lengths) - 1):
+            return
+        self.arena.modifying()
+        self._writable_root()
+        if t == TERMINAL:
+            self.root[:] = bytes(33)
+            return
+        self._finish_removal(*self._remove_prefix_branch(prefix, depth, self.rootblock, 0))
+
+    # Whether anything below pos has the same first depth bits as prefix, only following the prefix
+    def _holds_prefix_branch(self, prefix, depth, pos, d, moddepth):
+        mem = self.arena.memory
+        if d == depth:
+            return True
+        if moddepth == 0:
+            child, leafpos = struct.unpack_from('>QH', mem, pos)
+            if leafpos == 0xFFFF:
+                return self._holds_prefix_branch(prefix, depth, child + 8, d, len(self.subblock_lengths) - 1)
+            return self._holds_prefix_leaf(prefix, depth, child, leafpos, d)
+        if mem[pos] == TERMINAL[0] and mem[pos + 33] == TERMINAL[0]:
+            return _same_prefix(mem[pos + 1:pos + 33], prefix, depth) or _same_prefix(mem[pos + 34:pos + 66], prefix, depth)
+        bit = get_bit(prefix, d)
+        tpos = pos + 33 * bit
+        t = mem[tpos]
+        if t == EMPTY[0]:
+            return False
+        if t == TERMINAL[0]:
+            return _same_prefix(mem[tpos + 1:tpos + 33], prefix, depth)
+        return self._holds_prefix_branch(prefix, depth, pos + 74 + bit * self.subblock_lengths[moddepth - 1], d + 1, moddepth - 1)
+
+    def _holds_prefix_leaf(self, prefix, depth, leaf, pos, d):
+        mem = self.arena.memory
+        assert pos >= 0
+        if d == depth:
+            return True
+        rpos = leaf + 4 + pos * 78
+        if mem[rpos] == TERMINAL[0] and mem[rpos + 33] == TERMINAL[0]:
+            return _same_prefix(mem[rpos + 1:rpos + 33], prefix, depth) or _same_prefix(mem[rpos + 34:rpos + 66], prefix, depth)
+        bit = get_bit(prefix, d)
+        tpos = rpos + 33 * bit
+        t = mem[tpos]
+        if t == EMPTY[0]:
+            return False
+        if t == TERMINAL[0]:
+            return _same_prefix(mem[tpos + 1:tpos + 33], prefix, depth)
+        return self._holds_prefix_leaf(prefix, depth, leaf, struct.unpack_from('>H', mem, rpos + 66 + 2 * bit)[0] - 1, d + 1)
+
+    # returns (status, oneval)
+    # status can be NONELEFT, ONELEFT, FRAGILE, INVALIDATING, DONE
+    def _remove_prefix_branch(self, prefix, depth, block, d):
+        if d == depth:
+            self._free_branch(block)
+            return NONELEFT, None
+        result, val = self._remove_prefix_branch_inner(prefix, depth, block, block + 8, d, len(self.subblock_lengths) - 1)
+        if result == ONELEFT or result == NONELEFT:
+            self._deallocate(block)
+        return result, val
+
+    # returns (status, oneval)
+    # status can be NONELEFT, ONELEFT, FRAGILE, INVALIDATING, DONE
+    def _remove_prefix_branch_inner(self, prefix, depth, block, pos, d, moddepth):
+        mem = self.arena.memory
+        if d == depth:
+            # everything below goes, so the blocks there are freed as they are without copying
+            self._clear_branch_inner(block, pos, moddepth)
+            return NONELEFT, None
+        if moddepth == 0:
+            p = from_bytes(mem[pos + 8:pos + 10])
+            if p == 0xFFFF:
+                r, val = self._remove_prefix_branch(prefix, depth, self._writable(block, self._ref(mem[pos:pos + 8])), d)
+            else:
+                r, val = self._remove_prefix_leaf(prefix, depth, self._writable(block, self._ref(mem[pos:pos + 8])), p, d, block)
+            if r == ONELEFT or r == NONELEFT:
+                mem[pos:pos + 10] = bytes(10)
+            return r, val
+        t0 = mem[pos:pos + 1]
+        t1 = mem[pos + 33:pos + 34]
+        if t0 == TERMINAL and t1 == TERMINAL:
+            gone0 = _same_prefix(mem[pos + 1:pos + 33], prefix, depth)
+            gone1 = _same_prefix(mem[pos + 34:pos + 66], prefix, depth)
+            if not gone0 and not gone1:
+                return DONE, None
+            if gone0 and gone1:
+                mem[pos:pos + 74] = bytes(74)
+                return NONELEFT, None
+            left = mem[pos + 34:pos + 66] if gone0 else mem[pos + 1:pos + 33]
+            mem[pos:pos + 74] = bytes(74)
+            return ONELEFT, left
+        r = [DONE, DONE]
+        bit = get_bit(prefix, d)
+        r[bit] = self._remove_prefix_branch_side(prefix, depth, block, pos + 33 * bit,
+                pos + 74 + bit * self.subblock_lengths[moddepth - 1], d + 1, moddepth - 1)
+        return self._settle_branch(block, pos, moddepth, r[0], r[1], t0, t1)
+
+    # tpos is the position of the type of the child, childpos is where its contents go
+    # returns DONE, INVALIDATING, FRAGILE
+    def _remove_prefix_branch_side(self, prefix, depth, block, tpos, childpos, d, moddepth):
+        mem = self.arena.memory
+        t = mem[tpos:tpos + 1]
+        if t == EMPTY:
+            return DONE
+        if t == TERMINAL:
+            if _same_prefix(mem[tpos + 1:tpos + 33], prefix, depth):
+                mem[tpos:tpos + 33] = bytes(33)
+                return INVALIDATING
+            return DONE
+        r, val = self._remove_prefix_branch_inner(prefix, depth, block, childpos, d, moddepth)
+        if r == DONE:
+            return DONE
+        if r == NONELEFT:
+            mem[tpos:tpos + 33] = bytes(33)
+            return INVALIDATING
+        if r == ONELEFT:
+            mem[tpos + 1:tpos + 33] = val
+            mem[tpos:tpos + 1] = TERMINAL
+            return INVALIDATING
+        mem[tpos:tpos + 1] = LAZY
+        return r
+
+    # returns (status, oneval)
+    # status can be NONELEFT, ONELEFT, FRAGILE, INVALIDATING, DONE
+    def _remove_prefix_leaf(self, prefix, depth, leaf, pos, d, branch):
+        mem = self.arena.memory
+        result, val = self._remove_prefix_leaf_inner(prefix, depth, leaf, pos, d)
+        if result == ONELEFT or result == NONELEFT:
+            numin = from_bytes(mem[leaf + 2:leaf + 4])
+            if numin == 1:
+                self._deallocate(leaf)
+                if mem[branch:branch + 8] == self._deref(leaf):
+                    mem[branch:branch + 8] = bytes(8)
+            else:
+                mem[leaf + 2:leaf + 4] = to_bytes(numin - 1, 2)
+        return result, val
+
+    # returns (status, oneval)
+    # status can be NONELEFT, ONELEFT, FRAGILE, INVALIDATING, DONE
+    def _remove_prefix_leaf_inner(self, prefix, depth, leaf, pos, d):
+        mem = self.arena.memory
+        assert pos >= 0
+        rpos = leaf + 4 + pos * 78
+        if d == depth:
+            self._delete_from_leaf(leaf, pos)
+            return NONELEFT, None
+        t0 = mem[rpos:rpos + 1]
+        t1 = mem[rpos + 33:rpos + 34]
+        if t0 == TERMINAL and t1 == TERMINAL:
+            gone0 = _same_prefix(mem[rpos + 1:rpos + 33], prefix, depth)
+            gone1 = _same_prefix(mem[rpos + 34:rpos + 66], prefix, depth)
+            if not gone0 and not gone1:
+                return DONE, None
+            left = None
+            if not gone0 or not gone1:
+                left = mem[rpos + 34:rpos + 66] if gone0 else mem[rpos + 1:rpos + 33]
+            self._deallocate_leaf_node(leaf, pos)
+            return (ONELEFT, left) if left is not None else (NONELEFT, None)
+        r = [DONE, DONE]
+        bit = get_bit(prefix, d)
+        r[bit] = self._remove_prefix_leaf_side(prefix, depth, leaf, rpos + 33 * bit, rpos + 66 + 2 * bit, d + 1)
+        return self._settle_leaf(leaf, pos, r[0], r[1], t0, t1)
+
+    # tpos is the position of the type of the child, ppos is the position of its pointer
+    # returns DONE, INVALIDATING, FRAGILE
+    def _remove_prefix_leaf_side(self, prefix, depth, leaf, tpos, ppos, d):
+        mem = self.arena.memory
+        t = mem[tpos:tpos + 1]
+        if t == EMPTY:
+            return DONE
+        if t == TERMINAL:
+            if _same_prefix(mem[tpos + 1:tpos + 33], prefix, depth):
+                mem[tpos:tpos + 33] = bytes(33)
+                return INVALIDATING
+            return DONE
+        r, val = self._remove_prefix_leaf_inner(prefix, depth, leaf, from_bytes(mem[ppos:ppos + 2]) - 1, d)
+        if r == DONE:
+            return DONE
+        if r == NONELEFT:
+            mem[tpos:tpos + 33] = bytes(33)
+            mem[ppos:ppos + 2] = bytes(2)
+            return INVALIDATING
+        if r == ONELEFT:
+            mem[tpos + 1:tpos + 33] = val
+            mem[tpos:tpos + 1] = TERMINAL
+            mem[ppos:ppos + 2] = bytes(2)
+            return INVALIDATING
+        mem[tpos:tpos + 1] = LAZY
+        return r
+
+    # Frees block and everything below it without changing any of them
+    # Every leaf below a branch is only used by it so they can go all at once
+    def _free_branch(self, block):
+        mem = self.arena.memory
+        leaves = set()
+        for p in self.references[1:]:
+            child = self._ref(mem[block + p:block + p + 8])
+            if child is None:
+                continue
+            if mem[block + p + 8:block + p + 10] == bytes([0xFF, 0xFF]):
+                self._free_branch(child)
+            else:
+                leaves.add(child)
+        for leaf in leaves:
+            self._deallocate(leaf)
+        self._deallocate(block)
+
+    # Clears out the node at pos and everything below it, block must be writable
+    # Leaves can also be used by other parts of block so only their nodes from here are freed, 
+    # and ones which only this uses are freed as they are without being copied first
+    def _clear_branch_inner(self, block, pos, moddepth):
+        mem = self.arena.memory
+        leaves = {}
+        self._clear_branch_refs(block, pos, moddepth, leaves)
+        for leaf, leafposes in leaves.items():
+            numin = from_bytes(mem[leaf + 2:leaf + 4])
+            if numin == len(leafposes):
+                self._deallocate(leaf)
+                if mem[block:block + 8] == self._deref(leaf):
+                    mem[block:block + 8] = bytes(8)
+            else:
+                leaf = self._writable(block, leaf)
+                for leafpos in leafposes:
+                    self._delete_from_leaf(leaf, leafpos)
+                mem[leaf + 2:leaf + 4] = to_bytes(numin - len(leafposes), 2)
+
+    # Clears the nodes at pos and below in block, freeing branches below it and putting 
+    # the positions of leaf nodes it referred to in leaves
+    def _clear_branch_refs(self, block, pos, moddepth, leaves):
+        mem = self.arena.memory
+        if moddepth == 0:
+            child = self._ref(mem[pos:pos + 8])
+            if child is None:
+                return
+            leafpos = from_bytes(mem[pos + 8:pos + 10])
+            if leafpos == 0xFFFF:
+                self._free_branch(child)
+            else:
+                leaves.setdefault(child, []).append(leafpos)
+            mem[pos:pos + 10] = bytes(10)
+            return
+        if mem[pos:pos + 1] != EMPTY and mem[pos:pos + 1] != TERMINAL:
+            self._clear_branch_refs(block, pos + 74, moddepth - 1, leaves)
+        if mem[pos + 33:pos + 34] != EMPTY and mem[pos + 33:pos + 34] != TERMINAL:
+            self._clear_branch_refs(block, pos + 74 + self.subblock_lengths[moddepth - 1], moddepth - 1, leaves)
+        mem[pos:pos + 74] = bytes(74)
+
     def _catch_branch(self, block, pos, moddepth):
+        mem = self.arena.memory
         if moddepth == 0:
-            leafpos = from_bytes(block[pos + 8:pos + 10])
+            leafpos = from_bytes(mem[pos + 8:pos + 10])
+            child = self._writable(block, self._ref(mem[pos:pos + 8]))
             if leafpos == 0xFFFF:
-                self._catch_branch(self._ref(block[pos:pos + 8]), 8, len(self.subblock_lengths) - 1)
+                self._catch_branch(child, child + 8, len(self.subblock_lengths) - 1)
             else:
-                self._catch_leaf(self._ref(block[pos:pos + 8]), leafpos)
+                self._catch_leaf(child, leafpos)
             return
-        if block[pos:pos + 1] == EMPTY:
-            assert block[pos + 33:pos + 34] != TERMINAL
-            r = self._collapse_branch_inner(block, pos + 66 + self.subblock_lengths[moddepth - 1], moddepth - 1)
+        if mem[pos:pos + 1] == EMPTY:
+            assert mem[pos + 33:pos + 34] != TERMINAL
+            r = self._collapse_branch_inner(block, pos + 74 + self.subblock_lengths[moddepth - 1], moddepth - 1)
             if r != None:
-                block[pos:pos + 66] = r
+                mem[pos:pos + 66] = r
             return
-        if block[pos + 33:pos + 34] == EMPTY:
-            assert block[pos:pos + 1] != TERMINAL
-            r = self._collapse_branch_inner(block, pos + 66, moddepth - 1)
+        if mem[pos + 33:pos + 34] == EMPTY:
+            assert mem[pos:pos + 1] != TERMINAL
+            r = self._collapse_branch_inner(block, pos + 74, moddepth - 1)
             if r != None:
-                block[pos:pos + 66] = r
+                mem[pos:pos + 66] = r
 
     # returns two hashes string or None
     def _collapse_branch(self, block):
-        r = self._collapse_branch_inner(block, 8, len(self.subblock_lengths) - 1)
+        r = self._collapse_branch_inner(block, block + 8, len(self.subblock_lengths) - 1)
         if r != None:
             self._deallocate(block)
         return r
 
     # returns two hashes string or None
     def _collapse_branch_inner(self, block, pos, moddepth):
+        mem = self.arena.memory
         if moddepth == 0:
-            leafpos = from_bytes(block[pos + 8:pos + 10])
+            leafpos = from_bytes(mem[pos + 8:pos + 10])
             if leafpos == 0xFFFF:
-                r = self._collapse_branch(self._ref(block[pos:pos + 8]))
+                r = self._collapse_branch(self._writable(block, self._ref(mem[pos:pos + 8])))
             else:
-                r = self._collapse_leaf(self._ref(block[pos:pos + 8]), from_bytes(block[pos + 8:pos + 10]), block)
+                r = self._collapse_leaf(self._writable(block, self._ref(mem[pos:pos + 8])), from_bytes(mem[pos + 8:pos + 10]), block)
             if r != None:
-                block[pos:pos + 10] = bytes(10)
+                mem[pos:pos + 10] = bytes(10)
             return r
-        t0 = block[pos:pos + 1]
-        t1 = block[pos + 33:pos + 34]
+        t0 = mem[pos:pos + 1]
+        t1 = mem[pos + 33:pos + 34]
         if t0 == TERMINAL and t1 == TERMINAL:
-            r = block[pos:pos + 66]
-            block[pos:pos + 66] = bytes(66)
+            r = mem[pos:pos + 66]
+            mem[pos:pos + 74] = bytes(74)
             return r
         if t0 == EMPTY:
-            r = self._collapse_branch_inner(block, pos + 66 + self.subblock_lengths[moddepth - 1], moddepth - 1)
+            r = self._collapse_branch_inner(block, pos + 74 + self.subblock_lengths[moddepth - 1], moddepth - 1)
             if r != None:
-                block[pos + 33:pos + 66] = bytes(33)
+                mem[pos:pos + 74] = bytes(74)
             return r
         if t1 == EMPTY:
-            r = self._collapse_branch_inner(block, pos + 66, moddepth - 1)
+            r = self._collapse_branch_inner(block, pos + 74, moddepth - 1)
             if r != None:
-                block[pos:pos + 33] = bytes(33)
+                mem[pos:pos + 74] = bytes(74)
             return r
         return None
 
     def _catch_leaf(self, leaf, pos):
+        mem = self.arena.memory
         assert pos >= 0
-        rpos = 4 + pos * 70
-        t0 = leaf[rpos:rpos + 1]
-        t1 = leaf[rpos + 33:rpos + 34]
+        rpos = leaf + 4 + pos * 78
+        t0 = mem[rpos:rpos + 1]
+        t1 = mem[rpos + 33:rpos + 34]
         if t0 == EMPTY:
-            r = self._collapse_leaf_inner(leaf, from_bytes(leaf[rpos + 68:rpos + 70]) - 1)
+            r = self._collapse_leaf_inner(leaf, from_bytes(mem[rpos + 68:rpos + 70]) - 1)
             if r != None:
-                leaf[rpos + 68:rpos + 70] = bytes(2)
-                leaf[rpos:rpos + 66] = r
+                mem[rpos + 68:rpos + 70] = bytes(2)
+                mem[rpos:rpos + 66] = r
         elif t1 == EMPTY:
-            r = self._collapse_leaf_inner(leaf, from_bytes(leaf[rpos + 66:rpos + 68]) - 1)
+            r = self._collapse_leaf_inner(leaf, from_bytes(mem[rpos + 66:rpos + 68]) - 1)
             if r != None:
-                leaf[rpos + 66:rpos + 68] = bytes(2)
-                leaf[rpos:rpos + 66] = r
+                mem[rpos + 66:rpos + 68] = bytes(2)
+                mem[rpos:rpos + 66] = r
 
     # returns two hashes string or None
     def _collapse_leaf(self, leaf, pos, branch):
+        mem = self.arena.memory
         assert pos >= 0
         r = self._collapse_leaf_inner(leaf, pos)
         if r != None:
-            inputs = from_bytes(leaf[2:4])
+            inputs = from_bytes(mem[leaf + 2:leaf + 4])
             if inputs == 1:
                 self._deallocate(leaf)
-                if branch[:8] == self._deref(leaf):
-                    branch[:8] = bytes(8)
+                if mem[branch:branch + 8] == self._deref(leaf):
+                    mem[branch:branch + 8] = bytes(8)
                 return r
-            leaf[2:4] = to_bytes(inputs - 1, 2)
+            mem[leaf + 2:leaf + 4] = to_bytes(inputs - 1, 2)
         return r
 
     # returns two hashes string or None
     def _collapse_leaf_inner(self, leaf, pos):
+        mem = self.arena.memory
         assert pos >= 0
-        rpos = 4 + pos * 70
-        t0 = leaf[rpos:rpos + 1]
-        t1 = leaf[rpos + 33:rpos + 34]
+        rpos = leaf + 4 + pos * 78
+        t0 = mem[rpos:rpos + 1]
+        t1 = mem[rpos + 33:rpos + 34]
         r = None
         if t0 == TERMINAL and t1 == TERMINAL:
-            r = leaf[rpos:rpos + 66]
+            r = mem[rpos:rpos + 66]
         elif t0 == EMPTY:
-            r = self._collapse_leaf_inner(leaf, from_bytes(leaf[rpos + 68:rpos + 70]) - 1)
+            r = self._collapse_leaf_inner(leaf, from_bytes(mem[rpos + 68:rpos + 70]) - 1)
         elif t1 == EMPTY:
-            r = self._collapse_leaf_inner(leaf, from_bytes(leaf[rpos + 66:rpos + 68]) - 1)
+            r = self._collapse_leaf_inner(leaf, from_bytes(mem[rpos + 66:rpos + 68]) - 1)
         if r is not None:
             # this leaf node is being collapsed, deallocate it
-            leaf[rpos + 2:rpos + 70] = bytes(68)
-            leaf[rpos:rpos + 2] = leaf[:2]
-            leaf[:2] = to_bytes(pos, 2)
+            mem[rpos + 2:rpos + 78] = bytes(76)
+            mem[rpos:rpos + 2] = mem[leaf:leaf + 2]
+            mem[leaf:leaf + 2] = to_bytes(pos, 2)
         return r
 
-    # Convenience function
-    def is_included(self, tocheck):
-        return self.is_included_already_hashed(sha256(tocheck).digest())
+# A read only view of a MerkleSet as it was when snapshot was called
+# It shares blocks with the set, which copies any it's about to change while they're shared
+class Snapshot(_Reader):
+    def __init__(self, mset):
+        self.mset = mset
+        self.subblock_lengths = mset.subblock_lengths
+        self.leaf_units = mset.leaf_units
+        self.arena = mset.arena
+        self.root = safearray(mset.root)
+        self.rootblock = mset.rootblock
+        self.generation = mset.generation
+        self.hasher = mset.hasher
 
-    # returns (boolean, proof string)
-    def is_included_already_hashed(self, tocheck):
-        buf = []
-        self.get_root()
-        t = self.root[:1]
-        if t == EMPTY:
-            return False, EMPTY
-        if t == TERMINAL:
-            return tocheck == self.root[1:], self.root
-        assert t == MIDDLE
-        r = self._is_included_branch(tocheck, self.rootblock, 8, 0, len(self.subblock_lengths) - 1, buf)
-        return r, b''.join([bytes(x) for x in buf])
+    def _check_live(self):
+        assert self.mset is not None
 
-    # returns boolean, appends to buf
-    def _is_included_branch(self, tocheck, block, pos, depth, moddepth, buf):
-        if moddepth == 0:
-            if block[pos + 8:pos + 10] == bytes([0xFF, 0xFF]):
-                return self._is_included_branch(tocheck, self._ref(block[pos:pos + 8]), 8, depth, len(self.subblock_lengths) - 1, buf)
-            else:
-                return self._is_included_leaf(tocheck, self._ref(block[pos:pos + 8]), from_bytes(block[pos + 8:pos + 10]), depth, buf)
-        buf.append(MIDDLE)
-        if block[pos + 1:pos + 33] == tocheck or block[pos + 34:pos + 66] == tocheck:
-            _finish_proof(block[pos:pos + 66], depth, buf)
-            return True
-        if get_bit(tocheck, depth) == 0:
-            t = block[pos:pos + 1]
-            if t == EMPTY or t == TERMINAL:
-                _finish_proof(block[pos:pos + 66], depth, buf)
-                return False
-            assert t == MIDDLE
-            r = self._is_included_branch(tocheck, block, pos + 66, depth + 1, moddepth - 1, buf)
-            buf.append(_quick_summary(block[pos + 33:pos + 66]))
-            return r
+    # The blocks it was using get freed and reused, so nothing can be read from it afterwards
+    def release(self):
+        self._check_live()
+        self.mset._release(self)
+        self.mset = None
+        self.arena = None
+        self.rootblock = None
+
+# Stands in for a set at the other end of conn, which has to be running serve_prefix_nodes
+# conn can be one end of a Pipe or a socket connection from multiprocessing.connection
+# Only does what MerkleSet.diff needs, one round trip per level
+class RemoteSet:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def get_prefix_nodes(self, queries):
+        self.conn.send(queries)
+        return self.conn.recv()
+
+    # Tells the other end to stop serving
+    def close(self):
+        self.conn.send(None)
+
+# Answers requests from a RemoteSet on conn about mset until it's closed
+def serve_prefix_nodes(mset, conn):
+    while True:
+        queries = conn.recv()
+        if queries is None:
+            break
+        conn.send(mset.get_prefix_nodes(queries))
+
+# returns (pos, dest) for the given nodes and every LAZY one below them, in lists by depth
+# nodes are (pos, dest, block, moddepth) and all at the same depth
+# blocks gets the blocks below the ones nodes are in which those are found in
+def _collect_levels(mem, subblock_lengths, nodes, blocks):
+    # one per bit of the hash plus the root, so nothing has to check whether its level exists
+    levels = [[] for i in range(257)]
+    for pos, dest, block, moddepth in nodes:
+        if moddepth < 0:
+            _collect_leaf(mem, block, pos, 0, dest, levels)
         else:
-            t = block[pos + 33:pos + 34]
-            if t == EMPTY or t == TERMINAL:
-                _finish_proof(block[pos:pos + 66], depth, buf)
-                return False
-            assert t == MIDDLE
-            buf.append(_quick_summary(block[pos:pos + 33]))
-            return self._is_included_branch(tocheck, block, pos + 66 + self.subblock_lengths[moddepth - 1], depth + 1, moddepth - 1, buf)
+            _collect_branch(mem, subblock_lengths, block, pos, 0, moddepth, dest, levels, blocks)
+    while len(levels) > 0 and len(levels[-1]) == 0:
+        levels.pop()
+    return levels
 
-    # returns boolean, appends to buf
-    def _is_included_leaf(self, tocheck, block, pos, depth, buf):
-        assert pos >= 0
-        pos = 4 + pos * 70
-        buf.append(MIDDLE)
-        if block[pos + 1:pos + 33] == tocheck or block[pos + 34:pos + 66] == tocheck:
-            _finish_proof(block[pos:pos + 66], depth, buf)
-            return True
-        if get_bit(tocheck, depth) == 0:
-            t = block[pos:pos + 1]
-            if t == EMPTY or t == TERMINAL:
-                _finish_proof(block[pos:pos + 66], depth, buf)
-                return False
-            assert t == MIDDLE
-            r = self._is_included_leaf(tocheck, block, from_bytes(block[pos + 66:pos + 68]) - 1, depth + 1, buf)
-            buf.append(_quick_summary(block[pos + 33:pos + 66]))
-            return r
+# Adds (pos, dest) for the node at pos and every LAZY one below it to levels[depth]
+# dest is where its summary goes, None for the root
+def _collect_branch(mem, subblock_lengths, block, pos, depth, moddepth, dest, levels, blocks):
+    if moddepth == 0:
+        child = from_bytes(mem[pos:pos + 8])
+        leafpos = from_bytes(mem[pos + 8:pos + 10])
+        blocks.append(child)
+        if leafpos == 0xFFFF:
+            _collect_branch(mem, subblock_lengths, child, child + 8, depth, len(subblock_lengths) - 1, dest, levels, blocks)
         else:
-            t = block[pos + 33:pos + 34]
-            if t == EMPTY or t == TERMINAL:
-                _finish_proof(block[pos:pos + 66], depth, buf)
-                return False
-            assert t == MIDDLE
-            buf.append(_quick_summary(block[pos:pos + 33]))
-            return self._is_included_leaf(tocheck, block, from_bytes(block[pos + 68:pos + 70]) - 1, depth + 1, buf)
+            _collect_leaf(mem, child, child + 4 + leafpos * 78, depth, dest, levels)
+        return
+    levels[depth].append((pos, dest))
+    if mem[pos] == LAZY[0]:
+        _collect_branch(mem, subblock_lengths, block, pos + 74, depth + 1, moddepth - 1, pos, levels, blocks)
+    if mem[pos + 33] == LAZY[0]:
+        _collect_branch(mem, subblock_lengths, block, pos + 74 + subblock_lengths[moddepth - 1], depth + 1, moddepth - 1, pos + 33, levels, blocks)
+
+# Reads single bytes in place since this runs once per LAZY node
+def _collect_leaf(mem, leaf, rpos, depth, dest, levels):
+    levels[depth].append((rpos, dest))
+    if mem[rpos] == LAZY[0]:
+        _collect_leaf(mem, leaf, leaf + 4 + ((mem[rpos + 66] << 8 | mem[rpos + 67]) - 1) * 78, depth + 1, rpos, levels)
+    if mem[rpos + 33] == LAZY[0]:
+        _collect_leaf(mem, leaf, leaf + 4 + ((mem[rpos + 68] << 8 | mem[rpos + 69]) - 1) * 78, depth + 1, rpos + 33, levels)
+
+# Stops the worker processes and removes the shared memory, either can be None
+def _stop_workers(pool, shm):
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+    if shm is not None:
+        shm.close()
+        shm.unlink()
+
+# The shared memory a worker process is attached to, kept between tasks
+_attached = None
+
+# Runs in a worker process for get_root, hashing everything below nodes in the shared memory 
+# named name
+# returns (the blocks it wrote summaries into, (dest, summary) for each of nodes)
+def _hash_subtrees_in_worker(name, hash_batch, subblock_lengths, nodes):
+    global _attached
+    if _attached is None or _attached.name != name:
+        if _attached is not None:
+            _attached.close()
+        _attached = shared_memory.SharedMemory(name = name)
+    mem = _attached.buf
+    blocks = [block for pos, dest, block, moddepth in nodes]
+    levels = _collect_levels(mem, subblock_lengths, nodes, blocks)
+    for level in reversed(levels[1:]):
+        digests = hash_batch([bytes(mem[pos:pos + 66]) for pos, dest in level])
+        for (pos, dest), digest in zip(level, digests):
+            mem[dest:dest + 33] = MIDDLE + digest
+    digests = hash_batch([bytes(mem[pos:pos + 66]) for pos, dest in levels[0]])
+    return blocks, [(dest, MIDDLE + digest) for (pos, dest), digest in zip(levels[0], digests)]
+
+# Adds delta to the count at countpos, packed in place so it's cheap enough to do on every 
+# level an add or remove passes through
+def _add_count(mem, countpos, delta):
+    struct.pack_into('>I', mem, countpos, struct.unpack_from('>I', mem, countpos)[0] + delta)
+
+# returns the number of things below the node at pos, the counts of its children are at countpos
+def _count(mem, pos, countpos):
+    r = 0
+    t = bytes(mem[pos:pos + 1])
+    if t == TERMINAL:
+        r += 1
+    elif t != EMPTY:
+        r += from_bytes(mem[countpos:countpos + 4])
+    t = bytes(mem[pos + 33:pos + 34])
+    if t == TERMINAL:
+        r += 1
+    elif t != EMPTY:
+        r += from_bytes(mem[countpos + 4:countpos + 8])
+    return r
+
+# things must be sorted and share their first depth bits
+# returns the index of the first one whose bit at depth is 1
+def _split(things, depth):
+    low = 0
+    high = len(things)
+    while low < high:
+        mid = (low + high) // 2
+        if get_bit(things[mid], depth) == 0:
+            low = mid + 1
+        else:
+            high = mid
+    return low
+
+def _same_prefix(a, b, depth):
+    whole = depth // 8
+    if a[:whole] != b[:whole]:
+        return False
+    extra = depth % 8
+    return extra == 0 or (a[whole] ^ b[whole]) >> (8 - extra) == 0
+
+# returns thing with the bit at depth set to 1
+def _set_bit(thing, depth):
+    return thing[:depth // 8] + bytes([thing[depth // 8] | (0x80 >> (depth % 8))]) + thing[depth // 8 + 1:]
+
+# returns (summary, things) for the part of an EMPTY or TERMINAL summary which matches prefix
+def _prefix_terminal(val, prefix, depth):
+    if val[:1] == TERMINAL and _same_prefix(val[1:], prefix, depth):
+        return val, [val[1:]]
+    return EMPTY + BLANK, []
+
+# returns (summary, things) for the part of a node with two terminals which matches prefix
+def _prefix_double(node, prefix, depth, summary):
+    things = [node[1:33], node[34:]]
+    things = [x for x in things if _same_prefix(x, prefix, depth)]
+    if len(things) == 2:
+        return summary, things
+    if len(things) == 1:
+        return TERMINAL + things[0], things
+    return EMPTY + BLANK, []
+
+def _contains_sorted(things, thing):
+    i = bisect_left(things, thing)
+    return i < len(things) and things[i] == thing
+
+# returns the number of nodes it takes to store at least two sorted distinct things
+def _nodes_needed(things, depth):
+    if len(things) == 2:
+        return 1
+    split = _split(things, depth)
+    r = 1
+    if split >= 2:
+        r += _nodes_needed(things[:split], depth + 1)
+    if len(things) - split >= 2:
+        r += _nodes_needed(things[split:], depth + 1)
+    return r
 
 def _finish_proof(val, depth, buf):
     assert len(val) == 66
@@ -1222,6 +3907,11 @@ def _finish_proof(val, depth, buf):
     buf.append(_quick_summary(val[:33]))
     buf.append(_quick_summary(val[33:]))
 
+def _found_terminal(tochecks, val, found):
+    assert len(val) == 33
+    if val[:1] == TERMINAL and _contains_sorted(tochecks, val[1:]):
+        found.add(bytes(val[1:]))
+
 def _quick_summary(val):
     assert len(val) == 33
     t = val[:1]
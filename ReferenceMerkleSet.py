@@ -1,4 +1,4 @@
-from hashlib import blake2b
+from hashlib import blake2b, sha256
 
 """
 A simple, confidence-inspiring Merkle Set standard
@@ -11,6 +11,7 @@ Reasonably simple implementation
 The main tricks in this standard are:
 
 Uses blake2b because that has the best performance on 512 bit inputs
+The hash function can be swapped out by passing in a different Hasher
 Skips repeated hashing of exactly two things even when they share prefix bits
 
 
@@ -39,54 +40,125 @@ TRUNCATED = bytes([3])
 
 BLANK = bytes([0] * 32)
 
-prehashed = {}
-
-def init_prehashed():
-    for x in [EMPTY, TERMINAL, MIDDLE]:
-        for y in [EMPTY, TERMINAL, MIDDLE]:
-            prehashed[x + y] = blake2b(bytes([0] * 30) + x + y)
-
-init_prehashed()
+# Everything which gets hashed goes through one of these
+# hash_function is used for nodes and roots and value_function for the convenience functions 
+# which hash values before adding or checking them. Hasher(blake2s) is faster on 32 bit hardware 
+# but gives different roots.
+class Hasher:
+    def __init__(self, hash_function = blake2b, value_function = sha256):
+        self.hash_function = hash_function
+        self.value_function = value_function
+        self._prehash()
+
+    # hash states with the padding and types already in, keyed by the two types
+    def _prehash(self):
+        self.prehashed = {}
+        for x in [EMPTY, TERMINAL, MIDDLE]:
+            for y in [EMPTY, TERMINAL, MIDDLE]:
+                self.prehashed[x + y] = self.hash_function(bytes([0] * 30) + x + y)
+
+    # Hashers are the same if they give the same hashes
+    def __eq__(self, other):
+        return type(self) is type(other) and self.hash_function == other.hash_function and \
+                self.value_function == other.value_function
+
+    def __hash__(self):
+        return hash((type(self), self.hash_function, self.value_function))
+
+    # the hash states can't be pickled but are easy to make again, everything else including 
+    # which subclass it is comes through as is
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['prehashed']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._prehash()
+
+    # hash of a node from the 66 bytes of its children
+    def hashdown(self, mystr):
+        assert len(mystr) == 66
+        h = self.prehashed[bytes(mystr[0:1] + mystr[33:34])].copy()
+        h.update(mystr[1:33] + mystr[34:])
+        return h.digest()[:32]
+
+    # Same as calling hashdown on each, for a faster implementation to override
+    def hash_many(self, mystrs):
+        prehashed = self.prehashed
+        r = []
+        for mystr in mystrs:
+            h = prehashed[bytes(mystr[0:1] + mystr[33:34])].copy()
+            h.update(mystr[1:33])
+            h.update(mystr[34:66])
+            r.append(h.digest()[:32])
+        return r
+
+    def hash_value(self, val):
+        return self.value_function(val).digest()
+
+    def compress_root(self, mystr):
+        assert len(mystr) == 33
+        if mystr[0:1] == MIDDLE:
+            return mystr[1:]
+        if mystr[0:1] == EMPTY:
+            assert mystr[1:] == BLANK
+            return BLANK
+        return self.hash_function(mystr).digest()[:32]
+
+default_hasher = Hasher()
+
+prehashed = default_hasher.prehashed
 
 def hashdown(mystr):
-    assert len(mystr) == 66
-    h = prehashed[bytes(mystr[0:1] + mystr[33:34])].copy()
-    h.update(mystr[1:33] + mystr[34:])
-    return h.digest()[:32]
+    return default_hasher.hashdown(mystr)
 
 def compress_root(mystr):
-    assert len(mystr) == 33
-    if mystr[0:1] == MIDDLE:
-        return mystr[1:]
-    if mystr[0:1] == EMPTY:
-        assert mystr[1:] == BLANK
-        return BLANK
-    return blake2b(mystr).digest()[:32]
+    return default_hasher.compress_root(mystr)
 
 def get_bit(mybytes, pos):
     assert len(mybytes) == 32
     return (mybytes[pos // 8] >> (7 - (pos % 8))) & 1
 
 class ReferenceMerkleSet:
-    def __init__(self, root = None):
+    def __init__(self, root = None, hasher = default_hasher):
         self.root = root
         if root is None:
             self.root = _empty
+        self.hasher = hasher
 
     def get_root(self):
-        return compress_root(self.root.get_hash())
+        return self.hasher.compress_root(self.root.get_hash())
 
     def add_already_hashed(self, toadd):
-        self.root = self.root.add(toadd, 0)
+        self.root = self.root.add(toadd, 0, self.hasher)
 
     def remove_already_hashed(self, toremove):
-        self.root = self.root.remove(toremove, 0)
+        self.root = self.root.remove(toremove, 0, self.hasher)
 
     def is_included_already_hashed(self, tocheck):
         proof = []
         r = self.root.is_included(tocheck, 0, proof)
         return r, b''.join(proof)
 
+    # returns (list of booleans, proof string)
+    def is_included_many_already_hashed(self, tochecks):
+        proof = []
+        if len(tochecks) == 0:
+            self.root.other_included(None, 0, proof, True)
+            return [], b''.join(proof)
+        found = set()
+        self.root.is_included_many(sorted(set(tochecks)), 0, proof, found)
+        return [x in found for x in tochecks], b''.join(proof)
+
+    # returns (sorted list of everything whose first depth bits are the same as prefix's, proof string)
+    # The proof has everything below the prefix and only summaries off the path to it
+    def prefix_query(self, prefix, depth):
+        proof = []
+        found = []
+        self.root.prefix_query(prefix, depth, 0, proof, found)
+        return found, b''.join(proof)
+
     def _audit(self, hashes):
         newhashes = []
         self.root._audit(newhashes, [])
@@ -108,16 +180,22 @@ class EmptyNode:
     def is_double(self):
         raise SetError()
 
-    def add(self, toadd, depth):
+    def add(self, toadd, depth, hasher):
         return TerminalNode(toadd)
 
-    def remove(self, toremove, depth):
+    def remove(self, toremove, depth, hasher):
         return self
 
     def is_included(self, tocheck, depth, p):
         p.append(EMPTY)
         return False
 
+    def is_included_many(self, tochecks, depth, p, found):
+        p.append(EMPTY)
+
+    def prefix_query(self, prefix, depth, d, p, found):
+        p.append(EMPTY)
+
     def other_included(self, tocheck, depth, p, collapse):
         p.append(EMPTY)
 
@@ -145,24 +223,24 @@ class TerminalNode:
     def is_double(self):
         raise SetError()
 
-    def add(self, toadd, depth):
+    def add(self, toadd, depth, hasher):
         if toadd == self.hash:
             return self
         if toadd > self.hash:
-            return self._make_middle([self, TerminalNode(toadd)], depth)
+            return self._make_middle([self, TerminalNode(toadd)], depth, hasher)
         else:
-            return self._make_middle([TerminalNode(toadd), self], depth)
+            return self._make_middle([TerminalNode(toadd), self], depth, hasher)
 
-    def _make_middle(self, children, depth):
+    def _make_middle(self, children, depth, hasher):
         cbits = [get_bit(child.hash, depth) for child in children]
         if cbits[0] != cbits[1]:
-            return MiddleNode(children)
+            return MiddleNode(children, hasher)
         nextvals = [None, None]
         nextvals[cbits[0] ^ 1] = _empty
-        nextvals[cbits[0]] = self._make_middle(children, depth + 1)
-        return MiddleNode(nextvals)
+        nextvals[cbits[0]] = self._make_middle(children, depth + 1, hasher)
+        return MiddleNode(nextvals, hasher)
 
-    def remove(self, toremove, depth):
+    def remove(self, toremove, depth, hasher):
         if toremove == self.hash:
             return _empty
         return self
@@ -171,6 +249,16 @@ class TerminalNode:
         proof.append(TERMINAL + self.hash)
         return tocheck == self.hash
 
+    def is_included_many(self, tochecks, depth, proof, found):
+        proof.append(TERMINAL + self.hash)
+        if self.hash in tochecks:
+            found.add(self.hash)
+
+    def prefix_query(self, prefix, depth, d, proof, found):
+        proof.append(TERMINAL + self.hash)
+        if all(get_bit(self.hash, i) == get_bit(prefix, i) for i in range(depth)):
+            found.append(self.hash)
+
     def other_included(self, tocheck, depth, p, collapse):
         p.append(TERMINAL + self.hash)
 
@@ -180,7 +268,7 @@ class TerminalNode:
             assert get_bit(self.hash, pos) == v
 
 class MiddleNode:
-    def __init__(self, children):
+    def __init__(self, children, hasher):
         self.children = children
         if children[0].is_empty() and children[1].is_double():
             self.hash = children[1].hash
@@ -193,7 +281,7 @@ class MiddleNode:
                 raise SetError
             if children[0].is_terminal() and children[1].is_terminal() and children[0].hash >= children[1].hash:
                 raise SetError
-            self.hash = hashdown(children[0].get_hash() + children[1].get_hash())
+            self.hash = hasher.hashdown(children[0].get_hash() + children[1].get_hash())
 
     def get_hash(self):
         return MIDDLE + self.hash
@@ -211,20 +299,20 @@ class MiddleNode:
             return self.children[0].is_double()
         return self.children[0].is_terminal() and self.children[1].is_terminal()
 
-    def add(self, toadd, depth):
+    def add(self, toadd, depth, hasher):
         bit = get_bit(toadd, depth)
         child = self.children[bit]
-        newchild = child.add(toadd, depth + 1)
+        newchild = child.add(toadd, depth + 1, hasher)
         if newchild is child:
             return self
         newvals = [x for x in self.children]
         newvals[bit] = newchild
-        return MiddleNode(newvals)
+        return MiddleNode(newvals, hasher)
 
-    def remove(self, toremove, depth):
+    def remove(self, toremove, depth, hasher):
         bit = get_bit(toremove, depth)
         child = self.children[bit]
-        newchild = child.remove(toremove, depth + 1)
+        newchild = child.remove(toremove, depth + 1, hasher)
         if newchild is child:
             return self
         otherchild = self.children[bit ^ 1]
@@ -234,7 +322,7 @@ class MiddleNode:
             return newchild
         newvals = [x for x in self.children]
         newvals[bit] = newchild
-        return MiddleNode(newvals)
+        return MiddleNode(newvals, hasher)
 
     def is_included(self, tocheck, depth, p):
         p.append(MIDDLE)
@@ -246,6 +334,31 @@ class MiddleNode:
             self.children[0].other_included(tocheck, depth + 1, p, not self.children[1].is_empty())
             return self.children[1].is_included(tocheck, depth + 1, p)
 
+    def is_included_many(self, tochecks, depth, p, found):
+        p.append(MIDDLE)
+        zeros = [x for x in tochecks if get_bit(x, depth) == 0]
+        ones = [x for x in tochecks if get_bit(x, depth) == 1]
+        if len(zeros) > 0:
+            self.children[0].is_included_many(zeros, depth + 1, p, found)
+        else:
+            self.children[0].other_included(ones[0], depth + 1, p, not self.children[1].is_empty())
+        if len(ones) > 0:
+            self.children[1].is_included_many(ones, depth + 1, p, found)
+        else:
+            self.children[1].other_included(zeros[0], depth + 1, p, not self.children[0].is_empty())
+
+    def prefix_query(self, prefix, depth, d, p, found):
+        p.append(MIDDLE)
+        if d >= depth:
+            self.children[0].prefix_query(prefix, depth, d + 1, p, found)
+            self.children[1].prefix_query(prefix, depth, d + 1, p, found)
+        elif get_bit(prefix, d) == 0:
+            self.children[0].prefix_query(prefix, depth, d + 1, p, found)
+            self.children[1].other_included(prefix, d + 1, p, not self.children[0].is_empty())
+        else:
+            self.children[0].other_included(prefix, d + 1, p, not self.children[1].is_empty())
+            self.children[1].prefix_query(prefix, depth, d + 1, p, found)
+
     def other_included(self, tocheck, depth, p, collapse):
         if collapse or not self.is_double():
             p.append(TRUNCATED + self.hash)
@@ -275,54 +388,171 @@ class TruncatedNode:
     def is_included(self, tocheck, depth, p):
         raise SetError()
 
+    def is_included_many(self, tochecks, depth, p, found):
+        raise SetError()
+
+    def prefix_query(self, prefix, depth, d, p, found):
+        raise SetError()
+
     def other_included(self, tocheck, depth, p, collapse):
         p.append(TRUNCATED + self.hash)
 
 class SetError(BaseException):
     pass
 
-def confirm_included(root, val, proof):
-    return confirm_not_included_already_hashed(root, sha256(val).digest(), proof)
+def confirm_included(root, val, proof, hasher = default_hasher):
+    return confirm_included_already_hashed(root, hasher.hash_value(val), proof, hasher)
 
-def confirm_included_already_hashed(root, val, proof):
-    return _confirm(root, val, proof, True)
+def confirm_included_already_hashed(root, val, proof, hasher = default_hasher):
+    return _confirm(root, val, proof, True, hasher)
 
-def confirm_not_included(root, val, proof):
-    return confirm_not_included_already_hashed(root, sha256(val).digest(), proof)
+def confirm_not_included(root, val, proof, hasher = default_hasher):
+    return confirm_not_included_already_hashed(root, hasher.hash_value(val), proof, hasher)
 
-def confirm_not_included_already_hashed(root, val, proof):
-    return _confirm(root, val, proof, False)
+def confirm_not_included_already_hashed(root, val, proof, hasher = default_hasher):
+    return _confirm(root, val, proof, False, hasher)
 
-def _confirm(root, val, proof, expected):
+def _confirm(root, val, proof, expected, hasher):
     try:
-        p = deserialize_proof(proof)
+        r, included = verify_proof(val, proof, hasher)
+        return r == root and included == expected
+    except SetError:
+        return False
+
+# Works the same as deserialize_proof followed by get_root and is_included_already_hashed
+# but in a single pass over the proof with an explicit stack instead of building nodes
+# returns (root, whether val is included)
+def verify_proof(val, proof, hasher = default_hasher):
+    proof = memoryview(proof)
+    target = int.from_bytes(val, 'big')
+    # for each middle which isn't finished, whether its first child is finished
+    sides = bytearray()
+    # type, hash and whether it's a double for each finished first child
+    types = bytearray()
+    hashes = []
+    doubles = bytearray()
+    # the bits leading to the current position
+    prefix = 0
+    included = None
+    pos = 0
+    while True:
+        depth = len(sides)
+        if pos >= len(proof):
+            raise SetError()
+        t = proof[pos]
+        if t == 2:
+            # children of a middle at depth 256 would have nothing left to split on
+            if depth >= 256:
+                raise SetError()
+            sides.append(0)
+            prefix <<= 1
+            pos += 1
+            continue
+        on_path = target >> (256 - depth) == prefix
+        if t == 0:
+            h = BLANK
+            pos += 1
+            if on_path:
+                included = False
+        elif t == 1 or t == 3:
+            if pos + 33 > len(proof):
+                raise SetError()
+            h = proof[pos + 1:pos + 33]
+            pos += 33
+            if t == 3:
+                if on_path:
+                    raise SetError()
+                t = 2
+            else:
+                if depth > 0 and int.from_bytes(h, 'big') >> (256 - depth) != prefix:
+                    raise SetError()
+                if on_path:
+                    included = h == val
+        else:
+            raise SetError()
+        double = 0
+        while len(sides) > 0 and sides[-1] == 1:
+            sides.pop()
+            prefix >>= 1
+            t, h, double = _verify_middle(types.pop(), hashes.pop(), doubles.pop(), t, h, double, hasher)
+        if len(sides) == 0:
+            break
+        sides[-1] = 1
+        prefix |= 1
+        types.append(t)
+        hashes.append(h)
+        doubles.append(double)
+    if pos != len(proof):
+        raise SetError()
+    if t == 0:
+        return BLANK, included
+    if t == 1:
+        return hasher.compress_root(TERMINAL + h), included
+    return bytes(h), included
+
+# Follows the same rules as MiddleNode, returns (type, hash, whether it's a double)
+def _verify_middle(t0, h0, double0, t1, h1, double1, hasher):
+    if t0 == 0 and double1:
+        return 2, h1, 1
+    if t1 == 0 and double0:
+        return 2, h0, 1
+    if t0 == 0 and t1 != 2:
+        raise SetError()
+    if t1 == 0 and t0 == 1:
+        raise SetError()
+    if t0 == 1 and t1 == 1 and bytes(h0) >= bytes(h1):
+        raise SetError()
+    return 2, hasher.hashdown(bytes([t0]) + h0 + bytes([t1]) + h1), int(t0 == 1 and t1 == 1)
+
+# expected is a list of booleans, one for each of vals
+def confirm_many_already_hashed(root, vals, expected, proof, hasher = default_hasher):
+    try:
+        p = deserialize_proof(proof, hasher)
         if p.get_root() != root:
             return False
-        r, junk = p.is_included_already_hashed(val)
-        return r == expected
+        r, junk = p.is_included_many_already_hashed(vals)
+        return r == [bool(x) for x in expected]
     except SetError:
         return False
 
-def deserialize_proof(proof):
+# things is everything whose first depth bits are the same as prefix's, in any order
+def confirm_prefix_already_hashed(root, prefix, depth, things, proof, hasher = default_hasher):
     try:
-        r, pos = _deserialize(proof, 0, [])
+        p = deserialize_proof(proof, hasher)
+        if p.get_root() != root:
+            return False
+        r, junk = p.prefix_query(prefix, depth)
+        return r == sorted(things)
+    except SetError:
+        return False
+
+def deserialize_proof(proof, hasher = default_hasher):
+    proof = bytes(proof)
+    try:
+        r, pos = _deserialize(proof, 0, [], hasher)
         if pos != len(proof):
             raise SetError()
-        return ReferenceMerkleSet(r)
+        return ReferenceMerkleSet(r, hasher)
     except IndexError:
         raise SetError()
 
-def _deserialize(proof, pos, bits):
+def _deserialize(proof, pos, bits, hasher):
     t = proof[pos:pos + 1]
     if t == EMPTY:
         return _empty, pos + 1
-    if t == TERMINAL:
-        return TerminalNode(proof[pos + 1:pos + 33], bits), pos + 33
-    if t == TRUNCATED:
-        return TruncatedNode(proof[pos + 1:pos + 33]), pos + 33
+    if t == TERMINAL or t == TRUNCATED:
+        h = proof[pos + 1:pos + 33]
+        if len(h) != 32:
+            raise SetError()
+        if t == TRUNCATED:
+            return TruncatedNode(h), pos + 33
+        # proofs aren't trusted, so this is checked here instead of asserted by TerminalNode
+        if any(get_bit(h, i) != v for i, v in enumerate(bits)):
+            raise SetError()
+        return TerminalNode(h), pos + 33
     if t != MIDDLE:
         raise SetError()
-    v0, pos = _deserialize(proof, pos + 1, bits + [0])
-    v1, pos = _deserialize(proof, pos, bits + [1])
-    return MiddleNode([v0, v1]), pos
+    v0, pos = _deserialize(proof, pos + 1, bits + [0], hasher)
+    v1, pos = _deserialize(proof, pos, bits + [1], hasher)
+    return MiddleNode([v0, v1], hasher), pos
 
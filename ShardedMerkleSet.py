@@ -0,0 +1,209 @@
+from multiprocessing import Pipe, Process
+
+from ReferenceMerkleSet import *
+from MerkleSet import MerkleSet, _finish_proof, _quick_summary
+
+__all__ = ['ShardedMerkleSet']
+
+"""
+A set which is split between 2 ** bits processes by the first bits of each hash, each 
+of which keeps a MerkleSet of its part. Roots and proofs are the same as for a single 
+MerkleSet holding everything.
+
+The shards make up the nodes at depth bits. The nodes above them are only ever 
+calculated on demand from what the shards report about their nodes.
+"""
+
+# Runs in the shard processes, calls methods on this shard's set for whatever it's sent
+# request: name args wants_reply, None to stop
+# reply: error result, error is the first exception since the last reply or None
+def _serve(conn, depth, leaf_units, hasher):
+    mset = MerkleSet(depth, leaf_units, hasher = hasher)
+    error = None
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        name, args, wants_reply = request
+        r = None
+        try:
+            r = getattr(mset, name)(*args)
+        except Exception as e:
+            # requests which don't get a reply have their errors passed on with the next one
+            if error is None:
+                error = e
+        if wants_reply:
+            conn.send((error, r))
+            error = None
+    conn.close()
+
+# Raises the error in a reply from a shard, returns the result otherwise
+def _result(reply):
+    error, r = reply
+    if error is not None:
+        raise error
+    return r
+
+class ShardedMerkleSet:
+    # depth and leaf_units are for the MerkleSet in each shard
+    def __init__(self, bits, depth, leaf_units, hasher = default_hasher):
+        self.bits = bits
+        self.hasher = hasher
+        self.conns = []
+        self.processes = []
+        for i in range(2 ** bits):
+            conn, child_conn = Pipe()
+            p = Process(target = _serve, args = (child_conn, depth, leaf_units, hasher), daemon = True)
+            p.start()
+            child_conn.close()
+            self.conns.append(conn)
+            self.processes.append(p)
+        # (summary, things) from get_prefix_node on every shard, None when out of date
+        self.infos = None
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(None)
+        for p in self.processes:
+            p.join()
+        for conn in self.conns:
+            conn.close()
+
+    def _shard(self, thing):
+        return int.from_bytes(thing, 'big') >> (256 - self.bits)
+
+    # Requests to one shard are handled in order, so changes don't need to wait for a reply
+    def _send(self, shard, name, *args):
+        self.conns[shard].send((name, args, False))
+        self.infos = None
+
+    # Raises anything the shard ran into since it last replied, including with changes sent 
+    # to it before
+    def _call(self, shard, name, *args):
+        self.conns[shard].send((name, args, True))
+        return _result(self.conns[shard].recv())
+
+    # Asks every shard at once and waits for all the answers
+    def _call_all(self, name, args):
+        for shard, conn in enumerate(self.conns):
+            conn.send((name, args[shard], True))
+        replies = [conn.recv() for conn in self.conns]
+        return [_result(reply) for reply in replies]
+
+    # Convenience function
+    def add(self, toadd):
+        return self.add_already_hashed(self.hasher.hash_value(toadd))
+
+    def add_already_hashed(self, toadd):
+        self._send(self._shard(toadd), 'add_already_hashed', bytes(toadd))
+
+    def add_many_already_hashed(self, toadds):
+        for shard, things in enumerate(self._partition(toadds)):
+            if len(things) > 0:
+                self._send(shard, 'add_many_already_hashed', things)
+
+    # Convenience function
+    def remove(self, toremove):
+        return self.remove_already_hashed(self.hasher.hash_value(toremove))
+
+    def remove_already_hashed(self, toremove):
+        self._send(self._shard(toremove), 'remove_already_hashed', bytes(toremove))
+
+    def remove_many_already_hashed(self, toremoves):
+        for shard, things in enumerate(self._partition(toremoves)):
+            if len(things) > 0:
+                self._send(shard, 'remove_many_already_hashed', things)
+
+    def _partition(self, things):
+        r = [[] for conn in self.conns]
+        for thing in things:
+            r[self._shard(thing)].append(bytes(thing))
+        return r
+
+    # The shards all calculate their roots at the same time
+    def _get_infos(self):
+        if self.infos is None:
+            prefixes = [(int.to_bytes(i << (256 - self.bits), 32, 'big'), self.bits) for i in range(len(self.conns))]
+            self.infos = self._call_all('get_prefix_node', prefixes)
+        return self.infos
+
+    def get_root(self):
+        return self.hasher.compress_root(self._summary(0, 0, len(self.conns), self._get_infos())[0])
+
+    # returns (summary, count) for the node at depth which covers shards lo through hi - 1
+    # count stops at 3
+    def _summary(self, depth, lo, hi, infos):
+        if hi - lo == 1:
+            summary, things = infos[lo]
+            return summary, 3 if things is None else len(things)
+        mid = (lo + hi) // 2
+        s0, n0 = self._summary(depth + 1, lo, mid, infos)
+        s1, n1 = self._summary(depth + 1, mid, hi, infos)
+        if n0 + n1 <= 1:
+            return (s0, n0) if n0 == 1 else (s1, n1)
+        if n0 + n1 == 2 and n0 != 1:
+            # two things which are already a node with two terminals
+            return (s0, n0) if n0 == 2 else (s1, n1)
+        return MIDDLE + self.hasher.hashdown(s0 + s1), min(3, n0 + n1)
+
+    # Convenience function
+    def is_included(self, tocheck):
+        return self.is_included_already_hashed(self.hasher.hash_value(tocheck))
+
+    # returns (boolean, proof string)
+    def is_included_already_hashed(self, tocheck):
+        tocheck = bytes(tocheck)
+        infos = self._get_infos()
+        root, count = self._summary(0, 0, len(self.conns), infos)
+        if count == 0:
+            return False, EMPTY
+        if count == 1:
+            return tocheck == root[1:], root
+        buf = []
+        r = self._is_included(tocheck, 0, 0, len(self.conns), infos, buf)
+        return r, b''.join([bytes(x) for x in buf])
+
+    # the node must have at least two things in it
+    # returns boolean, appends to buf
+    def _is_included(self, tocheck, depth, lo, hi, infos, buf):
+        full = [i for i in range(lo, hi) if infos[i][1] != []]
+        if len(full) == 1:
+            # the shard has the same node, after a chain of ones with an empty sibling
+            r, proof = self._call(full[0], 'is_included_already_hashed', tocheck)
+            buf.append(_strip_chain(proof, tocheck, depth))
+            return r
+        things = [x for i in full for x in (infos[i][1] or [None, None, None])]
+        buf.append(MIDDLE)
+        if len(things) == 2:
+            # the whole node is two terminals
+            _finish_proof(TERMINAL + things[0] + TERMINAL + things[1], depth, buf)
+            return tocheck in things
+        mid = (lo + hi) // 2
+        s0, n0 = self._summary(depth + 1, lo, mid, infos)
+        s1, n1 = self._summary(depth + 1, mid, hi, infos)
+        if get_bit(tocheck, depth) == 0:
+            if n0 < 2:
+                _finish_proof(s0 + s1, depth, buf)
+                return tocheck == s0[1:] and n0 == 1
+            r = self._is_included(tocheck, depth + 1, lo, mid, infos, buf)
+            buf.append(_quick_summary(s1))
+            return r
+        else:
+            if n1 < 2:
+                _finish_proof(s0 + s1, depth, buf)
+                return tocheck == s1[1:] and n1 == 1
+            buf.append(_quick_summary(s0))
+            return self._is_included(tocheck, depth + 1, mid, hi, infos, buf)
+
+# Takes the proof of a node from the top of a set where everything shares its first depth 
+# bits with tocheck, and returns the proof of the same node at depth
+def _strip_chain(proof, tocheck, depth):
+    for d in range(depth):
+        assert proof[:1] == MIDDLE
+        if get_bit(tocheck, d) == 0:
+            assert proof[-1:] == EMPTY
+            proof = proof[1:-1]
+        else:
+            assert proof[1:2] == EMPTY
+            proof = proof[2:]
+    return proof
@@ -1,5 +1,16 @@
+from hashlib import blake2s
 from ReferenceMerkleSet import *
 from MerkleSet import *
+from ShardedMerkleSet import *
+from LoggedMerkleSet import *
+from multiprocessing import shared_memory
+from multiprocessing.connection import Client, Listener
+import gc
+import io
+import os
+import pickle
+import tempfile
+import threading
 
 def from_bytes(f):
     return int.from_bytes(f, 'big')
@@ -10,12 +21,20 @@ def to_bytes(f, v):
 # Add numhashes things, only checking the hash halfway through to test lazy evaluation
 def _testlazy(numhashes, mset, roots, proofss):
     hashes = [blake2b(to_bytes(i, 10)).digest()[:32] for i in range(numhashes)]
+    batches = []
+    def batch(mystrs):
+        assert len(mystrs) > 0
+        batches.append(len(mystrs))
+        return hash_batch(mystrs)
+    mset.hash_batch = batch
     checkpoint = numhashes // 2
     for i in range(numhashes - 1):
         if i == checkpoint:
             r, proof = mset.is_included_already_hashed(hashes[checkpoint // 2])
             assert r
             assert proof == proofss[i][checkpoint // 2]
+            # nodes at the same depth get hashed together
+            assert len(batches) < sum(batches)
         mset.add_already_hashed(hashes[i])
         mset._audit(hashes[:i + 1])
     r, proof = mset.is_included_already_hashed(hashes[checkpoint])
@@ -89,13 +108,881 @@ def _testmset(numhashes, mset, oldroots = None, oldproofss = None):
                 assert proof == proofss[i][j]
     return roots, proofss
 
+# Add and remove things in batches of increasing size, comparing to roots and proofs from one at a time
+def _testmany(numhashes, mset, roots, proofss):
+    hashes = [blake2b(to_bytes(i, 10)).digest()[:32] for i in range(numhashes)]
+    i = 0
+    step = 1
+    while i < numhashes:
+        end = min(numhashes, i + step)
+        # include some repeats and pass them out of order
+        mset.add_many_already_hashed(list(reversed(hashes[i:end])) + hashes[max(0, i - 2):i + 1])
+        mset._audit(hashes[:end])
+        if end < numhashes:
+            assert roots[end] == mset.get_root()
+            for j in range(numhashes):
+                r, proof = mset.is_included_already_hashed(hashes[j])
+                assert r == (j < end)
+                assert proof == proofss[end][j]
+        i = end
+        step += 1
+    mset.add_many_already_hashed([])
+    mset._audit(hashes)
+    # Remove them in batches as well, including some which were already removed
+    end = numhashes
+    step = 1
+    while end > 0:
+        i = max(0, end - step)
+        mset.remove_many_already_hashed(hashes[i:end] + hashes[end:end + 2])
+        mset._audit(hashes[:i])
+        assert roots[i] == mset.get_root()
+        for j in range(numhashes):
+            r, proof = mset.is_included_already_hashed(hashes[j])
+            assert r == (j < i)
+            assert proof == proofss[i][j]
+        end = i
+        step += 1
+    mset.remove_many_already_hashed(hashes)
+    mset._audit([])
+    # Freed blocks get reused
+    mset.add_many_already_hashed(hashes)
+    top = mset.arena.top
+    mset.remove_many_already_hashed(hashes)
+    mset.add_many_already_hashed(hashes)
+    mset._audit(hashes)
+    assert mset.arena.top == top
+    mset.remove_many_already_hashed(hashes)
+
+# Build sets straight from sorted streams, including repeats, comparing to roots from one at a time
+def _testsorted(numhashes, depth, leaf_units, roots):
+    hashes = [blake2b(to_bytes(i, 10)).digest()[:32] for i in range(numhashes)]
+    for i in [0, 1, 2, 3, 4, 5, numhashes // 2, numhashes - 1]:
+        stream = (h for h in sorted(hashes[:i] + hashes[:i // 3]))
+        mset = MerkleSet.from_sorted_hashes(stream, depth, leaf_units)
+        mset._audit(hashes[:i])
+        assert roots[i] == mset.get_root()
+
+# Look up many things at once at a range of sizes, comparing to the reference implementation
+def _testmultiproof(numhashes, mset):
+    hashes = [blake2b(to_bytes(i, 10)).digest()[:32] for i in range(numhashes)]
+    ref = ReferenceMerkleSet()
+    for i in [0, 1, 2, 3, 5, numhashes // 4, numhashes // 2]:
+        for h in hashes[:i]:
+            ref.add_already_hashed(h)
+        mset.add_many_already_hashed(hashes[:i])
+        for queries in [[], hashes[:1], hashes[i:i + 1], hashes[:i + 3], hashes[::-7] + hashes[:2]]:
+            r, proof = mset.is_included_many_already_hashed(queries)
+            assert (r, proof) == ref.is_included_many_already_hashed(queries)
+            assert r == [hashes.index(q) < i for q in queries]
+            if len(queries) == 1:
+                assert proof == mset.is_included_already_hashed(queries[0])[1]
+            assert confirm_many_already_hashed(mset.get_root(), queries, r, proof)
+            if len(queries) > 0:
+                assert not confirm_many_already_hashed(mset.get_root(), queries, r[:-1] + [not r[-1]], proof)
+                assert not confirm_many_already_hashed(mset.get_root(), queries + [hashes[-1]], r + [True], proof)
+            assert not confirm_many_already_hashed(hashes[-1], queries, r, proof)
+            p = deserialize_proof(proof)
+            assert p.get_root() == mset.get_root()
+            for q in queries:
+                assert p.is_included_already_hashed(q)[0] == (hashes.index(q) < i)
+
+# Calculate roots split between worker processes
+def _testworkers(numhashes, mset, roots):
+    hashes = [blake2b(to_bytes(i, 10)).digest()[:32] for i in range(numhashes)]
+    mset.add_many_already_hashed(hashes[:numhashes - 1])
+    assert mset.get_root(workers = 2) == roots[numhashes - 1]
+    mset._audit(hashes[:numhashes - 1])
+    # the same workers get used again
+    pool = mset.workers[0]
+    mset.remove_many_already_hashed(hashes[numhashes // 2:])
+    assert mset.get_root(workers = 2) == roots[numhashes // 2]
+    assert mset.workers[0] is pool
+    mset.add_already_hashed(hashes[numhashes // 2])
+    assert mset.get_root(workers = 3) == roots[numhashes // 2 + 1]
+    mset._audit(hashes[:numhashes // 2 + 1])
+    mset.stop_workers()
+    assert mset.workers is None
+    # they're let go of when the set is garbage collected too
+    other = MerkleSet(2, 4)
+    other.add_many_already_hashed(hashes[:numhashes - 1])
+    assert other.get_root(workers = 2) == roots[numhashes - 1]
+    name = other.workers[2].name
+    del other
+    gc.collect()
+    try:
+        shared_memory.SharedMemory(name = name)
+        assert False
+    except FileNotFoundError:
+        pass
+
+# Iterate in order from the start and from places along the way, including while adding
+def _testiter(numhashes, mset):
+    hashes = [blake2b(to_bytes(i, 10)).digest()[:32] for i in range(numhashes)]
+    for i in range(numhashes):
+        if i % 19 == 0:
+            have = sorted(hashes[:i])
+            assert list(mset) == have
+            for j in range(0, numhashes, 11):
+                assert list(mset.iter_sorted(hashes[j])) == [x for x in have if x >= hashes[j]]
+        mset.add_already_hashed(hashes[i])
+    snapshot = mset.snapshot()
+    mset.remove_many_already_hashed(hashes[:numhashes // 2])
+    assert list(mset) == sorted(hashes[numhashes // 2:])
+    assert list(snapshot.iter_sorted(bytes(32))) == sorted(hashes)
+    snapshot.release()
+
+# Query prefixes of a range of lengths, comparing to the reference implementation
+def _testprefix(numhashes, mset):
+    hashes = [blake2b(to_bytes(i, 10)).digest()[:32] for i in range(numhashes)]
+    ref = ReferenceMerkleSet()
+    for i in [0, 1, 2, 3, 5, numhashes // 4, numhashes - 1]:
+        for h in hashes[:i]:
+            ref.add_already_hashed(h)
+        mset.add_many_already_hashed(hashes[:i])
+        root = mset.get_root()
+        for prefix in [bytes(32), hashes[0], hashes[-1], hashes[i // 2]]:
+            for depth in [0, 1, 3, 6, 8, 40, 256]:
+                things, proof = mset.prefix_query(prefix, depth)
+                assert (things, proof) == ref.prefix_query(prefix, depth)
+                assert things == sorted(x for x in hashes[:i] if x[:depth // 8] == prefix[:depth // 8] and 
+                        from_bytes(x) >> (256 - depth) == from_bytes(prefix) >> (256 - depth))
+                assert confirm_prefix_already_hashed(root, prefix, depth, things, proof)
+                assert confirm_many_already_hashed(root, things, [True] * len(things), proof)
+                if len(things) > 0:
+                    assert not confirm_prefix_already_hashed(root, prefix, depth, things[1:], proof)
+                assert not confirm_prefix_already_hashed(root, prefix, depth, things + [hashes[-1]], proof)
+                # a proof which leaves things out isn't enough
+                single = mset.is_included_already_hashed(things[0])[1] if len(things) > 0 else proof
+                if single != proof:
+                    assert not confirm_prefix_already_hashed(root, prefix, depth, things, single)
+
+# Remove prefixes of a range of lengths, comparing to removing one at a time from the reference implementation
+def _testremoveprefix(numhashes, mset):
+    hashes = [blake2b(to_bytes(i, 10)).digest()[:32] for i in range(numhashes)]
+    def matches(x, prefix, depth):
+        return depth == 0 or from_bytes(x) >> (256 - depth) == from_bytes(prefix) >> (256 - depth)
+    for i in [1, 2, 3, 5, numhashes // 4, numhashes]:
+        for prefix in [hashes[0], hashes[i // 2], hashes[-1]]:
+            for depth in [256, 40, 8, 4, 3, 2, 1, 0]:
+                have = hashes[:i]
+                mset.add_many_already_hashed(have)
+                if depth % 2 == 0:
+                    mset.get_root()
+                snapshot = mset.snapshot() if depth in (40, 8, 3, 1) else None
+                # blocks which a snapshot shares and which get dropped are retired as they are, 
+                # not copied first, and with this many left under short prefixes nothing collapses so 
+                # every copy is kept
+                copies = []
+                def copy_block(block, copy = mset._copy_block):
+                    copies.append(copy(block))
+                    return copies[-1]
+                mset._copy_block = copy_block
+                mset.remove_prefix(prefix, depth)
+                del mset._copy_block
+                if i >= numhashes // 4 and depth < 8:
+                    assert all(mset.arena.tag(c) != 0 for c in copies)
+                have = [x for x in have if not matches(x, prefix, depth)]
+                ref = ReferenceMerkleSet()
+                for h in have:
+                    ref.add_already_hashed(h)
+                mset._audit(have)
+                assert mset.get_root() == ref.get_root()
+                if snapshot is not None:
+                    assert len(snapshot) == i
+                    snapshot.release()
+                    # there's nothing under the prefix any more, so removing it again copies nothing
+                    snapshot = mset.snapshot()
+                    blocks = sorted(mset.arena.blocks())
+                    retired = list(mset.retired)
+                    mset.remove_prefix(prefix, depth)
+                    assert sorted(mset.arena.blocks()) == blocks
+                    assert mset.retired == retired
+                    snapshot.release()
+                mset.remove_many_already_hashed(hashes)
+                assert mset.arena.blocks() == []
+
+# Dump and load sets of a range of sizes, and make sure damaged dumps are caught
+def _testdump(numhashes, depth, leaf_units, roots):
+    hashes = [blake2b(to_bytes(i, 10)).digest()[:32] for i in range(numhashes)]
+    for i in [0, 1, 2, 3, 10, numhashes - 1]:
+        mset = MerkleSet(2, 4)
+        mset.add_many_already_hashed(hashes[:i])
+        f = io.BytesIO()
+        mset.dump(f, chunk_size = 7)
+        f.seek(0)
+        loaded = MerkleSet.load(f, depth, leaf_units)
+        loaded._audit(hashes[:i])
+        assert loaded.get_root() == roots[i]
+        assert f.read() == b''
+        bad = f.getvalue()
+        # everything but the flag saying whether there's a root is checked
+        for k in list(range(8, len(bad) - 33, max(1, len(bad) // 20))) + [len(bad) - 32, len(bad) - 1]:
+            for damaged in [bad[:k], bad[:k] + bytes([bad[k] ^ 1]) + bad[k + 1:]]:
+                try:
+                    MerkleSet.load(io.BytesIO(damaged), depth, leaf_units)
+                    assert False
+                except SetError:
+                    pass
+    f = io.BytesIO()
+    mset.dump(f, with_root = False)
+    f.seek(0)
+    assert MerkleSet.load(f, depth, leaf_units).get_root() == roots[numhashes - 1]
+    # chunks with more than fit in the count are refused before anything is written
+    for size in [0, 65536]:
+        f = io.BytesIO()
+        try:
+            mset.dump(f, chunk_size = size)
+            assert False
+        except ValueError:
+            pass
+        assert f.getvalue() == b''
+    # shared prefixes are only stored once
+    mset = MerkleSet(2, 4)
+    mset.add_many_already_hashed([bytes(20) + h[:12] for h in hashes])
+    f = io.BytesIO()
+    mset.dump(f)
+    assert len(f.getvalue()) < 16 * numhashes
+    f.seek(0)
+    assert MerkleSet.load(f, depth, leaf_units).get_root() == mset.get_root()
+
+# Stop writing at various points and make sure what's reopened has exactly what was committed
+def _testlogged(numhashes, depth, leaf_units, roots):
+    hashes = [blake2b(to_bytes(i, 10)).digest()[:32] for i in range(numhashes)]
+    with tempfile.TemporaryDirectory() as d:
+        lset = LoggedMerkleSet(d, depth, leaf_units, group_size = 7)
+        for i in range(numhashes // 2):
+            lset.add_already_hashed(hashes[i])
+        lset.commit()
+        lset.add_many_already_hashed(hashes[numhashes // 2:numhashes - 1])
+        lset.remove_many_already_hashed(hashes[numhashes // 2:numhashes - 1])
+        lset.add_already_hashed(hashes[numhashes // 2])
+        # gone without committing the last one or flushing the set
+        lset.log.close()
+        lset.mset.arena.close()
+        lset = LoggedMerkleSet(d, depth, leaf_units)
+        assert lset.get_root() == roots[numhashes // 2]
+        assert hashes[0] in lset
+        assert not lset.contains_already_hashed(hashes[numhashes // 2])
+        lset.checkpoint()
+        assert os.path.getsize(os.path.join(d, 'log')) == 0
+        lset.add_many_already_hashed(hashes[numhashes // 2:numhashes - 1])
+        lset.remove_already_hashed(hashes[0])
+        lset.add_already_hashed(hashes[0])
+        lset.commit()
+        with open(os.path.join(d, 'log'), 'rb') as f:
+            log = f.read()
+        # a chunk which was only partly written is dropped
+        lset.log.write(bytes([0, 0, 0, 33]) + bytes(30))
+        lset.log.close()
+        lset.mset.arena.close()
+        lset = LoggedMerkleSet(d, depth, leaf_units)
+        assert lset.get_root() == roots[numhashes - 1]
+        assert os.path.getsize(os.path.join(d, 'log')) == len(log)
+        # the log replays to the same thing on top of a newer checkpoint
+        lset.close()
+        with open(os.path.join(d, 'log'), 'wb') as f:
+            f.write(log)
+        lset = LoggedMerkleSet(d, depth, leaf_units)
+        assert lset.get_root() == roots[numhashes - 1]
+        lset.close()
+
+# Roll back and commit transactions, including ones which free blocks and copy ones a snapshot uses
+def _testtransactions(numhashes, mset, roots):
+    hashes = [blake2b(to_bytes(i, 10)).digest()[:32] for i in range(numhashes)]
+    half = numhashes // 2
+    # there's nothing to roll back outside of a transaction
+    try:
+        mset.rollback()
+        rolled = True
+    except AssertionError:
+        rolled = False
+    assert not rolled
+    mset.track_changes()
+    mset.add_many_already_hashed(hashes[:half])
+    mset.get_root()
+    arena = mset.arena
+    before = bytes(arena.memory[:arena.top])
+    free_lists = dict(arena.free_lists)
+    mset.begin()
+    mset.add_many_already_hashed(hashes[half:])
+    mset.remove_many_already_hashed(hashes[:half - 5])
+    assert mset.get_root() != roots[half]
+    mset.rollback()
+    assert bytes(arena.memory[:arena.top]) == before
+    assert arena.free_lists == free_lists
+    mset._audit(hashes[:half])
+    assert mset.get_root() == roots[half]
+    # the rolled back state isn't hashed yet at begin
+    mset.add_many_already_hashed(hashes[half:numhashes - 1])
+    mset.begin()
+    for h in hashes[:half]:
+        mset.remove_already_hashed(h)
+    mset.rollback()
+    assert mset.get_root() == roots[numhashes - 1]
+    snapshot = mset.snapshot()
+    mset.begin()
+    mset.remove_many_already_hashed(hashes)
+    mset.add_already_hashed(hashes[0])
+    mset.rollback()
+    mset._audit(hashes[:numhashes - 1])
+    assert mset.get_root() == roots[numhashes - 1]
+    mset.begin()
+    mset.remove_many_already_hashed(hashes[half:])
+    mset.commit()
+    snapshot.release()
+    mset._audit(hashes[:half])
+    assert mset.get_root() == roots[half]
+    mirror = {}
+    for block, contents in mset.drain_changes():
+        if contents is not None:
+            mirror[block] = contents
+    mset.begin()
+    mset.add_many_already_hashed(hashes[half:])
+    mset.remove_many_already_hashed(hashes[:10])
+    mset.rollback()
+    for block, contents in mset.drain_changes():
+        if contents is None:
+            mirror.pop(block, None)
+        else:
+            mirror[block] = contents
+    assert sorted(mirror) == arena.blocks()
+    for block in mirror:
+        assert mirror[block] == arena.memory[block:block + arena.size(block)]
+
+# Hash a bit at a time, with changes in between, and in a background thread
+def _testadvance(numhashes, mset, roots):
+    hashes = [blake2b(to_bytes(i, 10)).digest()[:32] for i in range(numhashes)]
+    half = numhashes // 2
+    assert mset.advance_root(0)
+    mset.add_many_already_hashed(hashes[:half])
+    steps = 0
+    while not mset.advance_root(3):
+        steps += 1
+        mset._audit(hashes[:half])
+    assert steps > 0
+    assert mset.advance_root(0)
+    assert mset.get_root() == roots[half]
+    mset.add_many_already_hashed(hashes[half:numhashes - 1])
+    assert not mset.advance_root(5)
+    mset.remove_many_already_hashed(hashes[half:])
+    mset.add_already_hashed(hashes[half])
+    assert not mset.advance_root(5)
+    while not mset.advance_root(budget_seconds = 0):
+        pass
+    mset._audit(hashes[:half + 1])
+    assert mset.get_root() == roots[half + 1]
+    lock = threading.Lock()
+    with lock:
+        mset.add_many_already_hashed(hashes[half + 1:numhashes - 1])
+        thread = mset.advance_root_in_background(lock, 2)
+    for h in hashes[:10]:
+        with lock:
+            mset.remove_already_hashed(h)
+            mset.add_already_hashed(h)
+    thread.join()
+    assert mset.get_root() == roots[numhashes - 1]
+    mset._audit(hashes[:numhashes - 1])
+    # Finding what to hash is spread out too, so each call only looks at about as many nodes 
+    # as it hashes, even when the set changes in between every call
+    mset.remove_many_already_hashed(hashes)
+    mset.add_many_already_hashed(hashes[:numhashes - 1])
+    looked = []
+    lazy_children = mset._lazy_children
+    def count(pos, block, moddepth):
+        looked.append(pos)
+        return lazy_children(pos, block, moddepth)
+    mset._lazy_children = count
+    for i in range(numhashes):
+        if mset.advance_root(32):
+            break
+        assert len(looked) <= 64
+        looked.clear()
+        if i % 2 == 0:
+            mset.add_already_hashed(hashes[-1])
+        else:
+            mset.remove_already_hashed(hashes[-1])
+    assert i < numhashes - 1
+    del mset._lazy_children
+    mset.remove_already_hashed(hashes[-1])
+    assert mset.get_root() == roots[numhashes - 1]
+    mset._audit(hashes[:numhashes - 1])
+
+# Check membership in between changes without the root ever being calculated
+def _testcontains(numhashes, mset):
+    hashes = [blake2b(to_bytes(i, 10)).digest()[:32] for i in range(numhashes)]
+    assert hashes[0] not in mset
+    have = set()
+    for i in range(numhashes):
+        mset.add_already_hashed(hashes[i])
+        have.add(hashes[i])
+        if i % 7 == 0:
+            mset.remove_already_hashed(hashes[i // 2])
+            have.discard(hashes[i // 2])
+        if i % 13 == 0 or i < 5:
+            for h in hashes:
+                assert (h in mset) == (h in have)
+            if len(have) > 1:
+                assert not mset.advance_root(0)
+    for h in hashes:
+        assert (bytearray(h) in mset) == (h in have)
+    snapshot = mset.snapshot()
+    mset.remove_many_already_hashed(hashes)
+    assert not any(h in mset for h in hashes)
+    for h in hashes:
+        assert (h in snapshot) == (h in have)
+    snapshot.release()
+    mset.add(b'a')
+    assert mset.contains(b'a') and not mset.contains(b'b')
+
+# Keep a copy of the blocks up to date from the changes, including across snapshots
+def _testchanges(numhashes, mset):
+    hashes = [blake2b(to_bytes(i, 10)).digest()[:32] for i in range(numhashes)]
+    mset.add_many_already_hashed(hashes[:10])
+    mirror = {}
+    def check():
+        for block, contents in mset.drain_changes():
+            if contents is None:
+                mirror.pop(block, None)
+            else:
+                mirror[block] = contents
+        retired = set(block for block, born, died in mset.retired)
+        inuse = [b for b in mset.arena.blocks() if b not in retired]
+        assert sorted(mirror) == inuse
+        for block in inuse:
+            assert mirror[block] == mset.arena.memory[block:block + mset.arena.size(block)]
+        assert list(mset.drain_changes()) == []
+    check()
+    snapshot = None
+    for i in range(10, numhashes):
+        mset.add_already_hashed(hashes[i])
+        if i % 17 == 0:
+            check()
+        if i % 50 == 0:
+            if snapshot is not None:
+                snapshot.release()
+            snapshot = mset.snapshot()
+    check()
+    mset.remove_many_already_hashed(hashes[:numhashes // 2])
+    check()
+    snapshot.release()
+    mset.remove_prefix(hashes[-1], 2)
+    check()
+    for i in range(numhashes // 2, numhashes):
+        mset.remove_already_hashed(hashes[i])
+    check()
+    assert mirror == {}
+
+# Merge sets made with different parameters which overlap by varying amounts, comparing to roots from one at a time
+def _testupdate(numhashes, depth, leaf_units, roots):
+    hashes = [blake2b(to_bytes(i, 10)).digest()[:32] for i in range(numhashes)]
+    for ours, start, end in [(0, 0, 0), (0, 0, 1), (1, 0, 2), (0, 0, numhashes - 1), (2, 1, 3), (numhashes // 2, 0, numhashes - 1), 
+            (numhashes // 2, numhashes // 2, numhashes - 1), (numhashes // 2, numhashes // 4, numhashes // 2 + 3), (numhashes - 1, 3, 10)]:
+        mset = MerkleSet(depth, leaf_units)
+        mset.add_many_already_hashed(hashes[:ours])
+        if ours % 2 == 0:
+            mset.get_root()
+        other = MerkleSet(3, 2)
+        other.add_many_already_hashed(hashes[start:end])
+        mset.update(other)
+        mset._audit(hashes[:max(ours, end)])
+        assert mset.get_root() == roots[max(ours, end)]
+        other._audit(hashes[start:end])
+    # from a snapshot into a set which has snapshots of its own
+    mset = MerkleSet(depth, leaf_units)
+    mset.add_many_already_hashed(hashes[:numhashes // 3])
+    mine = mset.snapshot()
+    other = MerkleSet(2, 4)
+    other.add_many_already_hashed(hashes[:numhashes - 1])
+    theirs = other.snapshot()
+    other.remove_many_already_hashed(hashes)
+    mset.update(theirs)
+    mset._audit(hashes[:numhashes - 1])
+    assert mset.get_root() == roots[numhashes - 1] == theirs.get_root()
+    assert mine.get_root() == roots[numhashes // 3]
+    mine.release()
+    theirs.release()
+    # hashes made with a different hasher can't be copied over
+    other = MerkleSet(2, 4, hasher = Hasher(blake2s))
+    other.add_many_already_hashed(hashes[:3])
+    try:
+        mset.update(other)
+        assert False
+    except SetError:
+        pass
+    mset._audit(hashes[:numhashes - 1])
+    mset.update(MerkleSet(2, 4, hasher = Hasher()))
+
+# Diff sets which differ by a few things, both directly and against one on the other end of a socket
+def _testdiff(numhashes, mset):
+    hashes = [blake2b(to_bytes(i, 10)).digest()[:32] for i in range(numhashes)]
+    other = MerkleSet(2, 4)
+    queries = []
+    get_prefix_nodes = other.get_prefix_nodes
+    def counting(q):
+        queries.extend(q)
+        return get_prefix_nodes(q)
+    other.get_prefix_nodes = counting
+    assert list(mset.diff(other)) == []
+    for ours, theirs in [(hashes[:1], []), (hashes, hashes), (hashes[1:], hashes[:-1]), (hashes[:numhashes // 2], hashes[3:])]:
+        mset.remove_many_already_hashed(hashes)
+        mset.add_many_already_hashed(ours)
+        other.remove_many_already_hashed(hashes)
+        other.add_many_already_hashed(theirs)
+        del queries[:]
+        r = sorted(mset.diff(other))
+        assert r == sorted([(x, True) for x in set(ours) - set(theirs)] + [(x, False) for x in set(theirs) - set(ours)])
+        # identical subtrees are never looked inside
+        assert len(queries) <= 1 + 2 * 256 * len(r)
+        assert sorted(other.diff(mset)) == sorted([(x, not included) for x, included in r])
+    with tempfile.TemporaryDirectory() as d:
+        with Listener(os.path.join(d, 'socket'), 'AF_UNIX') as listener:
+            t = threading.Thread(target = lambda: serve_prefix_nodes(other, listener.accept()))
+            t.start()
+            remote = RemoteSet(Client(os.path.join(d, 'socket'), 'AF_UNIX'))
+            assert sorted(mset.diff(remote)) == r
+            remote.close()
+            t.join()
+
+# Check counts along the way while adding and removing
+def _testcounts(numhashes, mset):
+    hashes = [blake2b(to_bytes(i, 10)).digest()[:32] for i in range(numhashes)]
+    def check(have):
+        have = sorted(have)
+        assert len(mset) == len(have)
+        for j in range(0, numhashes, 7):
+            assert mset.rank(hashes[j]) == len([x for x in have if x < hashes[j]])
+        for j in range(0, len(have), 5):
+            assert mset.select(j) == have[j]
+        # counts are kept up to date as things change so none of that needed any hashing
+        assert len(have) < 2 or not mset.advance_root(0)
+        mset._audit(have)
+    check([])
+    try:
+        mset.sample()
+        assert False
+    except IndexError:
+        pass
+    for i in range(numhashes):
+        if i % 13 == 0:
+            check(hashes[:i])
+        mset.add_already_hashed(hashes[i])
+    check(hashes)
+    assert mset.sample() in hashes
+    snapshot = mset.snapshot()
+    mset.remove_many_already_hashed(hashes[:numhashes // 2])
+    check(hashes[numhashes // 2:])
+    assert len(snapshot) == numhashes
+    assert snapshot.select(numhashes - 1) == max(hashes)
+    snapshot.release()
+    for i in range(numhashes // 2, numhashes):
+        mset.remove_already_hashed(hashes[i])
+        if i % 11 == 0:
+            check(hashes[i + 1:])
+    check([])
+
+# A different hash function has to give different roots which match the reference and 
+# proofs which only verify with the same hash function
+# Hashes nodes differently without using different hash states, so anything which doesn't go 
+# through hashdown gets it wrong
+class _FlippedHasher(Hasher):
+    def hashdown(self, mystr):
+        return bytes(x ^ 1 for x in Hasher.hashdown(self, mystr))
+
+    def hash_many(self, mystrs):
+        return [self.hashdown(x) for x in mystrs]
+
+def _testhasher(numhashes, mset):
+    hashes = [blake2b(to_bytes(i, 10)).digest()[:32] for i in range(numhashes)]
+    ref = ReferenceMerkleSet(hasher = mset.hasher)
+    default = ReferenceMerkleSet()
+    for i in range(numhashes):
+        mset.add_already_hashed(hashes[i])
+        ref.add_already_hashed(hashes[i])
+        default.add_already_hashed(hashes[i])
+    root = mset.get_root()
+    assert root == ref.get_root()
+    assert root != default.get_root()
+    assert MerkleSet.from_sorted_hashes(sorted(hashes), 2, 4, mset.hasher).get_root() == root
+    # the hasher gets pickled into the workers and has to come out as the same subclass
+    assert pickle.loads(pickle.dumps(mset.hasher)) == mset.hasher
+    other = MerkleSet(2, 4, hasher = mset.hasher)
+    other.add_many_already_hashed(hashes)
+    assert other.get_root(workers = 2) == root
+    other._audit(hashes)
+    other.stop_workers()
+    for j in range(0, numhashes, 17):
+        r, proof = mset.is_included_already_hashed(hashes[j])
+        assert r
+        assert confirm_included_already_hashed(root, hashes[j], proof, mset.hasher)
+        assert not confirm_included_already_hashed(root, hashes[j], proof)
+    mset.add(b'a')
+    r, proof = mset.is_included(b'a')
+    assert r
+    assert confirm_included(mset.get_root(), b'a', proof, mset.hasher)
+    assert not confirm_not_included(mset.get_root(), b'a', proof, mset.hasher)
+
+# Check along the way that the shards together match a single set
+def _testsharded(numhashes, mset, roots, proofss):
+    hashes = [blake2b(to_bytes(i, 10)).digest()[:32] for i in range(numhashes)]
+    for i in range(numhashes):
+        if i % 7 == 0 or i < 10:
+            assert mset.get_root() == roots[i]
+            for j in range(0, numhashes, 13):
+                r, proof = mset.is_included_already_hashed(hashes[j])
+                assert r == (j < i)
+                assert proof == proofss[i][j]
+        mset.add_already_hashed(hashes[i])
+    mset.remove_many_already_hashed(hashes[numhashes // 2:])
+    assert mset.get_root() == roots[numhashes // 2]
+    # Small sets and ones bunched up under a prefix, where shards only have a few things in 
+    # them, have the same proofs as a single set for things which aren't there too
+    mset.remove_many_already_hashed(hashes[:numhashes // 2])
+    setss = [[bytes.fromhex(p) + hashes[i][2:] for i, p in enumerate(['1af4', '3ebc', '4a86', 
+            '5f45', 'd4a4', 'd54b', 'e842', 'fee3'])]]
+    for size in [1, 2, 3, 5, 8]:
+        for cluster in [b'', bytes([0x5a]), bytes([0xd5, 0x4b])]:
+            setss.append([cluster + h[len(cluster):] for h in hashes[:size]])
+    for things in setss:
+        ref = ReferenceMerkleSet()
+        single = MerkleSet(2, 4)
+        for thing in things:
+            ref.add_already_hashed(thing)
+            single.add_already_hashed(thing)
+        mset.add_many_already_hashed(things)
+        assert mset.get_root() == ref.get_root()
+        cluster = things[-1][:2]
+        for tocheck in things + [bytes(32), b'\xff' * 32, cluster + bytes(30), cluster + b'\xff' * 30, hashes[-1]]:
+            r, proof = ref.is_included_already_hashed(tocheck)
+            assert single.is_included_already_hashed(tocheck) == (r, proof)
+            assert mset.is_included_already_hashed(tocheck) == (r, proof)
+        mset.remove_many_already_hashed(things)
+    mset.add_many_already_hashed(hashes[:numhashes // 2])
+    assert mset.get_root() == roots[numhashes // 2]
+    # A shard running into an error passes it on and keeps going
+    mset.add_already_hashed(bytes(5))
+    try:
+        mset.get_root()
+        raised = False
+    except AssertionError:
+        raised = True
+    assert raised
+    assert mset.get_root() == roots[numhashes // 2]
+    mset.close()
+
+# Take snapshots along the way while adding and removing, checking they don't change
+def _testsnapshots(numhashes, mset, roots, proofss):
+    hashes = [blake2b(to_bytes(i, 10)).digest()[:32] for i in range(numhashes)]
+    snapshots = []
+    def check():
+        for i, s in snapshots:
+            assert s.get_root() == roots[i]
+            for j in range(0, numhashes, 17):
+                r, proof = s.is_included_already_hashed(hashes[j])
+                assert r == (j < i)
+                assert proof == proofss[i][j]
+    for i in range(numhashes):
+        if i % 23 == 0:
+            snapshots.append((i, mset.snapshot()))
+        mset.add_already_hashed(hashes[i])
+        if i % 31 == 0:
+            mset._audit(hashes[:i + 1])
+            check()
+    # release some in the middle and keep going
+    for i, s in snapshots[1::2]:
+        s.release()
+    released = snapshots[1][1]
+    snapshots = snapshots[::2]
+    mset._audit(hashes)
+    check()
+    # using a snapshot after it's been released fails instead of reading reused blocks
+    for f in [lambda: len(released), lambda: list(released), released.get_root, 
+            lambda: released.is_included_already_hashed(hashes[0]), lambda: hashes[0] in released, 
+            released.release]:
+        try:
+            f()
+            used = True
+        except AssertionError:
+            used = False
+        assert not used
+    s = mset.snapshot()
+    # adding what's already there and removing what isn't doesn't copy anything the snapshot uses
+    blocks = sorted(mset.arena.blocks())
+    retired = list(mset.retired)
+    absent = [blake2b(to_bytes(i, 11)).digest()[:32] for i in range(5)]
+    mset.add_already_hashed(hashes[0])
+    mset.add_many_already_hashed(hashes[::7])
+    mset.remove_already_hashed(absent[0])
+    mset.remove_many_already_hashed(absent)
+    assert sorted(mset.arena.blocks()) == blocks
+    assert mset.retired == retired
+    # and ones which are partly no-ops still do the rest
+    mset.remove_many_already_hashed(absent[:2] + hashes[:1])
+    mset.add_many_already_hashed(absent[:2] + hashes[:2])
+    mset.remove_many_already_hashed(absent)
+    mset._audit(hashes)
+    mset.remove_many_already_hashed(hashes[numhashes // 3:])
+    check()
+    assert s.is_included_many_already_hashed(hashes)[0] == [True] * numhashes
+    s.release()
+    for i in range(numhashes // 3):
+        mset.remove_already_hashed(hashes[i])
+    mset._audit([])
+    check()
+    mset.add_many_already_hashed(hashes[:numhashes // 2])
+    mset._audit(hashes[:numhashes // 2])
+    check()
+    mset.remove_many_already_hashed(hashes)
+    for i, s in snapshots:
+        s.release()
+    assert mset.retired == []
+    mset._audit([])
+
+# Reopen a file backed set between changes, comparing to roots from one at a time
+def _testpersistent(numhashes, depth, leaf_units, roots):
+    hashes = [blake2b(to_bytes(i, 10)).digest()[:32] for i in range(numhashes)]
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'set')
+        mset = MerkleSet.open(path, depth, leaf_units)
+        for i in range(numhashes):
+            mset.add_already_hashed(hashes[i])
+            if i % 37 == 0:
+                mset.close()
+                mset = MerkleSet.open(path, depth, leaf_units)
+                assert mset.get_root() == roots[i + 1]
+        mset.close()
+        mset = MerkleSet.open(path, depth, leaf_units)
+        mset._audit(hashes)
+        mset.remove_many_already_hashed(hashes[numhashes // 2:])
+        mset.flush()
+        # Blocks which only a snapshot was using at the flush get freed when it's opened again
+        snapshot = mset.snapshot()
+        mset.remove_many_already_hashed(hashes[:numhashes // 4])
+        mset.flush()
+        mset.arena.close()
+        mset = MerkleSet.open(path, depth, leaf_units)
+        mset._audit(hashes[numhashes // 4:numhashes // 2])
+        # Dying before a flush goes back to the last one
+        root = mset.get_root()
+        mset.remove_already_hashed(hashes[numhashes // 4])
+        mset.add_many_already_hashed(hashes[numhashes // 2:])
+        mset.get_root()
+        mset.arena.close()
+        mset = MerkleSet.open(path, depth, leaf_units)
+        assert mset.get_root() == root
+        mset._audit(hashes[numhashes // 4:numhashes // 2])
+        mset.remove_already_hashed(hashes[numhashes // 4])
+        mset.close()
+        mset = MerkleSet.open(path, depth, leaf_units)
+        mset._audit(hashes[numhashes // 4 + 1:numhashes // 2])
+        mset.close()
+        mset = MerkleSet.open(os.path.join(d, 'other'), depth, leaf_units)
+        mset.add_many_already_hashed(hashes[:numhashes // 2])
+        mset.close()
+        try:
+            MerkleSet.open(os.path.join(d, 'other'), depth + 1, leaf_units)
+            assert False
+        except SetError:
+            pass
+        mset = MerkleSet.open(os.path.join(d, 'other'), depth, leaf_units)
+        assert mset.get_root() == roots[numhashes // 2]
+        mset.close()
+        # Dying while a new file is being made leaves nothing at its path
+        MerkleSet.open(os.path.join(d, 'new'), depth, leaf_units).close()
+        assert sorted(os.listdir(d)) == ['new', 'other', 'set']
+        for contents in [b'', bytes(4096)]:
+            with open(os.path.join(d, 'dead.new'), 'wb') as f:
+                f.write(contents)
+            mset = MerkleSet.open(os.path.join(d, 'dead'), depth, leaf_units)
+            assert mset.get_root() == BLANK
+            mset.add_already_hashed(hashes[0])
+            mset.close()
+            mset = MerkleSet.open(os.path.join(d, 'dead'), depth, leaf_units)
+            assert mset.get_root() == roots[1]
+            mset.close()
+            os.remove(os.path.join(d, 'dead'))
+        for contents in [b'', bytes(4096)]:
+            with open(os.path.join(d, 'bad'), 'wb') as f:
+                f.write(contents)
+            try:
+                MerkleSet.open(os.path.join(d, 'bad'), depth, leaf_units)
+                assert False
+            except SetError:
+                pass
+
+def _slow_confirm(root, val, proof, expected):
+    try:
+        p = deserialize_proof(proof)
+        if p.get_root() != root:
+            return False
+        r, junk = p.is_included_already_hashed(val)
+        return r == expected
+    except SetError:
+        return False
+
+def _mangle(proof):
+    bads = [proof[:k] for k in range(len(proof))] + [proof + x for x in [EMPTY, TERMINAL, MIDDLE, TRUNCATED]]
+    for k in range(len(proof)):
+        for v in [0, 1, 2, 3, 4, proof[k] ^ 0x80]:
+            bads.append(proof[:k] + bytes([v]) + proof[k + 1:])
+    return bads
+
+# Mangle proofs every which way, checking that the single pass verifier agrees with deserializing
+# and that nothing checking proofs raises anything other than returning False
+def _testbadproofs(numhashes):
+    hashes = [blake2b(to_bytes(i, 10)).digest()[:32] for i in range(numhashes)]
+    for bad in [MIDDLE + TERMINAL + b'abc' + TERMINAL + b'def', MIDDLE + TERMINAL + bytes(32) + TERMINAL + bytes(32), 
+            MIDDLE + TRUNCATED + bytes(32) + TRUNCATED + bytes(5), MIDDLE * 300 + EMPTY]:
+        for root in [bytes(32), hashes[0]]:
+            assert not confirm_included_already_hashed(root, bytes(32), bad)
+            assert not confirm_many_already_hashed(root, [bytes(32)], [False], bad)
+            assert not confirm_prefix_already_hashed(root, bytes(32), 3, [], bad)
+    mset = MerkleSet(2, 4)
+    for i in [0, 1, 2, 3, 10, numhashes // 2]:
+        mset.add_many_already_hashed(hashes[:i])
+        root = mset.get_root()
+        for j in range(0, numhashes, 29):
+            r, proof = mset.is_included_already_hashed(hashes[j])
+            assert verify_proof(hashes[j], proof) == (root, r)
+            for bad in _mangle(proof):
+                assert confirm_included_already_hashed(root, hashes[j], bad) == _slow_confirm(root, hashes[j], bad, True)
+                assert confirm_not_included_already_hashed(root, hashes[j], bad) == _slow_confirm(root, hashes[j], bad, False)
+                assert confirm_many_already_hashed(root, [hashes[j]], [r], bad) == _slow_confirm(root, hashes[j], bad, r)
+        for prefix, depth in [(hashes[0], 1), (hashes[1], 3), (bytes(32), 5)]:
+            things, proof = mset.prefix_query(prefix, depth)
+            assert confirm_prefix_already_hashed(root, prefix, depth, things, proof)
+            for bad in _mangle(proof):
+                assert confirm_prefix_already_hashed(root, prefix, depth, things, bad) == (bad == proof)
+
 def testall():
     num = 200
     roots, proofss = _testmset(num, ReferenceMerkleSet())
+    _testbadproofs(num)
     # Test with a range of values of both parameters
     for i in range(1, 5):
         for j in range(6):
             _testmset(num, MerkleSet(i, 2 ** j), roots, proofss)
             _testlazy(num, MerkleSet(i, 2 ** j), roots, proofss)
+            _testmany(num, MerkleSet(i, 2 ** j), roots, proofss)
+            _testsorted(num, i, 2 ** j, roots)
+            _testpersistent(num, i, 2 ** j, roots)
+            _testsnapshots(num, MerkleSet(i, 2 ** j), roots, proofss)
+            _testworkers(num, MerkleSet(i, 2 ** j), roots)
+            _testmultiproof(num, MerkleSet(i, 2 ** j))
+            _testiter(num, MerkleSet(i, 2 ** j))
+            _testcounts(num, MerkleSet(i, 2 ** j))
+            _testdiff(num, MerkleSet(i, 2 ** j))
+            _testprefix(num, MerkleSet(i, 2 ** j))
+            _testremoveprefix(num, MerkleSet(i, 2 ** j))
+            _testupdate(num, i, 2 ** j, roots)
+            _testdump(num, i, 2 ** j, roots)
+            _testchanges(num, MerkleSet(i, 2 ** j))
+            _testlogged(num, i, 2 ** j, roots)
+            _testtransactions(num, MerkleSet(i, 2 ** j), roots)
+            _testadvance(num, MerkleSet(i, 2 ** j), roots)
+            _testcontains(num, MerkleSet(i, 2 ** j))
+            _testhasher(num, MerkleSet(i, 2 ** j, hasher = Hasher(blake2s)))
+            _testhasher(num, MerkleSet(i, 2 ** j, hasher = _FlippedHasher()))
+    for bits in [0, 1, 3]:
+        _testsharded(num, ShardedMerkleSet(bits, 2, 4), roots, proofss)
 
 testall()